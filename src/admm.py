@@ -0,0 +1,374 @@
+# Consensus ADMM solver for networks with many consumers. The problem is split into one subproblem per consumer,
+# over its valve parameters theta_i and a local copy of the parameters of the pipes on its path, which are driven
+# to agree on the shared pipe parameters s. The subproblems are solved in worker processes, sharing phi through
+# shared memory.
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import scipy.sparse as sp
+
+from solvers import nnls_gram
+from utils.topology import load_topology
+
+# number of worker processes of the admm solver, set with --solver-workers
+N_WORKERS = 1
+# rescale the penalty rho when the primal and dual residuals differ by more than this factor
+RHO_BALANCE = 10
+# iterations between checks of the residual balance
+RHO_INTERVAL = 10
+# estimated time of an iteration spent per consumer, n_features + path length + CONSUMER_WORK, and per batch of
+# consumers, BATCH_WORK, for splitting the consumers over the admm workers
+CONSUMER_WORK = 7
+BATCH_WORK = 1300
+
+def share_arrays(arrays):
+    """
+    Copy arrays into shared memory. Returns the blocks, to be closed and unlinked when done,
+    and a description of each array for attach_arrays.
+    """
+    blocks, descriptions = [], {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        descriptions[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, descriptions
+
+def attach_arrays(descriptions):
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in descriptions.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    return blocks, arrays
+
+class ConsumerGroup:
+    """
+    The subproblems of a set of consumers. Consumer i has the local variables x_i = (theta_i, s_i), where s_i is its
+    copy of the parameters s[P_i] of the pipes on its path, and the local problem
+        min 1/2 x_i^T G_i x_i - c_i^T x_i + valve terms + rho/2 ||s_i - z[P_i] + u_i||^2,  x_i >= 0
+    where G_i, c_i are the Gram statistics of the rows of phi which hit valve i, z is the consensus value of s and u_i
+    the scaled dual variables. The consumers are batched by the size of their local problem, and solved all at once on
+    the passive sets of their last solutions; the ones where this is not optimal are solved with nnls_gram.
+    """
+    def __init__(self, phi, y, W, row_consumer, consumers, topology, n_features):
+        self.n_features = n_features
+        order = np.argsort(row_consumer, kind="stable")
+        starts = np.searchsorted(row_consumer[order], consumers, side="left")
+        ends = np.searchsorted(row_consumer[order], consumers, side="right")
+        y_w = W * y
+
+        sizes = {}
+        for i, start, end in zip(consumers, starts, ends):
+            rows = order[start:end]
+            pipes = topology.pipemap[i]
+            columns = np.concatenate([np.arange(i*n_features, (i+1)*n_features), topology.n_consumers * n_features + pipes])
+            A = phi[rows][:, columns].toarray() * W[rows, None]
+            batch = sizes.setdefault(len(pipes), {"consumers": [], "pipes": [], "G": [], "c": [], "yy": 0.0})
+            batch["consumers"].append(i)
+            batch["pipes"].append(pipes)
+            batch["G"].append(A.T @ A)
+            batch["c"].append(A.T @ y_w[rows])
+            batch["yy"] += y_w[rows] @ y_w[rows]
+
+        self.batches = []
+        for batch in sizes.values():
+            G = np.array(batch["G"])
+            self.batches.append({
+                "consumers": np.array(batch["consumers"]), "pipes": np.array(batch["pipes"]),
+                "G": G, "c": np.array(batch["c"]), "yy": batch["yy"],
+                "x": np.zeros(G.shape[:2]), "u": np.zeros((G.shape[0], G.shape[1] - n_features)), "started": False,
+            })
+
+    def pipe_diagonals(self, n_pipes):
+        """
+        Sum of the diagonal entries of G_i for each pipe over the consumers in the group, for choosing rho
+        """
+        total = np.zeros(n_pipes)
+        for b in self.batches:
+            np.add.at(total, b["pipes"], np.diagonal(b["G"], axis1=1, axis2=2)[:, self.n_features:])
+        return total
+
+    def factor(self, rho, valve_ridge):
+        """
+        Set the penalty rho (per pipe) and the ridge on theta in the matrices of the local problems
+        """
+        K = self.n_features
+        for b in self.batches:
+            H = b["G"].copy()
+            H[:, np.arange(K), np.arange(K)] += valve_ridge
+            H[:, np.arange(K, H.shape[1]), np.arange(K, H.shape[1])] += rho[b["pipes"]]
+            # scaled to unit diagonal, since the valve features span many orders of magnitude
+            scale = np.sqrt(np.diagonal(H, axis1=1, axis2=2)).copy()
+            b["observed"] = scale > 0
+            scale[scale == 0] = 1
+            b["H"] = H
+            b["scale"] = scale
+            b["H scaled"] = H / scale[:, :, None] / scale[:, None, :]
+            b["rho"] = rho[b["pipes"]]
+            if "passive" not in b:
+                b["passive"] = b["observed"].copy()
+            b["inverse"] = self.passive_inverse(b, np.arange(len(H)))
+
+    def rescale(self, factor):
+        # the scaled dual variables u = lambda / rho follow a change of rho
+        for b in self.batches:
+            b["u"] /= factor
+
+    def update(self, z, valve_linear):
+        """
+        One iteration for the consensus value z: update the dual variables with the previous local solutions,
+        and solve the local problems. Returns the sums of rho (s_i + u_i) for each pipe and the primal residual
+        sum rho ||s_i - z[P_i]||^2 of the previous local solutions.
+        """
+        K = self.n_features
+        total = np.zeros(len(z))
+        primal = 0.0
+        for b in self.batches:
+            zp = z[b["pipes"]]
+            if b["started"]:
+                difference = b["x"][:, K:] - zp
+                primal += np.sum(b["rho"] * difference**2)
+                b["u"] += difference
+            b["started"] = True
+
+            d = b["c"].copy()
+            d[:, :K] -= valve_linear
+            d[:, K:] += b["rho"] * (zp - b["u"])
+            x, solved = self.solve_passive(b, d)
+            changed = np.flatnonzero(~solved)
+            for j in changed:
+                x[j], _ = nnls_gram(b["H"][j], d[j], passive=b["passive"][j])
+                b["passive"][j] = x[j] > 0
+            if len(changed) > 0:
+                b["inverse"][changed] = self.passive_inverse(b, changed)
+            b["x"] = x
+            np.add.at(total, b["pipes"], b["rho"] * (x[:, K:] + b["u"]))
+        return total, primal
+
+    def passive_inverse(self, b, index):
+        """
+        Inverses of the scaled local matrices restricted to the passive sets, for the consumers in index of a batch
+        """
+        P = b["passive"][index] & b["observed"][index]
+        n = P.shape[1]
+        A = b["H scaled"][index] * (P[:, :, None] & P[:, None, :])
+        # pinv, since the features in a passive set can be (nearly) collinear
+        return np.linalg.pinv(A, hermitian=True) * (P[:, :, None] & P[:, None, :])
+
+    def solve_passive(self, b, d):
+        """
+        Solve the local problems of a batch on the passive sets of their last solutions, all at once.
+        Returns the solutions, and which of them are optimal; the others have to be solved with nnls_gram.
+        """
+        P = b["passive"] & b["observed"]
+        d_scaled = d / b["scale"]
+        x = np.einsum("mij,mj->mi", b["inverse"], d_scaled)
+        gradient = d_scaled - np.einsum("mij,mj->mi", b["H scaled"], x)
+        tol = 1e-10 * np.maximum(1, np.abs(d_scaled).max(axis=1))
+        solved = np.all((x > 0) | ~P, axis=1) & np.all((gradient <= tol[:, None]) | P, axis=1)
+        return x / b["scale"], solved
+
+    def objective_terms(self, z):
+        """
+        The weighted sum of squared residuals of the consumers in the group with the pipe parameters z,
+        and the sums of theta and theta^2
+        """
+        K = self.n_features
+        squares = 0.0
+        theta_sum = 0.0
+        theta_squares = 0.0
+        for b in self.batches:
+            x = np.concatenate([b["x"][:, :K], z[b["pipes"]]], axis=1)
+            squares += np.einsum("mi,mij,mj->", x, b["G"], x) - 2 * np.einsum("mi,mi->", b["c"], x) + b["yy"]
+            theta_sum += b["x"][:, :K].sum()
+            theta_squares += np.sum(b["x"][:, :K]**2)
+        return squares, theta_sum, theta_squares
+
+    def theta(self):
+        return [(b["consumers"], b["x"][:, :self.n_features]) for b in self.batches]
+
+def _run_worker(connection, descriptions, shape, consumers, topology, n_features):
+    blocks, arrays = attach_arrays(descriptions)
+    phi = sp.csr_matrix((arrays["phi_data"], arrays["phi_indices"], arrays["phi_indptr"]), shape=shape)
+    group = ConsumerGroup(phi, arrays["y"], arrays["W"], arrays["row consumer"], consumers, topology, n_features)
+    # the group holds its own Gram statistics, so the shared arrays are not needed anymore
+    del phi, arrays
+    for block in blocks:
+        block.close()
+    connection.send(None)
+    while True:
+        method, args = connection.recv()
+        if method is None:
+            break
+        connection.send(getattr(group, method)(*args))
+    connection.close()
+
+class ConsumerPool:
+    """
+    The consumers split into n_workers groups, each in a worker process (or in this process with n_workers = 1).
+    call(method, *args) calls the method of all groups at once and returns their results.
+    The groups are contiguous runs of the consumers ordered by path length, so that each group only holds a few of
+    the batches of ConsumerGroup: much of the time of an iteration is spent per batch, and splitting every batch over
+    all workers would leave each of them nearly the work of a serial solve. The runs are cut at equal estimated work
+    (see CONSUMER_WORK and BATCH_WORK).
+    """
+    def __init__(self, phi, y, W, row_consumer, topology, n_features, n_workers):
+        path_lengths = np.diff(topology.incidence.indptr)
+        order = np.argsort(path_lengths, kind="stable")
+        batch_starts = np.diff(path_lengths[order], prepend=-1) != 0
+        work = np.cumsum(n_features + path_lengths[order] + CONSUMER_WORK + BATCH_WORK * batch_starts)
+        groups = np.split(order, np.searchsorted(work, work[-1] * np.arange(1, n_workers) / n_workers))
+        self.local = None
+        self.workers = []
+        if n_workers == 1:
+            self.local = ConsumerGroup(phi, y, W, row_consumer, groups[0], topology, n_features)
+            return
+
+        blocks, descriptions = share_arrays({
+            "phi_data": phi.data, "phi_indices": phi.indices, "phi_indptr": phi.indptr,
+            "y": y, "W": W, "row consumer": row_consumer,
+        })
+        try:
+            for consumers in groups:
+                connection, child = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_run_worker, args=(child, descriptions, phi.shape, consumers, topology, n_features), daemon=True)
+                process.start()
+                self.workers.append((process, connection))
+            for _, connection in self.workers:
+                connection.recv()
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    def call(self, method, *args):
+        if self.local is not None:
+            return [getattr(self.local, method)(*args)]
+        for _, connection in self.workers:
+            connection.send((method, args))
+        return [connection.recv() for _, connection in self.workers]
+
+    def close(self):
+        for process, connection in self.workers:
+            connection.send((None, None))
+            connection.close()
+            process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def solve_admm(phi, y, w, settings, beta0 = None, n_workers = None, tol = 1e-8, max_iter = 20000, max_outer = 200):
+    """
+    Solve the problem with L2 cost (cost norm = 2) and L1 or L2 regularization with consensus ADMM over the consumers,
+    for networks where the Gram matrix of all parameters (as used by the nnls solver) is too large.
+    As in solve_nnls, the non-squared cost has the optimality conditions of the regularized least squares problem for
+    the residual r* = ||W (phi beta* - y)||_2 and block norms at the optimum, so the ADMM is run for the current r and
+    norms, which are then updated, until beta converges. Each ADMM iteration solves the local problems of all
+    consumers in n_workers processes (N_WORKERS by default), and then updates the consensus value z of the pipe
+    parameters in this process.
+    beta0: an earlier solution to start the pipe parameters from.
+    Returns beta and a dict with the number of outer and ADMM iterations and the objective.
+    """
+    if settings["cost norm"] != 2 or settings["regularization norm"] not in [1, 2]:
+        raise ValueError("The admm solver requires cost norm 2 and regularization norm 1 or 2.")
+
+    topology = load_topology(settings)
+    n_workers = min(N_WORKERS if n_workers is None else n_workers, topology.n_consumers)
+    phi = sp.csr_matrix(phi)
+    n_data = phi.shape[0]
+    n_features = (phi.shape[1] - topology.n_pipes) // topology.n_consumers
+    W = np.asarray(w**settings["flow rate weights"], dtype=float)
+    # each row hits one valve block, whose first column comes first in the row
+    row_consumer = phi.indices[phi.indptr[:-1]] // n_features
+    # number of local copies of each pipe parameter
+    copies = np.asarray(topology.incidence.sum(axis=0)).ravel()
+    valve_gain = settings["valve regularization gain"]
+    pipe_gain = settings["pipe regularization gain"]
+
+    with ConsumerPool(phi, np.asarray(y, dtype=float), W, row_consumer, topology, n_features, n_workers) as pool:
+        base_rho = sum(pool.call("pipe_diagonals", topology.n_pipes)) / copies
+        base_rho[base_rho == 0] = 1
+        rho_scale = 1.0
+        z = np.zeros(topology.n_pipes) if beta0 is None else np.asarray(beta0, dtype=float)[-topology.n_pipes:].copy()
+
+        def objective_terms(z):
+            terms = np.sum(pool.call("objective_terms", z), axis=0)
+            return np.sqrt(max(terms[0], 1e-300)), terms[1], np.sqrt(terms[2])
+
+        def run(valve_linear, valve_ridge, pipe_linear, pipe_ridge, z):
+            """
+            ADMM iterations for fixed regularization terms, until the primal and dual residuals are below tol
+            relative to the size of z
+            """
+            nonlocal rho_scale
+            pool.call("factor", rho_scale * base_rho, valve_ridge)
+            for iteration in range(1, max_iter + 1):
+                rho = rho_scale * base_rho
+                results = pool.call("update", z, valve_linear)
+                total = sum(r[0] for r in results)
+                primal = np.sqrt(sum(r[1] for r in results))
+                # prox of the pipe regularization and s >= 0 for the average of the local copies
+                z_new = np.maximum(total - pipe_linear, 0) / (rho * copies + pipe_ridge)
+                dual = np.sqrt(np.sum(rho * copies * (z_new - z)**2))
+                size = max(np.sqrt(np.sum(rho * copies * z_new**2)), 1e-300)
+                z = z_new
+                if iteration > 1 and primal <= tol * size and dual <= tol * size:
+                    break
+                if iteration % RHO_INTERVAL == 0 and iteration > 1:
+                    # keep the residuals balanced
+                    factor = 2.0 if primal > RHO_BALANCE * dual else 0.5 if dual > RHO_BALANCE * primal else 1.0
+                    if factor != 1.0:
+                        rho_scale *= factor
+                        pool.call("rescale", factor)
+                        pool.call("factor", rho_scale * base_rho, valve_ridge)
+            return z, iteration
+
+        def beta_of(z):
+            theta = np.zeros((topology.n_consumers, n_features))
+            for group in pool.call("theta"):
+                for consumers, values in group:
+                    theta[consumers] = values
+            return np.concatenate([theta.reshape(-1), z])
+
+        # start from the unregularized solution
+        z, iterations = run(0.0, 0.0, 0.0, 0.0, z)
+
+        norm = settings["regularization norm"]
+        def objective(z):
+            residual, theta_sum, theta_norm = objective_terms(z)
+            value = residual / n_data + valve_gain * (theta_sum if norm == 1 else theta_norm) + pipe_gain * np.linalg.norm(z, norm)
+            return value, residual, theta_norm
+
+        outer = 0
+        if valve_gain > 0 or pipe_gain > 0:
+            previous = None
+            for outer in range(1, max_outer + 1):
+                value, residual, theta_norm = objective(z)
+                # the fixed point is reached when the residual and block norms which define the terms no longer change
+                norms = np.array([residual, theta_norm, np.linalg.norm(z)])
+                if previous is not None and abs(norms[0] - previous[0]) <= 10 * tol * norms[0] \
+                        and np.all(np.abs(norms[1:] - previous[1:]) <= 10 * tol * norms[1:].sum()):
+                    break
+                previous = norms
+                scale = n_data * residual
+                if norm == 1:
+                    terms = (scale * valve_gain, 0.0, scale * pipe_gain, 0.0)
+                else:
+                    # a block which has reached zero stays there
+                    ridge = lambda gain, block_norm: min(scale * gain / block_norm, 1e300) if block_norm > 0 else (1e300 if gain > 0 else 0.0)
+                    terms = (0.0, ridge(valve_gain, theta_norm), 0.0, ridge(pipe_gain, norms[2]))
+                z, n_iter = run(*terms, z)
+                iterations += n_iter
+
+        beta = beta_of(z)
+        value, _, _ = objective(z)
+
+    info = {"outer iterations": outer, "admm iterations": iterations, "objective": value}
+    logging.info(f"admm: {outer} outer / {iterations} ADMM iterations with {n_workers} workers. Optimal value: {value:.6e}")
+    return beta, info
@@ -0,0 +1,275 @@
+# End-to-end benchmark on synthetic data: generates raw data files from a known network, and times each stage
+# of the pipeline from preparing the data set to exporting figures, recording wall time and peak memory as JSON.
+import importlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+import admm
+from training import make_data_matrices, solve_beta, split_parameters, training_split, SOLVERS
+from evaluation import predict_flow_rates, evaluate_model
+from plotting import scatter_errors
+from predictor import Predictor
+from profiling import reset_peak_rss, peak_rss
+from utils.hysteresis import hysteresis_kernel, append_hysteresis
+from utils.prepare_datasets import make_filtered_data_set
+from utils.topology import load_topology, DEFAULT_TOPOLOGY
+from utils.utils import DATA_DIR, load_data, save_model, save_results, write_column_store, model_dirname
+
+# name of the data set and model written by the benchmark, removed again afterwards
+BENCHMARK_NAME = "benchmark"
+# raw samples per load condition, as for the realistic data set in prepare_datasets.run
+STEP_LENGTH = 30
+# raw samples dropped at the start of the realistic data set
+SKIP = 100
+# the network the data is generated from: valve resistances theta_i / v^2 and pipe parameters s, given for the lab
+# network and repeated over the consumers and pipes of larger networks
+TRUE_THETA = np.array([0.4, 0.5, 0.6, 0.7])
+TRUE_S = np.array([0.01, 0.012, 0.011, 0.013, 0.02, 0.015, 0.01])
+# samples predicted one at a time to measure the per-sample latency of the predictor
+LATENCY_SAMPLES = 1000
+# consumers whose error scatters are drawn in the export stage
+EXPORT_CONSUMERS = 4
+
+def true_parameters(topology):
+    """
+    The parameters theta (one per consumer) and s of the network the data is generated from
+    """
+    return np.resize(TRUE_THETA, topology.n_consumers), np.resize(TRUE_S, topology.n_pipes)
+
+def simulate(topology, n_steps, hysteresis_percent, rng):
+    """
+    Valve set-points v of shape (n_steps, n_consumers), pump pressures dp_pump and flow rates q of the consumers, of
+    shape (n_steps, n_consumers), of n_steps load conditions. The set-points follow random walks, the valves lag
+    behind them with hysteresis of hysteresis_percent, and the flow rates follow from the pump pressure through the
+    network (predict_flow_rates).
+    """
+    theta, s = true_parameters(topology)
+    v = np.clip(0.5 + np.cumsum(rng.normal(0, 0.05, (n_steps, topology.n_consumers)), axis=0) % 1.0, 0.05, 1.0)
+    dp_pump = 3 + rng.normal(0, 0.2, n_steps)
+    conditions = pd.DataFrame({"dp_pump": dp_pump})
+    for i in range(topology.n_consumers):
+        conditions[f"vh{i}"] = hysteresis_kernel(v[:, i], hysteresis_percent / 100)
+    s_valves = lambda positions: theta[:, None] / np.array(positions)**2
+    q = predict_flow_rates(conditions, s_valves, s, 2, topology).to_numpy()
+    return v, dp_pump, q
+
+def generate_raw_data(raw_dir, n_data, noise = 0.01, hysteresis_percent = 1.5, seed = 0):
+    """
+    Write raw data files of the lab network for the realistic data set in raw_dir/realistic, which prepare into
+    n_data load conditions (see simulate). Each load condition is held for STEP_LENGTH raw samples, with Gaussian
+    noise of standard deviation noise times the mean value added to the flow rates and pressures.
+    """
+    topology = load_topology({})
+    rng = np.random.default_rng(seed)
+    n_raw = SKIP + (n_data + 1) * STEP_LENGTH
+    # load condition of each raw sample, such that the blocks after the first SKIP samples each hold one load condition
+    step = (np.arange(n_raw) - SKIP) // STEP_LENGTH - (-SKIP // STEP_LENGTH)
+    v, dp_pump, q = simulate(topology, step[-1] + 1, hysteresis_percent, rng)
+
+    noisy = lambda x: x[step] * (1 + noise * rng.normal(0, 1, n_raw))
+    time_column = np.arange(n_raw)
+
+    dirname = os.path.join(raw_dir, "realistic")
+    os.makedirs(dirname, exist_ok=True)
+    for i in range(topology.n_consumers):
+        q_pipe = noisy(q[:, i])
+        pd.DataFrame({
+            "time": time_column, "q_sensor": q_pipe, "q_pipe": q_pipe, "p_in": noisy(dp_pump), "p_out": np.ones(n_raw),
+            "v": 100 * v[step, i], "qr": q_pipe,
+        }).to_csv(os.path.join(dirname, f"consumer_{i+1}.csv"), index=False)
+    p_return = np.ones(n_raw)
+    pd.DataFrame({
+        "time": time_column, "p3_1": p_return, "p3_2": p_return, "p3_3": p_return + noisy(dp_pump), "q2_2": np.zeros(n_raw),
+    }).to_csv(os.path.join(dirname, "pump_41.csv"), index=False)
+    for name, offset in [("pipe_20.csv", 1), ("pipe_24.csv", 0)]:
+        pressures = {f"p{k}_2": offset + noisy(dp_pump) for k in range(1, 5)}
+        pd.DataFrame({"time": time_column, **pressures, "q3_1": np.zeros(n_raw)}).to_csv(os.path.join(dirname, name), index=False)
+
+def generate_data_set(topology, n_data, noise = 0.01, hysteresis_percent = 1.5, seed = 0):
+    """
+    A prepared data set of n_data load conditions for any network (see simulate), for networks which have no raw data
+    format. The valve positions v{i}, the pump pressure dp_pump, the flow rates q{i} of the consumers and the flow
+    columns of the topology, with Gaussian noise of standard deviation noise times the value on the flow rates and
+    pressures.
+    """
+    rng = np.random.default_rng(seed)
+    v, dp_pump, q = simulate(topology, n_data, hysteresis_percent, rng)
+    noisy = lambda x: x * (1 + noise * rng.normal(0, 1, np.shape(x)))
+    q = noisy(q)
+    q_pipe = topology.pipe_flow_rates(q)
+    data = pd.DataFrame({f"q{i}": q[:, i] for i in range(topology.n_consumers)})
+    for e, column in topology.flow_columns.items():
+        data[column] = q_pipe[:, e]
+    for i in range(topology.n_consumers):
+        data[f"v{i}"] = v[:, i]
+    data["dp_pump"] = noisy(dp_pump)
+    data["time"] = np.arange(n_data)
+    data.index.name = "sample"
+    return data
+
+def solver_settings(settings, solver):
+    """
+    The settings with the cost and regularization norms the solver backend needs, if it needs any
+    """
+    if solver == "highs":
+        return dict(settings, **{"solver": solver, "cost norm": 1, "regularization norm": 1})
+    if solver in ["nnls", "admm"]:
+        return dict(settings, **{"solver": solver, "cost norm": 2})
+    return dict(settings, solver=solver)
+
+def time_predictor(model, data):
+    """
+    Per-sample latency (in seconds) of a Predictor for the model, predicting LATENCY_SAMPLES samples of the data one at
+    a time, and its throughput (samples per second) predicting all of the data in one batch
+    """
+    predictor = Predictor(model)
+    v = data[[f"v{i}" for i in range(predictor.topology.n_consumers)]].to_numpy()
+    dp_pump = data["dp_pump"].to_numpy()
+    n = min(len(data), LATENCY_SAMPLES)
+    start = time.perf_counter()
+    for k in range(n):
+        predictor.predict(v[k], dp_pump[k])
+    latency = (time.perf_counter() - start) / n
+
+    predictor.reset()
+    start = time.perf_counter()
+    predictor.predict(v, dp_pump)
+    return latency, len(data) / (time.perf_counter() - start)
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(DATA_DIR), capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def remove_artifacts():
+    paths = [
+        os.path.join(DATA_DIR, f"{BENCHMARK_NAME}.csv"),
+        os.path.join(DATA_DIR, f"{BENCHMARK_NAME}_columns"),
+        os.path.join(DATA_DIR, "results", f"{BENCHMARK_NAME}_{BENCHMARK_NAME}_{BENCHMARK_NAME}.csv"),
+        os.path.join(DATA_DIR, "tikz", f"error_train_{BENCHMARK_NAME}_{BENCHMARK_NAME}_{BENCHMARK_NAME}.csv"),
+        os.path.join(DATA_DIR, "tikz", f"error_test_{BENCHMARK_NAME}_{BENCHMARK_NAME}_{BENCHMARK_NAME}.csv"),
+        os.path.join(DATA_DIR, "tikz", f"valve_curve_{BENCHMARK_NAME}_{BENCHMARK_NAME}.csv"),
+        model_dirname(BENCHMARK_NAME, BENCHMARK_NAME),
+    ]
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+def run_benchmark(settings, n_data, noise = 0.01, hysteresis_percent = 1.5, solvers = SOLVERS, seed = 0):
+    """
+    Run the pipeline on a synthetic data set of n_data load conditions, with the model settings in settings, and
+    return a report with the wall time and peak RSS of each stage:
+    generate, prepare, load, hysteresis, phi, solve (one stage per solver backend, and for admm with --solver-workers
+    also one in this process), evaluation, predict and export.
+    The data are generated for the network of the model: for the lab network as raw data files which are prepared as
+    the realistic data set, and for other networks as a prepared data set, which the prepare stage only saves.
+    """
+    settings = dict(settings, name=BENCHMARK_NAME)
+    topology = load_topology(settings)
+    stages = []
+    # the figures are only saved
+    plt.switch_backend("Agg")
+
+    def stage(name, func, *args):
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = func(*args)
+        stages.append({"stage": name, "wall time": time.perf_counter() - start, "peak rss": peak_rss()})
+        logging.info(f"{name}: {stages[-1]['wall time']:.3f} s, peak RSS {stages[-1]['peak rss']:.0f} MB")
+        return result
+
+    def generate(raw_dir):
+        if settings.get("topology", DEFAULT_TOPOLOGY) == DEFAULT_TOPOLOGY:
+            generate_raw_data(raw_dir, n_data, noise, hysteresis_percent, seed)
+            return None
+        return generate_data_set(topology, n_data, noise, hysteresis_percent, seed)
+
+    def prepare(raw_dir, data):
+        if data is None:
+            data = make_filtered_data_set("realistic", STEP_LENGTH, raw_dir=raw_dir)
+        data.to_csv(os.path.join(DATA_DIR, f"{BENCHMARK_NAME}.csv"))
+        write_column_store(BENCHMARK_NAME)
+
+    def export(model, results):
+        # the tikz data and the error scatter plots, as made from saved models and results
+        save_model(model, BENCHMARK_NAME, overwrite=True)
+        save_results(results, BENCHMARK_NAME, BENCHMARK_NAME, BENCHMARK_NAME, overwrite=True)
+        tikz = importlib.import_module("tikz-data")
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(DATA_DIR))
+        try:
+            os.makedirs(os.path.join("data", "tikz"), exist_ok=True)
+            tikz.error_data(BENCHMARK_NAME, BENCHMARK_NAME, BENCHMARK_NAME)
+            tikz.valve_curve_data(BENCHMARK_NAME, BENCHMARK_NAME)
+        finally:
+            os.chdir(cwd)
+        n_axes = min(topology.n_consumers, EXPORT_CONSUMERS)
+        fig, axs = plt.subplots(1, n_axes, figsize=(4 * n_axes, 4), squeeze=False)
+        for i, ax in enumerate(axs[0]):
+            scatter_errors(ax, i, BENCHMARK_NAME, BENCHMARK_NAME, BENCHMARK_NAME)
+        with tempfile.TemporaryDirectory() as dirname:
+            fig.savefig(os.path.join(dirname, "errors.png"))
+        plt.close(fig)
+
+    try:
+        with tempfile.TemporaryDirectory() as raw_dir:
+            generated = stage("generate", generate, raw_dir)
+            stage("prepare", prepare, raw_dir, generated)
+        data = stage("load", load_data, BENCHMARK_NAME)
+        data = stage("hysteresis", append_hysteresis, data, settings["hysteresis percent"])
+        phi, y, w = stage("phi", make_data_matrices, training_split(data, settings), settings)
+        stages[-1]["rows"] = phi.shape[0]
+
+        model = None
+        for solver in solvers:
+            beta = stage(f"solve {solver}", solve_beta, phi, y, w, solver_settings(settings, solver), None, False)
+            theta, s = split_parameters(beta, settings)
+            if settings["parameterization"] == "linear":
+                # the network can be represented exactly, so check that the solver still finds it
+                true_s = true_parameters(topology)[1]
+                stages[-1]["pipe parameter error"] = float(np.max(np.abs(np.array(s) - true_s) / true_s))
+            if model is None:
+                model = {"theta": theta, "s": s, "settings": solver_settings(settings, solver)}
+            if solver == "admm" and admm.N_WORKERS > 1:
+                # the same problem in this process, to compare the workers against
+                stage("solve admm serial", admm.solve_admm, phi, y, w, solver_settings(settings, solver), None, 1)
+
+        results = stage("evaluation", evaluate_model, model, BENCHMARK_NAME, True, data.copy())
+        latency, throughput = stage("predict", time_predictor, model, data)
+        stages[-1].update({"latency": latency, "throughput": throughput})
+        stage("export", export, model, results)
+    finally:
+        remove_artifacts()
+
+    return {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "rows": n_data,
+        "noise": noise,
+        "hysteresis percent": hysteresis_percent,
+        "settings": settings,
+        "stages": stages,
+    }
+
+def save_benchmark(report, filename = None):
+    if filename is None:
+        dirname = os.path.join(DATA_DIR, "benchmarks")
+        os.makedirs(dirname, exist_ok=True)
+        commit = report["commit"][:8] if report["commit"] else "unknown"
+        filename = os.path.join(dirname, f"{time.strftime('%Y%m%d-%H%M%S')}_{commit}.json")
+    logging.info(f"Saving benchmark report to {filename}.")
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=4)
@@ -0,0 +1,120 @@
+# Bootstrap confidence intervals for the parameters and valve curves of a model,
+# resampling the load conditions of data matrices which are built once.
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+
+import admm
+from training import make_data_matrices, row_mask, solve_beta, split_parameters, training_split
+from parallel import run_jobs
+from utils.hysteresis import append_hysteresis
+from utils.parameterization import valve_curve
+from utils.topology import load_topology
+from utils.cache import cache_key, load_cached_matrices, save_cached_matrices
+from utils.utils import load_data, DATA_DIR
+
+# data matrices and full-data solution shared by the replicates, set up once per worker
+WORKER_STATE = {}
+
+def block_bootstrap(n_data, block_length, rng):
+    """
+    Moving block bootstrap sample of the load conditions 0..n_data-1: blocks of block_length consecutive
+    load conditions starting at random positions, concatenated and cut to n_data.
+    block_length = 1 gives the ordinary bootstrap.
+    """
+    block_length = min(block_length, n_data)
+    n_blocks = -(-n_data // block_length)
+    starts = rng.integers(0, n_data - block_length + 1, n_blocks)
+    return (starts[:, None] + np.arange(block_length)[None, :]).reshape(-1)[:n_data]
+
+def sample_rows(conditions, row_starts, row_counts):
+    """
+    Rows of the data matrices of the (possibly repeated) load conditions in conditions
+    """
+    counts = row_counts[conditions]
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(row_starts[conditions], counts) + offsets
+
+def init_bootstrap_worker(settings, key, matrices, mask, beta_full, solver_workers = 1):
+    admm.N_WORKERS = solver_workers
+    # memory-mapped from the cache, unless they did not fit in it
+    WORKER_STATE["matrices"] = load_cached_matrices(key, mmap_mode="r") if matrices is None else matrices
+    # the rows of each load condition in the data matrices, where rows with q < threshold have been dropped
+    row_counts = mask.reshape(-1, load_topology(settings).n_consumers).sum(axis=1)
+    WORKER_STATE["row counts"] = row_counts
+    WORKER_STATE["row starts"] = np.cumsum(row_counts) - row_counts
+    WORKER_STATE["beta"] = beta_full
+
+def bootstrap_job(settings, seeds, block_length):
+    """
+    Solve one replicate per seed, warm-started from the full-data solution
+    """
+    phi, y, w = WORKER_STATE["matrices"]
+    n_data = len(WORKER_STATE["row counts"])
+    betas = []
+    for seed in seeds:
+        conditions = block_bootstrap(n_data, block_length, np.random.default_rng(seed))
+        rows = sample_rows(conditions, WORKER_STATE["row starts"], WORKER_STATE["row counts"])
+        betas.append(solve_beta(phi[rows], y[rows], w[rows], settings, WORKER_STATE["beta"], verbose=False))
+    return betas
+
+def bootstrap(settings, data_set, n_replicates, block_length, confidence = 0.95, n_jobs = 1, seed = 0):
+    """
+    Bootstrap the model in settings on the training data of data_set with n_replicates moving block bootstrap
+    replicates, solved in n_jobs worker processes. The data matrices are built once (through the data matrix cache)
+    and each replicate resamples their rows by load condition.
+    Returns percentile intervals at the given confidence level for each entry of theta and s, and for the kv values
+    of the valve curves.
+    """
+    key = cache_key(data_set, settings)
+    data = training_split(append_hysteresis(load_data(data_set), settings["hysteresis percent"]), settings)
+    matrices = None
+    if load_cached_matrices(key, mmap_mode="r") is None:
+        matrices = make_data_matrices(data, settings)
+        save_cached_matrices(key, data_set, settings, *matrices)
+        if load_cached_matrices(key, mmap_mode="r") is not None:
+            matrices = None
+    phi, y, w = load_cached_matrices(key, mmap_mode="r") if matrices is None else matrices
+    beta_full = solve_beta(phi, y, w, settings, verbose=False)
+
+    # a few jobs per worker, so the replicates are spread evenly
+    seeds = np.random.SeedSequence(seed).generate_state(n_replicates)
+    jobs = [(settings, chunk, block_length) for chunk in np.array_split(seeds, min(n_replicates, 4 * n_jobs))]
+    start = time.perf_counter()
+    betas = []
+    for _, result, output in run_jobs(bootstrap_job, jobs, n_jobs, init_bootstrap_worker, (settings, key, matrices, row_mask(data, settings), beta_full, admm.N_WORKERS)):
+        print(output, end="")
+        betas += result
+    elapsed = time.perf_counter() - start
+    logging.info(f"Solved {n_replicates} bootstrap replicates in {elapsed:.1f} s, {n_replicates / elapsed:.2f} replicates/s.")
+
+    levels = 100 * np.array([(1 - confidence) / 2, (1 + confidence) / 2])
+    betas = np.array(betas)
+    topology = load_topology(settings)
+    n_v = (betas.shape[1] - topology.n_pipes) // topology.n_consumers
+    names = [f"theta{i}_{k}" for i in range(topology.n_consumers) for k in range(n_v)] + [f"s{j}" for j in range(topology.n_pipes)]
+    lower, upper = np.percentile(betas, levels, axis=0)
+    parameters = pd.DataFrame({"parameter": names, "estimate": beta_full, "lower": lower, "upper": upper})
+
+    def curve(beta):
+        theta, s = split_parameters(beta, settings)
+        return valve_curve({"theta": theta, "s": s, "settings": settings})
+
+    kv = curve(beta_full)
+    curves = np.array([curve(beta)[[f"kv{i}" for i in range(topology.n_consumers)]].to_numpy() for beta in betas])
+    with np.errstate(invalid="ignore"):
+        kv_lower, kv_upper = np.percentile(curves, levels, axis=0)
+    for i in range(topology.n_consumers):
+        kv[f"kv{i} lower"] = kv_lower[:, i]
+        kv[f"kv{i} upper"] = kv_upper[:, i]
+    return parameters, kv
+
+def save_bootstrap(parameters, kv, model_name, data_set):
+    dirname = os.path.join(DATA_DIR, "bootstrap")
+    os.makedirs(dirname, exist_ok=True)
+    filename = os.path.join(dirname, f"{model_name}_{data_set}")
+    logging.info(f"Saving bootstrap intervals to {filename}_parameters.csv and {filename}_kv.csv.")
+    parameters.to_csv(f"{filename}_parameters.csv", index=False)
+    kv.to_csv(f"{filename}_kv.csv", index=False)
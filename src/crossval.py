@@ -0,0 +1,118 @@
+# Cross-validation of a model over k-fold, blocked or rolling-origin splits of a data set,
+# with the folds solved in parallel on one shared set of data matrices.
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+import admm
+from training import make_data_matrices, row_mask, estimate_parameters, training_columns
+from evaluation import predict_flow_rates
+from parallel import run_jobs
+from utils.hysteresis import append_hysteresis
+from utils.parameterization import valve_equivalent_resistances
+from utils.topology import load_topology
+from utils.cache import cache_key, load_cached_matrices, save_cached_matrices
+from utils.utils import load_data, DATA_DIR
+
+SCHEMES = ["kfold", "blocked", "rolling"]
+
+# data matrices and data shared by the folds, set up once per worker
+WORKER_STATE = {}
+
+def make_folds(n_data, scheme, k, seed = 0):
+    """
+    Split the load conditions 0..n_data-1 into k (train, test) pairs of index arrays.
+    * kfold: k random folds, each one the test set once
+    * blocked: k contiguous blocks in time, each one the test set once with the rest for training
+    * rolling: rolling origin, the data split into k+1 blocks in time, training on blocks 0..j and testing on block j+1
+    """
+    if scheme == "kfold":
+        order = np.random.default_rng(seed).permutation(n_data)
+        tests = [np.sort(fold) for fold in np.array_split(order, k)]
+        return [(np.setdiff1d(np.arange(n_data), test), test) for test in tests]
+    if scheme == "blocked":
+        tests = np.array_split(np.arange(n_data), k)
+        return [(np.setdiff1d(np.arange(n_data), test), test) for test in tests]
+    if scheme == "rolling":
+        blocks = np.array_split(np.arange(n_data), k + 1)
+        return [(np.concatenate(blocks[:j + 1]), blocks[j + 1]) for j in range(k)]
+    raise ValueError(f"Invalid cross-validation scheme {scheme}, choose from {SCHEMES}.")
+
+def full_data_settings(settings):
+    # the data matrices of all rows, the folds are sliced from these
+    return dict(settings, **{"training data percent": 100})
+
+def prepare_data(settings, data_set):
+    """
+    Load the columns of the data set needed for training and evaluation, with hysteresis-filtered positions
+    """
+    data = load_data(data_set, columns=training_columns(settings))
+    return append_hysteresis(data, settings["hysteresis percent"])
+
+def init_crossval_worker(settings, data, key, solver_workers = 1):
+    admm.N_WORKERS = solver_workers
+    cached = load_cached_matrices(key, mmap_mode="r")
+    if cached is None:
+        # evicted from the cache in the meantime
+        cached = make_data_matrices(data, settings)
+    WORKER_STATE["data"] = data
+    WORKER_STATE["matrices"] = cached
+    # load condition of each row of the data matrices
+    WORKER_STATE["rows"] = np.repeat(np.arange(len(data)), load_topology(settings).n_consumers)[row_mask(data, settings)]
+
+def fold_job(settings, fold, train, test):
+    """
+    Train on the load conditions in train, and return the per-valve errors on train and test
+    """
+    data = WORKER_STATE["data"]
+    phi, y, w = WORKER_STATE["matrices"]
+    rows = np.flatnonzero(np.isin(WORKER_STATE["rows"], train))
+    theta, s = estimate_parameters(phi[rows], y[rows], w[rows], settings)
+
+    model = {"theta": theta, "s": s, "settings": settings}
+    table = []
+    for split, index in [("train", train), ("test", test)]:
+        fold_data = data.iloc[index]
+        q_hat = predict_flow_rates(fold_data, valve_equivalent_resistances(model), s, settings["flow rate exponent"], load_topology(settings))
+        for i in range(len(theta)):
+            e = fold_data[f"q{i}"].to_numpy() - q_hat[f"qhat{i}"].to_numpy()
+            table.append({
+                "fold": fold, "split": split, "valve": i, "samples": len(index),
+                "rmse": np.sqrt(np.mean(e**2)), "mae": np.mean(np.abs(e)), "bias": np.mean(e),
+            })
+    return table
+
+def crossval(settings, data_set, scheme, k, n_jobs = 1):
+    """
+    Cross-validate the model in settings on data_set with k folds of the given scheme, solving the folds in
+    n_jobs worker processes. The data matrices of all rows are built once (through the data matrix cache) and
+    memory-mapped by the workers, which slice the rows of each fold from them.
+    Returns the per-valve errors of every fold, and their mean and standard deviation over the folds.
+    """
+    data = prepare_data(settings, data_set)
+    key = cache_key(data_set, full_data_settings(settings))
+    if load_cached_matrices(key, mmap_mode="r") is None:
+        phi, y, w = make_data_matrices(data, settings)
+        save_cached_matrices(key, data_set, full_data_settings(settings), phi, y, w)
+
+    folds = make_folds(len(data), scheme, k)
+    jobs = [(settings, fold, train, test) for fold, (train, test) in enumerate(folds)]
+    table = []
+    for (_, fold, _, _), result, output in run_jobs(fold_job, jobs, n_jobs, init_crossval_worker, (settings, data, key, admm.N_WORKERS)):
+        print(output, end="")
+        logging.info(f"Fold {fold + 1}/{k} done.")
+        table += result
+    table = pd.DataFrame(table)
+
+    summary = table.groupby(["split", "valve"])[["rmse", "mae", "bias"]].agg(["mean", "std"])
+    summary.columns = [f"{stat} {agg}" for stat, agg in summary.columns]
+    return table, summary.reset_index()
+
+def save_crossval(table, summary, model_name, data_set, scheme):
+    dirname = os.path.join(DATA_DIR, "crossval")
+    os.makedirs(dirname, exist_ok=True)
+    filename = os.path.join(dirname, f"{model_name}_{data_set}_{scheme}")
+    logging.info(f"Saving cross-validation results to {filename}.csv.")
+    table.to_csv(f"{filename}.csv", index=False)
+    summary.to_csv(f"{filename}_summary.csv", index=False)
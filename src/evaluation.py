@@ -3,41 +3,82 @@ import pandas as pd
 from utils.utils import *
 from utils.hysteresis import append_hysteresis
 from utils.parameterization import valve_equivalent_resistances
+from utils.topology import load_topology
 
-def predict_flow_rates(row, s_valves, s, gamma = 2):
+# bound on the number of nodes x samples in the arrays of one pass through the network
+PREDICTION_BLOCK_SIZE = 2**22
+
+def predict_flow_rates(data, s_valves, s, gamma = 2, topology = None):
     """
-    Predict the flow rates q0, q1, q2, q3 for one row of the data. 
-    s_valve(row): function for evaluating the equivalent resistances in the valves
+    Predict the flow rates q0, q1, ... of all consumers for all rows of the data at once.
+    s_valves(v): function for evaluating the equivalent resistances in the valves
     s: the pipe parameters
     gamma: the exponent in the flow rate model (ususally 2)
+    topology: the network, the lab network by default
     """
-    # Split the resistances into grid-level (pipes 4, 5, 6) and branches (pipes + valves going through substations)
-    s_branch = s_valves([row["vh0"], row["vh1"], row["vh2"], row["vh3"]]) + 2 * np.array(s[0:4])
-    s_grid = 2 * np.array(s[4:7])
-    
-    s_hat = find_equivalent_resistance(s_grid, s_branch, gamma)
-    q_hat = np.zeros(4)
-    q0 = (row['dp_pump'] / s_hat[0])**(1/gamma)
-    for i in range(3):
-        q_hat[i] = q0 * (s_hat[i+1])**(1/gamma) / ((s_branch[i])**(1/gamma) + (s_hat[i+1])**(1/gamma))
-        q0 -= q_hat[i]
-    q_hat[-1] = q0
-
-    # store as pd series with qhat0, qhat1,...
-    return pd.Series( {f'qhat{i}' : q_hat[i] for i in range(4)} )
-
-def find_equivalent_resistance(s_grid, s_branch, gamma):
-    """find equivalent resistance s_hat for one row of the model data""" 
-    s_hat = np.zeros(4)
-    s_hat[-1] = s_branch[-1]
-    # iterate backwards from 2 to 0
-    for i in range(2,-1,-1):
-        s_hat[i] = s_grid[i] + s_branch[i]*s_hat[i+1] / (((s_branch[i])**(1/gamma) + (s_hat[i+1])**(1/gamma))**gamma )
-
-    return s_hat
-
-def evaluate_model(model, test_data, is_training_data):
-    data = load_data(test_data)
+    if topology is None:
+        topology = load_topology({})
+    s = np.asarray(s, dtype=float)
+    positions = [data[f"vh{i}"].to_numpy() for i in range(topology.n_consumers)]
+    dp_pump = data['dp_pump'].to_numpy()
+
+    # in blocks of samples, so the node x sample arrays stay small for large networks
+    q_hat = np.zeros((topology.n_consumers, len(data)))
+    block = max(1, PREDICTION_BLOCK_SIZE // topology.n_nodes)
+    for start in range(0, len(data), block):
+        rows = slice(start, start + block)
+        q_hat[:, rows] = network_flow_rates(topology, s, s_valves([v[rows] for v in positions]), dp_pump[rows], gamma)
+
+    # store as data frame with qhat0, qhat1,...
+    return pd.DataFrame({f'qhat{i}' : q_hat[i] for i in range(topology.n_consumers)}, index=data.index)
+
+def network_flow_rates(topology, s, s_valve, dp_pump, gamma):
+    """
+    Flow rates of the consumers, of shape (n_consumers, n), for the valve resistances s_valve of shape (n_consumers, n)
+    and the n pump pressures dp_pump
+    """
+    resistance, conductance, pipe_conductance = find_equivalent_resistance(topology, s, s_valve, gamma)
+
+    # split the flow from the pump at each node in proportion to the conductances of the pipes leaving it
+    q_node = np.zeros(resistance.shape)
+    q_node[topology.root] = (dp_pump / resistance[topology.root])**(1/gamma)
+    for level in topology.levels:
+        parent = topology.parent[level]
+        q_node[topology.child[level]] = q_node[parent] * pipe_conductance[level] / conductance[parent]
+    return q_node[topology.consumer_nodes]
+
+def find_equivalent_resistance(topology, s, s_valve, gamma):
+    """
+    Find the equivalent resistance of each node of the network, i.e. of the part of the network downstream of it,
+    for all samples at once. Both the supply and return pipe of pipe e have resistance s_e, and the valves are at the
+    consumers, with resistances s_valve of shape (n_consumers, n).
+    Parallel branches add up in conductance R^(-1/gamma), so the network is reduced level by level from the consumers
+    up to the pump.
+    Returns the resistance and the total conductance of the branches leaving each node, of shape (n_nodes, n),
+    and the conductance of each pipe with everything downstream of it, of shape (n_pipes, n).
+    """
+    n = np.shape(s_valve)[1]
+    resistance = np.zeros((topology.n_nodes, n))
+    resistance[topology.consumer_nodes] = s_valve
+    conductance = np.zeros((topology.n_nodes, n))
+    pipe_conductance = np.zeros((topology.n_pipes, n))
+    # the deepest pipes first, so the nodes at their ends have been reduced
+    for level in reversed(topology.levels):
+        child = topology.child[level]
+        inner = child[~topology.is_consumer[child]]
+        resistance[inner] = conductance[inner]**(-gamma)
+        pipe_conductance[level] = (2 * s[level][:, None] + resistance[child])**(-1/gamma)
+        np.add.at(conductance, topology.parent[level], pipe_conductance[level])
+    resistance[topology.root] = conductance[topology.root]**(-gamma)
+
+    return resistance, conductance, pipe_conductance
+
+def evaluate_model(model, test_data, is_training_data, data = None):
+    """
+    Evaluate a model on test_data. The data set can be passed as data if it is already loaded, and is then modified in place.
+    """
+    if data is None:
+        data = load_data(test_data)
     
     s = model["s"]
     # function for evaluating equivalent resistance in valves
@@ -47,13 +88,12 @@ def evaluate_model(model, test_data, is_training_data):
     data = append_hysteresis(data, model["settings"]["hysteresis percent"])
 
     # predict flow rates
-    results = data.apply(lambda row : predict_flow_rates(row, s_valves, s, model["settings"]["flow rate exponent"]), axis=1)
+    topology = load_topology(model["settings"])
+    results = predict_flow_rates(data, s_valves, s, model["settings"]["flow rate exponent"], topology)
 
     # make error-columns
-    results["e0"] = data["q0"] - results["qhat0"]
-    results["e1"] = data["q1"] - results["qhat1"]
-    results["e2"] = data["q2"] - results["qhat2"]
-    results["e3"] = data["q3"] - results["qhat3"]
+    errors = {f"e{i}": data[f"q{i}"] - results[f"qhat{i}"] for i in range(topology.n_consumers)}
+    results = pd.concat([results, pd.DataFrame(errors)], axis=1)
 
     # name index as "sample"
     results.index.name = "sample"
@@ -1,5 +1,6 @@
 # script for inspecting the data matrix phi and its' properties.
 import numpy as np
+import scipy.sparse as sp
 import matplotlib.pyplot as plt
 
 from utils.utils import load_data_matrices
@@ -16,8 +17,11 @@ def run():
           Realistic: {phi_R.shape}""")
 
     # calculate condition number for phi^T phi
-    PPT_E = phi_E.T @ phi_E / n_E
-    PPT_R = phi_R.T @ phi_R / n_R
+    # (phi is stored sparse, but the small Gram matrices are inspected densely)
+    phi_E = sp.csr_matrix(phi_E)
+    phi_R = sp.csr_matrix(phi_R)
+    PPT_E = (phi_E.T @ phi_E / n_E).toarray()
+    PPT_R = (phi_R.T @ phi_R / n_R).toarray()
 
     # make inverses
     PPT_E_inv = np.linalg.inv(PPT_E)
@@ -1,17 +1,67 @@
 import json
 import argparse
 import os
+import sys
 import logging 
+import numpy as np
 
 from utils import prepare_datasets
-from training import train_model
+from training import train_model, train_model_chunked
 from evaluation import evaluate_model
-from plotting import plot_models
-from utils.utils import load_model, save_model, load_results, save_results, print_model, get_all_models, print_data_stats
+from plotting import plot_models, export_figures, SCATTER_MODES, FIGURE_DIR
+from sweep import sweep, save_sweep
+from parallel import run_jobs
+from online import replay, save_trajectory
+from crossval import crossval, save_crossval
+from bootstrap import bootstrap, save_bootstrap
+from benchmark import run_benchmark, save_benchmark
+from predictor import Predictor, stream_predictions
+from utils.utils import load_data, save_model, load_results, save_results, print_model, get_all_models, print_data_stats, DATA_SETS
 from utils.parameterization import print_curves
+from utils.topology import load_topology
+from utils import cache
+from utils.artifacts import cached_model
+import admm
+import profiling
 
 MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
 
+# data sets loaded once per training worker
+WORKER_DATA = {}
+# rows per chunk when training out of core, None to train on data in memory
+WORKER_CHUNK_SIZE = None
+
+def init_training_worker(data_sets, cache_size, chunk_size = None, profile = False, solver_workers = 1):
+    global WORKER_CHUNK_SIZE
+    cache.CACHE_SIZE_LIMIT = cache_size
+    profiling.ENABLED = profile
+    admm.N_WORKERS = solver_workers
+    WORKER_CHUNK_SIZE = chunk_size
+    if chunk_size is not None:
+        # the training data is streamed by train_model_chunked, and evaluation memory-maps the column store
+        return
+    for data_set in data_sets:
+        WORKER_DATA[data_set] = load_data(data_set)
+
+def training_job(config, training_data):
+    """
+    Train a model on one data set and evaluate it on all data sets
+    """
+    if WORKER_CHUNK_SIZE is not None:
+        model = train_model_chunked(config, training_data, WORKER_CHUNK_SIZE)
+        results = {
+            test_data: evaluate_model(model, test_data, training_data == test_data)
+            for test_data in DATA_SETS
+        }
+        return model, results
+
+    model = train_model(config, training_data, data=WORKER_DATA[training_data].copy())
+    results = {
+        test_data: evaluate_model(model, test_data, training_data == test_data, data=WORKER_DATA[test_data].copy())
+        for test_data in DATA_SETS
+    }
+    return model, results
+
 def handle_training(args):
     
     if len(args.models) == 0:
@@ -21,6 +71,7 @@ def handle_training(args):
     else:
         models = args.models
     
+    jobs = []
     for model in models:
         # read config file
         with open(os.path.join(MODEL_DIR, f"{model}.json"), 'r') as f:
@@ -28,13 +79,111 @@ def handle_training(args):
 
         config["name"] = model
 
-        for training_data in ["exciting", "realistic"]:
-            model = train_model(config, training_data)
-            print_model(model)
-            save_model(model, training_data, overwrite=args.overwrite)
-            for test_data in ["exciting", "realistic"]:
-                results = evaluate_model(model, test_data, training_data == test_data)
-                save_results(results, config["name"], training_data, test_data, overwrite=args.overwrite)
+        for training_data in DATA_SETS:
+            jobs.append((config, training_data))
+
+    # train in parallel, but print and save the results in order from this process
+    for (config, training_data), (model, results), output in run_jobs(training_job, jobs, args.jobs, init_training_worker, (DATA_SETS, cache.CACHE_SIZE_LIMIT, args.chunk_size, profiling.ENABLED, admm.N_WORKERS)):
+        print(output, end="")
+        print_model(model)
+        save_model(model, training_data, overwrite=args.overwrite)
+        if "profile" in model:
+            profiling.log_profile(model, training_data)
+        for test_data in DATA_SETS:
+            save_results(results[test_data], config["name"], training_data, test_data, overwrite=args.overwrite)
+
+def handle_sweep(args):
+    if len(args.models) == 0:
+        raise ValueError('Please provide a model name to sweep')
+
+    # the flow rate weights outermost, since the problem is set up again when they change
+    gains = {
+        "flow rate weights": args.weights,
+        "valve regularization gain": args.valve_gains,
+        "pipe regularization gain": args.pipe_gains,
+    }
+    if args.path_points is not None:
+        # expand each pair of end points into a log-spaced path, from strong to weak
+        for name, values in gains.items():
+            if values is None or name == "flow rate weights":
+                continue
+            if len(values) != 2 or min(values) <= 0:
+                raise ValueError(f'--path-points needs two positive end points for {name}, got {values}')
+            gains[name] = [float(x) for x in np.geomspace(max(values), min(values), args.path_points)]
+
+    for model in args.models:
+        with open(os.path.join(MODEL_DIR, f"{model}.json"), 'r') as f:
+            config = json.load(f)
+        config["name"] = model
+
+        # sweep only over the values given, keep the rest from the config
+        grid = {name: values if values is not None else [config[name]] for name, values in gains.items()}
+        for training_data in DATA_SETS:
+            table = sweep(config, training_data, grid)
+            save_sweep(table, model, training_data)
+
+def handle_online(args):
+    if len(args.models) == 0:
+        raise ValueError('Please provide a model name to estimate online')
+
+    for model in args.models:
+        with open(os.path.join(MODEL_DIR, f"{model}.json"), 'r') as f:
+            config = json.load(f)
+        config["name"] = model
+
+        # continue from the last checkpoint unless overwriting
+        for training_data in DATA_SETS:
+            table = replay(config, training_data, args.batch_size, args.forgetting_factor, resume=not args.overwrite)
+            save_trajectory(table, model, training_data, append=not args.overwrite)
+
+def handle_crossval(args):
+    if len(args.models) == 0:
+        raise ValueError('Please provide a model name to cross-validate')
+
+    for model in args.models:
+        with open(os.path.join(MODEL_DIR, f"{model}.json"), 'r') as f:
+            config = json.load(f)
+        config["name"] = model
+
+        for training_data in DATA_SETS:
+            table, summary = crossval(config, training_data, args.scheme, args.folds, args.jobs)
+            print(f"Model name: {model}, Data: {training_data}, {args.folds} folds ({args.scheme})")
+            print(summary.to_string(index=False))
+            save_crossval(table, summary, model, training_data, args.scheme)
+
+def handle_bootstrap(args):
+    if len(args.models) == 0:
+        raise ValueError('Please provide a model name to bootstrap')
+
+    for model in args.models:
+        with open(os.path.join(MODEL_DIR, f"{model}.json"), 'r') as f:
+            config = json.load(f)
+        config["name"] = model
+
+        for training_data in DATA_SETS:
+            parameters, kv = bootstrap(config, training_data, args.replicates, args.block_length, args.confidence, args.jobs)
+            print(f"Model name: {model}, Training data: {training_data}, {args.confidence:.0%} intervals from {args.replicates} replicates")
+            print(parameters.to_string(index=False))
+            save_bootstrap(parameters, kv, model, training_data)
+
+def handle_benchmark(args):
+    # the settings of the first model, or model C
+    model = args.models[0] if len(args.models) > 0 else "C"
+    with open(os.path.join(MODEL_DIR, f"{model}.json"), 'r') as f:
+        config = json.load(f)
+
+    report = run_benchmark(config, args.rows, args.noise, args.hysteresis)
+    for stage in report["stages"]:
+        print(f"{stage['stage']:<20}{stage['wall time']:>10.3f} s{stage['peak rss']:>10.0f} MB")
+    save_benchmark(report, args.output)
+
+def handle_predict(args):
+    if len(args.models) != 1:
+        raise ValueError('Please provide one model name to predict with')
+
+    predictor = Predictor.load(args.models[0], args.training_data)
+    n_rows = stream_predictions(predictor, sys.stdin, sys.stdout, args.batch_size)
+    logging.info(f"Predicted {n_rows} rows.")
 
 def handle_plotting(args):
     if len(args.models) == 0:
@@ -44,6 +193,21 @@ def handle_plotting(args):
     else:
         plot_models(args.models, args)
 
+def handle_export(args):
+    if len(args.models) == 0:
+        raise ValueError('Please provide a model name to export figures for')
+    elif len(args.models) == 1 and args.models[0] == "all":
+        models = get_all_models()
+    else:
+        models = args.models
+
+    # one figure per model, rendered in parallel
+    jobs = [(model, args.formats, args.figure_dir, args.scatter, args.rasterize, args.dpi) for model in models]
+    for _, filenames, output in run_jobs(export_figures, jobs, args.jobs):
+        print(output, end="")
+        for filename in filenames:
+            logging.info(f"Saved {filename}.")
+
 def handle_printing(args):
     if len(args.models) == 0 or args.models[0] == "all":
         names = get_all_models()
@@ -51,26 +215,38 @@ def handle_printing(args):
         names = args.models
 
     for name, in sorted(names):
-        for training_data in ["exciting", "realistic"]:
+        for training_data in DATA_SETS:
             print("-------------------------------------------------------")
             print(f"Model name: {name}, Training data: {training_data}")
-            model = load_model(name, training_data)
+            model = cached_model(name, training_data)
             print_model(model, print_settings=False, print_theta=False)
             print("Valve parameterizations:")
             print_curves(model)
 
 
+def handle_cache(args):
+    if args.clear:
+        cache.clear_cache()
+    else:
+        cache.evict(cache.CACHE_SIZE_LIMIT)
+    cache.print_cache()
+
 def handle_stats(args):
+    # the consumers of the network of the first model, or of the lab network
+    config = {}
+    if len(args.models) > 0:
+        with open(os.path.join(MODEL_DIR, f"{args.models[0]}.json"), 'r') as f:
+            config = json.load(f)
 
-    for data_set in ["exciting", "realistic"]:
-        print_data_stats(data_set)
+    for data_set in DATA_SETS:
+        print_data_stats(data_set, load_topology(config))
 
 
 if __name__ == "__main__":
     # parse arguments
     parser = argparse.ArgumentParser(description='Decide if you want to prepare datasets, train a model or plot results.')
 
-    parser.add_argument('mode', type=str, help='Which mode to run the script in - prepare, train, plot, print or statistics', choices=['prepare', 'train', 'plot', 'print', 'statistics'])
+    parser.add_argument('mode', type=str, help='Which mode to run the script in - prepare, train, sweep, online, crossval, bootstrap, benchmark, predict, plot, export, print, statistics or cache', choices=['prepare', 'train', 'sweep', 'online', 'crossval', 'bootstrap', 'benchmark', 'predict', 'plot', 'export', 'print', 'statistics', 'cache'])
 
     parser.add_argument('-m', '--models',nargs='+', help='Name of the model(s) to train or plot', default='')
 
@@ -78,8 +254,67 @@ if __name__ == "__main__":
 
     parser.add_argument('-o', '--overwrite', action='store_true', help='Automatically overwrite old model parameters and results when training.', default=False)
 
+    parser.add_argument('-j', '--jobs', type=int, help='Number of worker processes for training, cross-validation, bootstrap and figure export', default=1)
+
+    parser.add_argument('--valve-gains', nargs='+', type=float, help='Valve regularization gains to sweep over', default=None)
+
+    parser.add_argument('--pipe-gains', nargs='+', type=float, help='Pipe regularization gains to sweep over', default=None)
+
+    parser.add_argument('--weights', nargs='+', type=float, help='Flow rate weight exponents to sweep over', default=None)
+
+    parser.add_argument('--path-points', type=int, help='Expand the two end points given for each swept gain into this many log-spaced values', default=None)
+
+    parser.add_argument('--chunk-size', type=int, help='Train out of core, streaming the training data in chunks of this many rows', default=None)
+
+    parser.add_argument('--batch-size', type=int, help='Number of load conditions per update in online mode, or rows per micro-batch in predict mode', default=100)
+
+    parser.add_argument('--training-data', type=str, help='Training data set of the model to predict with', choices=DATA_SETS, default='realistic')
+
+    parser.add_argument('--forgetting-factor', type=float, help='Forgetting factor per load condition in online mode', default=1.0)
+
+    parser.add_argument('--scheme', type=str, help='Cross-validation scheme', choices=['kfold', 'blocked', 'rolling'], default='blocked')
+
+    parser.add_argument('--folds', type=int, help='Number of cross-validation folds', default=5)
+
+    parser.add_argument('--replicates', type=int, help='Number of bootstrap replicates', default=200)
+
+    parser.add_argument('--block-length', type=int, help='Number of consecutive load conditions per bootstrap block, 1 for the ordinary bootstrap', default=100)
+
+    parser.add_argument('--confidence', type=float, help='Confidence level of the bootstrap intervals', default=0.95)
+
+    parser.add_argument('--rows', type=int, help='Number of load conditions in the synthetic benchmark data set', default=10000)
+
+    parser.add_argument('--noise', type=float, help='Relative noise level of the synthetic benchmark data', default=0.01)
+
+    parser.add_argument('--hysteresis', type=float, help='Valve hysteresis in percent in the synthetic benchmark data', default=1.5)
+
+    parser.add_argument('--output', type=str, help='File to save the benchmark report to', default=None)
+
+    parser.add_argument('--cache-size', type=float, help='Size limit of the data matrix cache in MB', default=None)
+
+    parser.add_argument('--clear', action='store_true', help='Clear the data matrix cache (cache mode)', default=False)
+
+    parser.add_argument('--solver-workers', type=int, help='Number of worker processes of the admm solver', default=1)
+
+    parser.add_argument('--scatter', type=str, help='How error scatters with many points are drawn when plotting: all points, decimated or in hexagonal bins', choices=SCATTER_MODES, default='decimate')
+
+    parser.add_argument('--rasterize', action='store_true', help='Rasterize the error scatters in vector outputs', default=False)
+
+    parser.add_argument('--formats', nargs='+', type=str, help='File formats of the exported figures', default=['png'])
+
+    parser.add_argument('--figure-dir', type=str, help='Directory to export figures to', default=FIGURE_DIR)
+
+    parser.add_argument('--dpi', type=int, help='Resolution of the exported figures and rasterized layers', default=150)
+
+    parser.add_argument('--profile', action='store_true', help='Record the time, memory and solver statistics of each training stage with the model and in data/profiles.jsonl', default=False)
+
     args = parser.parse_args()
 
+    if args.cache_size is not None:
+        cache.CACHE_SIZE_LIMIT = int(args.cache_size * 1024**2)
+    admm.N_WORKERS = args.solver_workers
+    profiling.ENABLED = args.profile
+
     # set up logging
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
@@ -94,10 +329,38 @@ if __name__ == "__main__":
     if args.mode == 'train':
         handle_training(args)
 
+    # sweep regularization gains and flow rate weights for a model
+    if args.mode == 'sweep':
+        handle_sweep(args)
+
+    # replay the data sets through the online estimator
+    if args.mode == 'online':
+        handle_online(args)
+
+    # cross-validate models over several training/test splits
+    if args.mode == 'crossval':
+        handle_crossval(args)
+
+    # bootstrap confidence intervals for the parameters
+    if args.mode == 'bootstrap':
+        handle_bootstrap(args)
+
+    # time the stages of the pipeline on synthetic data
+    if args.mode == 'benchmark':
+        handle_benchmark(args)
+
+    # predict flow rates for rows streamed from stdin to stdout
+    if args.mode == 'predict':
+        handle_predict(args)
+
     # check if results should be plotted
     if args.mode == 'plot':
         handle_plotting(args)
 
+    # render the figures of the models to files, without a display
+    if args.mode == 'export':
+        handle_export(args)
+
     # print parameters for all models
     if args.mode == 'print':
         handle_printing(args)
@@ -105,6 +368,10 @@ if __name__ == "__main__":
     # print data set statistics, such as e.g. mean flow rates
     if args.mode == 'statistics':
         handle_stats(args)
+
+    # inspect or clear the data matrix cache
+    if args.mode == 'cache':
+        handle_cache(args)
             
 
 
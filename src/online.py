@@ -0,0 +1,186 @@
+# Online estimation of the parameters, updated with each mini-batch of load conditions from live or replayed data.
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from training import make_data_matrices, row_mask, split_parameters, train_model_chunked, training_columns
+from solvers import solve_nnls
+from utils.hysteresis import HysteresisFilter
+from utils.topology import load_topology
+from utils.utils import iter_data, save_arrays, load_arrays, DATA_DIR
+
+class OnlineEstimator:
+    """
+    Recursive least squares estimate of beta = (theta, s) with a forgetting factor, constrained to be nonnegative.
+    The state is the exponentially weighted Gram statistics of the cost (see gram_statistics): the information matrix
+    phi^T W^2 phi, the vector phi^T W^2 y, y^T W^2 y and the number of rows, where the rows of a load condition seen k
+    load conditions ago are weighted by forgetting_factor^k. After each batch, beta is the solution of solve_nnls for
+    the current state with the regularization of the model, warm-started from the previous one.
+    With forgetting_factor = 1 this is the batch solution of the model on all data seen so far. Models with cost norm 1
+    have no such recursive form, and are refused.
+    """
+    def __init__(self, settings, forgetting_factor = 1.0):
+        if settings["cost norm"] != 2 or settings["regularization norm"] not in [1, 2]:
+            raise ValueError("The online estimator requires cost norm 2 and regularization norm 1 or 2, "
+                             f"the model has cost norm {settings['cost norm']} and regularization norm "
+                             f"{settings['regularization norm']}.")
+        self.settings = settings
+        self.forgetting_factor = forgetting_factor
+        self.n_valves = load_topology(settings).n_consumers
+        self.filters = [HysteresisFilter(settings["hysteresis percent"] / 100) for _ in range(self.n_valves)]
+        self.information = None
+        self.vector = None
+        self.squares = 0.0
+        self.rows = 0.0
+        self.beta = None
+        self.samples = 0
+
+    def update(self, data):
+        """
+        Update the estimate with the load conditions (rows) in data, which must follow the ones seen so far
+        """
+        columns = {column: data[column].to_numpy() for column in training_columns(self.settings)}
+        for i in range(self.n_valves):
+            columns[f"vh{i}"] = self.filters[i].filter(columns[f"v{i}"])
+        data = pd.DataFrame(columns, copy=False)
+        phi, y, w = make_data_matrices(data, self.settings)
+
+        # weight of each row: the flow rate weight and the forgetting of its load condition
+        n_data = len(data)
+        age = np.repeat(np.arange(n_data - 1, -1, -1), self.n_valves)[row_mask(data, self.settings)]
+        forgetting = self.forgetting_factor**age
+        W = w**self.settings["flow rate weights"] * np.sqrt(forgetting)
+        # a batch is small, so dense products are faster than sparse ones
+        phi_w = phi.toarray() * W[:, None]
+
+        if self.information is None:
+            self.information = np.zeros((phi.shape[1], phi.shape[1]))
+            self.vector = np.zeros(phi.shape[1])
+            self.beta = np.zeros(phi.shape[1])
+        decay = self.forgetting_factor**n_data
+        self.information = decay * self.information + phi_w.T @ phi_w
+        self.vector = decay * self.vector + phi_w.T @ (W * y)
+        self.squares = decay * self.squares + (W * y) @ (W * y)
+        self.rows = decay * self.rows + forgetting.sum()
+        self.samples += n_data
+
+        stats = (self.information, self.vector, self.squares, self.rows)
+        self.beta, _ = solve_nnls(stats, self.settings, self.beta, verbose=False)
+        return self.beta
+
+    def parameters(self):
+        """
+        The current estimate as (theta, s)
+        """
+        return split_parameters(self.beta, self.settings)
+
+    def save(self, dirname):
+        """
+        Checkpoint the state of the estimator in dirname
+        """
+        arrays = {"information": self.information, "vector": self.vector, "beta": self.beta}
+        metadata = {
+            "settings": self.settings,
+            "forgetting factor": self.forgetting_factor,
+            "samples": self.samples,
+            "squares": self.squares,
+            "rows": self.rows,
+            "hysteresis": [f.last for f in self.filters],
+        }
+        save_arrays(dirname, arrays, metadata)
+
+    @classmethod
+    def load(cls, dirname):
+        """
+        Restore an estimator from a checkpoint written by save
+        """
+        arrays, metadata = load_arrays(dirname, ["information", "vector", "beta"], mmap_mode=None)
+        estimator = cls(metadata["settings"], metadata["forgetting factor"])
+        estimator.information = arrays["information"]
+        estimator.vector = arrays["vector"]
+        estimator.beta = arrays["beta"]
+        estimator.samples = metadata["samples"]
+        estimator.squares = metadata["squares"]
+        estimator.rows = metadata["rows"]
+        for f, last in zip(estimator.filters, metadata["hysteresis"]):
+            f.last = last
+        return estimator
+
+def checkpoint_changes(estimator, settings, forgetting_factor):
+    """
+    The settings (and the forgetting factor) which differ between a restored estimator and the current ones,
+    as {name: (checkpoint value, current value)}. The description does not matter.
+    """
+    names = (set(estimator.settings) | set(settings)) - {"description"}
+    changed = {name: (estimator.settings.get(name), settings.get(name)) for name in sorted(names)
+               if estimator.settings.get(name) != settings.get(name)}
+    if estimator.forgetting_factor != forgetting_factor:
+        changed["forgetting factor"] = (estimator.forgetting_factor, forgetting_factor)
+    return changed
+
+def online_dirname(model_name, data_set):
+    return os.path.join(DATA_DIR, "online", f"{model_name}_{data_set}")
+
+def replay(settings, data_set, batch_size, forgetting_factor = 1.0, resume = True, checkpoint_interval = 100000):
+    """
+    Replay data_set through an online estimator in batches of batch_size load conditions,
+    checkpointing every checkpoint_interval load conditions and at the end.
+    With resume, the estimator continues from the checkpoint of an earlier replay if there is one, which must have been
+    made with the same settings and forgetting factor.
+    Returns the trajectory of the estimate, with one row per batch and the relative distance to the batch solution
+    of the model on all of the data.
+    """
+    dirname = online_dirname(settings["name"], data_set)
+    if resume and os.path.exists(os.path.join(dirname, "meta.json")):
+        estimator = OnlineEstimator.load(dirname)
+        changed = checkpoint_changes(estimator, settings, forgetting_factor)
+        if len(changed) > 0:
+            raise ValueError(f"The checkpoint in {dirname} was made with other settings, {changed} changed. "
+                             "Start over without resuming (-o) to use the new settings.")
+        logging.info(f"Resuming from checkpoint after {estimator.samples} samples.")
+    else:
+        estimator = OnlineEstimator(settings, forgetting_factor)
+
+    # the batch solution to compare against
+    batch_settings = dict(settings, **{"training data percent": 100, "solver": "nnls"})
+    reference = train_model_chunked(batch_settings, data_set, 100000)
+    beta_ref = np.concatenate([np.ravel(reference["theta"]), reference["s"]])
+
+    rows = []
+    first_sample = estimator.samples
+    last_checkpoint = estimator.samples
+    start = time.perf_counter()
+    for batch in iter_data(data_set, batch_size, training_columns(settings)):
+        if batch.index[-1] < estimator.samples:
+            continue
+        estimator.update(batch.loc[estimator.samples:])
+
+        theta, s = estimator.parameters()
+        beta = np.concatenate([np.ravel(theta), s])
+        row = {"samples": estimator.samples, "distance": np.linalg.norm(beta - beta_ref) / np.linalg.norm(beta_ref)}
+        row.update({f"s{j}": s[j] for j in range(len(s))})
+        rows.append(row)
+        if estimator.samples - last_checkpoint >= checkpoint_interval:
+            estimator.save(dirname)
+            last_checkpoint = estimator.samples
+    estimator.save(dirname)
+    elapsed = time.perf_counter() - start
+
+    if len(rows) > 0:
+        logging.info(f"Replayed {estimator.samples - first_sample} samples of {data_set} at "
+                     f"{(estimator.samples - first_sample) / elapsed:.0f} samples/s, "
+                     f"final relative distance to the batch solution {rows[-1]['distance']:.3e}.")
+    return pd.DataFrame(rows)
+
+def save_trajectory(table, model_name, data_set, append = False):
+    """
+    Save the trajectory of a replay, or append it to the one of an earlier replay which was resumed
+    """
+    filename = online_dirname(model_name, data_set) + "_trajectory.csv"
+    logging.info(f"Saving trajectory to {filename}.")
+    if append and os.path.exists(filename):
+        table.to_csv(filename, mode="a", header=False, index=False)
+    else:
+        table.to_csv(filename, index=False)
@@ -0,0 +1,56 @@
+# Running independent jobs in a pool of worker processes
+import contextlib
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+@contextlib.contextmanager
+def capture_output():
+    """
+    Capture everything written to stdout and stderr in the block, including log records and
+    output from compiled solvers writing directly to the file descriptors.
+    Yields a list which holds the captured text once the block has exited.
+    """
+    captured = []
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with tempfile.TemporaryFile() as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+        try:
+            yield captured
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, saved_fd in zip([1, 2], saved):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+            f.seek(0)
+            captured.append(f.read().decode(errors="replace"))
+
+def _captured_job(func, args):
+    with capture_output() as output:
+        result = func(*args)
+    return result, output[0]
+
+def run_jobs(func, jobs, n_jobs = 1, initializer = None, initargs = ()):
+    """
+    Run func(*job) for each job (a tuple of arguments) and yield (job, result, output) in the order of jobs.
+    With n_jobs > 1 the jobs run in a pool of n_jobs worker processes, each set up once with initializer(*initargs),
+    and the output of each job is captured and returned as one block so that jobs do not interleave.
+    With n_jobs = 1 the jobs run one after another in this process, printing their output directly.
+    """
+    if n_jobs == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for job in jobs:
+            yield job, func(*job), ""
+        return
+
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=initializer, initargs=initargs) as executor:
+        futures = [executor.submit(_captured_job, func, job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            result, output = future.result()
+            yield job, result, output
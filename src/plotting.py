@@ -1,7 +1,22 @@
+import os
+import itertools
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from utils.parameterization import valve_curve
-from utils.utils import load_model, load_data, load_results
+from utils.artifacts import cached_model, cached_data, cached_results
+from utils.topology import load_topology
+from utils.utils import DATA_DIR, DATA_SETS
+
+# error scatters with more points than this are decimated or binned, so rendering time does not grow with the data
+SCATTER_MAX_POINTS = 20000
+# how large error scatters are drawn: all points, an evenly spaced subset of SCATTER_MAX_POINTS, or hexagonal bins
+SCATTER_MODES = ["full", "decimate", "hexbin"]
+# hexagons across the valve positions of a binned error scatter
+HEXBIN_GRIDSIZE = 50
+# size in inches of each plot of the exported figures, and where they are saved
+EXPORT_AXES_SIZE = (4, 3.6)
+FIGURE_DIR = os.path.join(DATA_DIR, "figures")
 
 def plot_hysteresis(results, data):
     # add a column "sign" which is 1 if v[i] is increasing and -1 if v[i] is decreasing
@@ -27,8 +42,8 @@ def plot_hysteresis(results, data):
     #plt.show()
 
 def plot_valve_curve(ax, valve, model_name):
-    for training_set in ["exciting", "realistic"]:
-        model = load_model(model_name, training_set)
+    for training_set in DATA_SETS:
+        model = cached_model(model_name, training_set)
         kv = valve_curve(model)
         ax.plot(kv["v"], kv[f"kv{valve}"], label=training_set)
         ax.set_xlabel(f"v{valve+1}")
@@ -38,19 +53,37 @@ def plot_valve_curve(ax, valve, model_name):
         ax.set_xlim(0, 1)
         ax.set_ylim(0, 4.5)
 
-def scatter_errors(ax, valve, model_name, training_set, test_set):
-    data = load_data(test_set)
-    results = load_results(model_name, training_set, test_set)
+def error_layer(ax, v, e, label, alpha, cmap, scatter = "decimate", rasterized = False):
+    """
+    Draw the errors e over the valve positions v. Beyond SCATTER_MAX_POINTS points, scatter="decimate" draws an evenly
+    spaced subset of them, and scatter="hexbin" their density in hexagonal bins (log scale, in the colormap cmap).
+    rasterized: rasterize the layer in vector outputs
+    """
+    v, e = np.asarray(v), np.asarray(e)
+    if scatter not in SCATTER_MODES:
+        raise ValueError(f"Invalid scatter mode {scatter}, choose from {SCATTER_MODES}.")
+    if scatter == "full" or len(v) <= SCATTER_MAX_POINTS:
+        ax.scatter(v, e, label=label, alpha=alpha, rasterized=rasterized)
+    elif scatter == "decimate":
+        keep = np.linspace(0, len(v) - 1, SCATTER_MAX_POINTS).astype(int)
+        ax.scatter(v[keep], e[keep], label=label, alpha=alpha, rasterized=rasterized)
+    else:
+        ax.hexbin(v, e, gridsize=HEXBIN_GRIDSIZE, extent=(0, 1, -1.5, 1.5), mincnt=1, bins="log", cmap=cmap,
+                  label=label, rasterized=rasterized)
+
+def scatter_errors(ax, valve, model_name, training_set, test_set, scatter = "decimate", rasterized = False):
+    data = cached_data(test_set, columns=[f"v{valve}"])
+    results = cached_results(model_name, training_set, test_set)
     
     if training_set == test_set:
-        train_percent = load_model(model_name, training_set)["settings"]["training data percent"]
+        train_percent = cached_model(model_name, training_set)["settings"]["training data percent"]
         train_samples = int(train_percent/100 * len(data))
         # plot first #train percent of training data
-        ax.scatter(data[f"v{valve}"][:train_samples], results[f"e{valve}"][:train_samples], label="train", alpha=0.1)
+        error_layer(ax, data[f"v{valve}"][:train_samples], results[f"e{valve}"][:train_samples], "train", 0.1, "Blues", scatter, rasterized)
         # plot the rest of the data
-        ax.scatter(data[f"v{valve}"][train_samples:], results[f"e{valve}"][train_samples:], label="test", alpha=0.1)
+        error_layer(ax, data[f"v{valve}"][train_samples:], results[f"e{valve}"][train_samples:], "test", 0.1, "Oranges", scatter, rasterized)
     else:
-        ax.scatter(data[f"v{valve}"], results[f"e{valve}"], label="test", alpha=0.5)
+        error_layer(ax, data[f"v{valve}"], results[f"e{valve}"], "test", 0.5, "Blues", scatter, rasterized)
 
     ax.set_xlabel(f"v{valve}")
     ax.set_ylabel(f"e{valve}")
@@ -61,9 +94,10 @@ def scatter_errors(ax, valve, model_name, training_set, test_set):
     ax.set_ylim(-1.5, 1.5)
 
 
-def plot_all(model_name):
-    # make 5 x 4 plots
-    fig, axs = plt.subplots(5, 4)
+def plot_all(model_name, scatter = "decimate", rasterized = False):
+    # make 5 x n_consumers plots, one column per valve of the network of the model
+    n_valves = load_topology(cached_model(model_name, "exciting")["settings"]).n_consumers
+    fig, axs = plt.subplots(5, n_valves, squeeze=False)
     # set the title
     fig.suptitle(f"Results for model {model_name}")
 
@@ -75,7 +109,7 @@ def plot_all(model_name):
         'Real. - Real.', 
         'Valve curves'
         ]
-    col_labels = [f"Valve {i}" for i in range(1,5)]
+    col_labels = [f"Valve {i}" for i in range(1, n_valves + 1)]
 
     # Labeling the rows
     for ax, row in zip(axs[:,0], row_labels):
@@ -90,10 +124,10 @@ def plot_all(model_name):
                     size='large', ha='center', va='baseline')
 
     # plot scatter plots of errors over valve settings for all training and test data sets
-    for valve in range(4):
-        for i, (training_set, test_set) in enumerate([("exciting", "exciting"), ("exciting", "realistic"), ("realistic", "exciting"), ("realistic", "realistic")]):
+    for valve in range(n_valves):
+        for i, (training_set, test_set) in enumerate(itertools.product(DATA_SETS, DATA_SETS)):
             ax = axs[i, valve]
-            scatter_errors(ax, valve, model_name, training_set, test_set)
+            scatter_errors(ax, valve, model_name, training_set, test_set, scatter, rasterized)
 
         # plot valve curves
         plot_valve_curve(axs[4, valve], valve, model_name)
@@ -102,5 +136,21 @@ def plot_all(model_name):
 
 def plot_models(models, args):
     for model in models:
-        plot_all(model)
+        plot_all(model, args.scatter, args.rasterize)
     plt.show()
+
+def export_figures(model_name, formats = ("png",), dirname = FIGURE_DIR, scatter = "decimate", rasterized = False, dpi = 150):
+    """
+    Render the figure of plot_all for a model without a display, and save it as dirname/<model_name>.<format> for each
+    format, e.g. png or pdf. Returns the file names.
+    """
+    plt.switch_backend("Agg")
+    fig, axs = plot_all(model_name, scatter, rasterized)
+    fig.set_size_inches(EXPORT_AXES_SIZE[0] * axs.shape[1], EXPORT_AXES_SIZE[1] * axs.shape[0])
+    os.makedirs(dirname, exist_ok=True)
+    filenames = []
+    for file_format in formats:
+        filenames.append(os.path.join(dirname, f"{model_name}.{file_format}"))
+        fig.savefig(filenames[-1], dpi=dpi, bbox_inches="tight")
+    plt.close(fig)
+    return filenames
@@ -0,0 +1,109 @@
+# Flow rate prediction from a trained model for live data, arriving batch by batch instead of as a prepared data set.
+import numpy as np
+
+from evaluation import network_flow_rates, PREDICTION_BLOCK_SIZE
+from utils.hysteresis import HysteresisFilter
+from utils.parameterization import load_parameterization, valve_table
+from utils.topology import load_topology
+from utils.utils import load_model
+
+class Predictor:
+    """
+    Predicts the flow rates of the consumers of a trained model from the valve positions and the pump pressure.
+    Everything which does not depend on the data is set up once: the valve resistance curves as a ValveTable, or for
+    parameterizations which are not tabulated, theta as one (n_consumers x K) array, so the valve basis is evaluated
+    for the positions of all valves in one call, the pipe parameters and the network.
+    The hysteresis filter state is carried between calls to predict, so predicting a series batch by batch gives the
+    same flow rates as predicting it all at once, and as evaluate_model on the same data.
+    """
+    def __init__(self, model):
+        settings = model["settings"]
+        self.topology = load_topology(settings)
+        self.theta = np.array(model["theta"], dtype=float)
+        self.s = np.asarray(model["s"], dtype=float)
+        self.gamma = settings["flow rate exponent"]
+        self.valve_features = load_parameterization(settings)
+        self.table = valve_table(model)
+        self.delta = settings["hysteresis percent"] / 100
+        self.reset()
+
+    @classmethod
+    def load(cls, name, training_data):
+        return cls(load_model(name, training_data))
+
+    def reset(self):
+        """
+        Forget the hysteresis filter state, so the filters start at the next valve positions
+        """
+        self.filters = [HysteresisFilter(self.delta) for _ in range(self.topology.n_consumers)]
+
+    def valve_resistances(self, vh):
+        """
+        Equivalent resistances of the valves, of shape (n_consumers, n), for filtered positions vh of shape (n, n_consumers)
+        """
+        if self.table is not None:
+            return self.table(vh.T)
+        n = len(vh)
+        features = self.valve_features(vh.T.reshape(-1)).reshape(self.topology.n_consumers, n, -1)
+        return np.matmul(features, self.theta[:, :, None])[:, :, 0]
+
+    def predict(self, v, dp_pump):
+        """
+        Predict the flow rates q_hat of shape (n, n_consumers) for n samples of the valve positions v, of shape
+        (n, n_consumers), and the pump pressure dp_pump, of shape (n,). A single sample can be given as v of shape
+        (n_consumers,) and a scalar dp_pump.
+        """
+        v = np.atleast_2d(np.asarray(v, dtype=float))
+        dp_pump = np.atleast_1d(np.asarray(dp_pump, dtype=float))
+        n, n_consumers = len(dp_pump), self.topology.n_consumers
+        if v.shape != (n, n_consumers):
+            raise ValueError(f"Expected valve positions of shape ({n}, {n_consumers}), got {v.shape}.")
+
+        vh = np.column_stack([self.filters[i].filter(v[:, i]) for i in range(n_consumers)])
+        q_hat = np.zeros((n_consumers, n))
+        block = max(1, PREDICTION_BLOCK_SIZE // (self.topology.n_nodes * self.theta.shape[1]))
+        for start in range(0, n, block):
+            rows = slice(start, start + block)
+            q_hat[:, rows] = network_flow_rates(self.topology, self.s, self.valve_resistances(vh[rows]), dp_pump[rows], self.gamma)
+        return q_hat.T
+
+def stream_predictions(predictor, source, sink, batch_size):
+    """
+    Read CSV rows with (at least) the columns dp_pump and v0, v1, ... from source, and write them to sink with the
+    predicted flow rates qhat0, qhat1, ... appended. The rows are predicted in micro-batches of batch_size rows, each
+    written and flushed as soon as its rows have been read, so that it can follow live data.
+    Returns the number of rows predicted.
+    """
+    n_consumers = predictor.topology.n_consumers
+    header = source.readline().strip().split(",")
+    missing = [c for c in ["dp_pump"] + [f"v{i}" for i in range(n_consumers)] if c not in header]
+    if len(missing) > 0:
+        raise ValueError(f"Missing columns {missing} in the input.")
+    dp_column = header.index("dp_pump")
+    v_columns = [header.index(f"v{i}") for i in range(n_consumers)]
+    sink.write(",".join(header + [f"qhat{i}" for i in range(n_consumers)]) + "\n")
+    sink.flush()
+
+    def write_batch(lines):
+        fields = [line.split(",") for line in lines]
+        v = np.array([[row[j] for j in v_columns] for row in fields], dtype=float)
+        dp_pump = np.array([row[dp_column] for row in fields], dtype=float)
+        q_hat = predictor.predict(v, dp_pump)
+        sink.write("".join(line + "," + ",".join(map(repr, q)) + "\n" for line, q in zip(lines, q_hat.tolist())))
+        sink.flush()
+
+    lines = []
+    n_rows = 0
+    for line in source:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        lines.append(line)
+        if len(lines) == batch_size:
+            write_batch(lines)
+            n_rows += len(lines)
+            lines = []
+    if len(lines) > 0:
+        write_batch(lines)
+        n_rows += len(lines)
+    return n_rows
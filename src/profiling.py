@@ -0,0 +1,105 @@
+# Stage-level profiling of training runs: wall and CPU time, peak memory, data matrix size and solver telemetry
+# per stage, stored with the model and appended to a JSON-lines log. Off unless main.py is run with --profile.
+import contextlib
+import json
+import logging
+import os
+import resource
+import time
+
+from utils.utils import DATA_DIR
+
+# set by main.py with --profile, and passed on to the training workers
+ENABLED = False
+# append-only log of the profiles of all models trained with profiling on, one JSON object per line
+PROFILE_LOG = os.path.join(DATA_DIR, "profiles.jsonl")
+
+# the stages recorded for the run being profiled, None when no run is profiled
+_stages = None
+# returned by stage() when profiling is off, so an unprofiled stage costs one function call
+_NO_STAGE = contextlib.nullcontext()
+
+def reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets the peak resident set size of the process
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss():
+    """
+    Peak resident set size in MB since the last reset_peak_rss, or of the whole process if it cannot be reset
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def start():
+    """
+    Start profiling a run, if profiling is on
+    """
+    global _stages
+    _stages = [] if ENABLED else None
+
+def stop():
+    """
+    Stop profiling the run, and return its stages, or None if profiling is off
+    """
+    global _stages
+    stages, _stages = _stages, None
+    return stages
+
+@contextlib.contextmanager
+def _profiled_stage(name):
+    entry = {"stage": name}
+    _stages.append(entry)
+    reset_peak_rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        entry["wall time"] = time.perf_counter() - wall
+        # CPU time of this process only, not of solver worker processes
+        entry["cpu time"] = time.process_time() - cpu
+        entry["peak rss"] = peak_rss()
+
+def stage(name):
+    """
+    Context manager timing one stage of the run being profiled. Stages are not nested.
+    """
+    if _stages is None:
+        return _NO_STAGE
+    return _profiled_stage(name)
+
+def record(**fields):
+    """
+    Add fields, such as matrix sizes or solver statistics, to the current stage of the run being profiled
+    """
+    if _stages:
+        _stages[-1].update(fields)
+
+def record_matrix(phi):
+    if _stages:
+        _stages[-1].update({"rows": int(phi.shape[0]), "columns": int(phi.shape[1]), "nnz": int(phi.nnz)})
+
+def log_profile(model, data_set, filename = PROFILE_LOG):
+    """
+    Log the stages of a profiled model, and append its profile to the JSON-lines log
+    """
+    for entry in model["profile"]:
+        logging.info(f"{entry['stage']}: {entry['wall time']:.3f} s wall, {entry['cpu time']:.3f} s CPU, "
+                     f"peak RSS {entry['peak rss']:.0f} MB")
+    line = json.dumps({
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "model": model["settings"]["name"],
+        "data set": data_set,
+        "stages": model["profile"],
+    }, default=float)
+    with open(filename, "a") as f:
+        f.write(line + "\n")
@@ -0,0 +1,236 @@
+# Solver backends for the parameter estimation problem which bypass cvxpy,
+# for special cases where the problem has a structure that a dedicated method can exploit.
+import logging
+import numpy as np
+import scipy.sparse as sp
+import highspy
+from scipy.linalg import cho_factor, cho_solve
+
+from utils.topology import load_topology
+import profiling
+
+def regularization_gains(n_var, settings):
+    """
+    Vector of regularization gains per parameter, valve gain for theta and pipe gain for the pipes (s), which come last
+    """
+    gains = np.full(n_var, float(settings["valve regularization gain"]))
+    gains[-load_topology(settings).n_pipes:] = settings["pipe regularization gain"]
+    return gains
+
+class LinearProgram:
+    """
+    The problem with L1 cost and L1 regularization (cost norm = regularization norm = 1) as a sparse LP in HiGHS.
+    Since beta >= 0, the L1 regularization is linear, and the problem is the LP
+        min  sum_j a_j |phi_j beta - y_j| + g^T beta,  beta >= 0
+    with a_j = |W_j| / N and g the regularization gains. Its dual
+        max  y^T lambda  s.t.  phi^T lambda <= g,  -a <= lambda <= a
+    has one constraint per parameter instead of one per data row, and is solved with the dual simplex method.
+    beta is recovered from the multipliers of the constraints phi^T lambda <= g.
+    The gains and flow rate weights only enter the bounds of the dual, so the LP is set up once for phi and y, and
+    each solve for new gains or weights is warm-started from the basis of the previous one.
+    """
+    def __init__(self, phi, y):
+        phi = sp.csr_matrix(phi)
+        self.n_data, self.n_var = phi.shape
+        lp = highspy.HighsLp()
+        lp.num_col_ = self.n_data
+        lp.num_row_ = self.n_var
+        lp.col_cost_ = -np.asarray(y, dtype=float)
+        lp.col_lower_ = np.zeros(self.n_data)
+        lp.col_upper_ = np.zeros(self.n_data)
+        lp.row_lower_ = np.full(self.n_var, -highspy.kHighsInf)
+        lp.row_upper_ = np.zeros(self.n_var)
+        # the columns of phi^T are the rows of phi
+        lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+        lp.a_matrix_.start_ = phi.indptr
+        lp.a_matrix_.index_ = phi.indices
+        lp.a_matrix_.value_ = phi.data
+        self.highs = highspy.Highs()
+        self.highs.setOptionValue("output_flag", False)
+        self.highs.setOptionValue("simplex_strategy", 1) # dual simplex
+        self.highs.passModel(lp)
+
+    def solve(self, w, settings):
+        """
+        Solve for the gains and flow rate weights in settings. Returns beta.
+        """
+        if settings["cost norm"] != 1 or settings["regularization norm"] != 1:
+            raise ValueError("The highs solver requires cost norm 1 and regularization norm 1.")
+
+        # optional flow rate weights
+        a = np.abs(w**settings["flow rate weights"]) / self.n_data
+        self.highs.changeColsBounds(self.n_data, np.arange(self.n_data, dtype=np.int32), -a, a)
+        self.highs.changeRowsBounds(self.n_var, np.arange(self.n_var, dtype=np.int32),
+                                    np.full(self.n_var, -highspy.kHighsInf), regularization_gains(self.n_var, settings))
+        self.highs.run()
+
+        status = self.highs.getModelStatus()
+        if status != highspy.HighsModelStatus.kOptimal:
+            raise RuntimeError(f"HiGHS failed: {self.highs.modelStatusToString(status)}")
+        info = self.highs.getInfo()
+        logging.info(f"HiGHS: {info.simplex_iteration_count} simplex iterations. "
+                     f"Optimal value: {-info.objective_function_value:.6e}")
+        profiling.record(solver="highs", status=self.highs.modelStatusToString(status),
+                         iterations=int(info.simplex_iteration_count), objective=-info.objective_function_value)
+        return np.maximum(-np.asarray(self.highs.getSolution().row_dual), 0)
+
+def solve_highs(phi, y, w, settings):
+    """
+    Solve the problem with L1 cost and L1 regularization as the sparse LP in LinearProgram. Returns beta.
+    """
+    return LinearProgram(phi, y).solve(w, settings)
+
+def gram_statistics(phi, y, w, settings):
+    """
+    Sufficient statistics of the weighted least squares cost: (phi^T W^2 phi, phi^T W^2 y, y^T W^2 y, N).
+    The L2 cost only depends on the data through these, so they can be computed once and reused.
+    """
+    # optional flow rate weights
+    W = w**settings["flow rate weights"]
+    phi_w = sp.csr_matrix(phi).multiply(W[:, None]).tocsr()
+    y_w = W * y
+    return (phi_w.T @ phi_w).toarray(), phi_w.T @ y_w, y_w @ y_w, phi.shape[0]
+
+def _solve_positive_definite(H, d):
+    try:
+        return cho_solve(cho_factor(H), d)
+    except np.linalg.LinAlgError:
+        # (nearly) collinear features in the passive set
+        return np.linalg.lstsq(H, d, rcond=None)[0]
+
+def nnls_gram(H, d, passive=None, tol=1e-10, max_iter=None):
+    """
+    Active-set (Lawson-Hanson) solution of  min 1/2 x^T H x - d^T x,  x >= 0,  working on the Gram matrix H only.
+    The problem is solved with the columns scaled to unit diagonal, since the valve features span many orders of magnitude.
+    passive: boolean mask of the variables expected to be positive, to warm-start from an earlier solution.
+    Returns x and the number of iterations.
+    """
+    n = len(d)
+    scale = np.sqrt(np.diag(H))
+    scale[scale == 0] = 1
+    H = H / scale[:, None] / scale[None, :]
+    d = d / scale
+    tol = tol * max(1, np.abs(d).max())
+    max_iter = 3 * n if max_iter is None else max_iter
+
+    def solve_passive(P):
+        z = np.zeros(n)
+        idx = np.flatnonzero(P)
+        if len(idx) > 0:
+            z[idx] = _solve_positive_definite(H[np.ix_(idx, idx)], d[idx])
+        return z
+
+    def make_feasible(x, P):
+        # move from x towards the solution on the passive set P, dropping variables which hit zero on the way
+        while True:
+            z = solve_passive(P)
+            if np.all(z[P] > 0):
+                return z, P
+            mask = P & (z <= 0)
+            alpha = np.min(x[mask] / (x[mask] - z[mask]))
+            x = x + alpha * (z - x)
+            P = P & (x > 0)
+            P[mask & (x <= tol)] = False
+            x[~P] = 0
+
+    x = np.zeros(n)
+    P = np.zeros(n, dtype=bool) if passive is None else passive.copy()
+    if P.any():
+        x, P = make_feasible(x, P)
+
+    iterations = 0
+    gradient = d - H @ x
+    while iterations < max_iter and (~P).any() and gradient[~P].max() > tol:
+        j = np.flatnonzero(~P)[np.argmax(gradient[~P])]
+        P[j] = True
+        x, P = make_feasible(x, P)
+        gradient = d - H @ x
+        iterations += 1
+
+    return x / scale, iterations
+
+def l2_objective(beta, stats, settings):
+    """
+    The objective 1/N ||W (phi beta - y)||_2 + regularization, evaluated from the Gram statistics
+    """
+    G, c, yy, n_data = stats
+    n_pipes = load_topology(settings).n_pipes
+    residual = np.sqrt(max(beta @ G @ beta - 2 * c @ beta + yy, 0))
+    return residual / n_data + settings["valve regularization gain"] * np.linalg.norm(beta[:-n_pipes], settings["regularization norm"]) \
+        + settings["pipe regularization gain"] * np.linalg.norm(beta[-n_pipes:], settings["regularization norm"])
+
+def l2_kkt_residual(beta, stats, settings):
+    """
+    Largest violation of the optimality conditions, |min(beta_j, gradient_j)| over all parameters
+    """
+    G, c, yy, n_data = stats
+    residual = np.sqrt(max(beta @ G @ beta - 2 * c @ beta + yy, 1e-300))
+    gradient = (G @ beta - c) / (n_data * residual)
+    gains = regularization_gains(len(beta), settings)
+    if settings["regularization norm"] == 1:
+        gradient += gains
+    else:
+        n_pipes = load_topology(settings).n_pipes
+        for block in [slice(0, -n_pipes), slice(-n_pipes, None)]:
+            norm = np.linalg.norm(beta[block])
+            if norm > 0:
+                gradient[block] += gains[block] * beta[block] / norm
+    return np.abs(np.minimum(beta, gradient)).max()
+
+def solve_nnls(stats, settings, beta0=None, tol=1e-10, max_outer=200, verbose=True):
+    """
+    Solve the problem with L2 cost (cost norm = 2) and L1 or L2 regularization from the Gram statistics, so the cost
+    of a solve does not depend on the number of data rows.
+    The cost 1/N ||W (phi beta - y)||_2 is not squared, but at an optimum beta* the problem has the same optimality
+    conditions as the nonnegative least squares problem
+        min 1/2 beta^T G beta - (c - N r* g)^T beta  (+ 1/2 N r* sum_b g_b / ||beta*_b|| ||beta_b||^2 for L2 regularization)
+    with r* = ||W (phi beta* - y)||_2. This is solved with nnls_gram for the current r and block norms,
+    which are then updated, until beta converges.
+    beta0: an earlier solution, e.g. for similar data, to warm-start the active set from.
+    verbose: log the iterations and the optimal value.
+    Returns beta and a dict with the number of outer and active-set iterations and the KKT residual.
+    """
+    if settings["cost norm"] != 2 or settings["regularization norm"] not in [1, 2]:
+        raise ValueError("The nnls solver requires cost norm 2 and regularization norm 1 or 2.")
+
+    G, c, yy, n_data = stats
+    n_var = len(c)
+    gains = regularization_gains(n_var, settings)
+    n_pipes = load_topology(settings).n_pipes
+    blocks = [slice(0, n_var - n_pipes), slice(n_var - n_pipes, n_var)]
+
+    # start from the unregularized solution, warm-started from beta0 if given
+    passive = None if beta0 is None else np.asarray(beta0) > 0
+    beta, iterations = nnls_gram(G, c, passive=passive, tol=tol)
+
+    outer = 0
+    if np.any(gains > 0):
+        for outer in range(1, max_outer + 1):
+            residual = np.sqrt(max(beta @ G @ beta - 2 * c @ beta + yy, 1e-300))
+            H = G.copy()
+            d = c.copy()
+            if settings["regularization norm"] == 1:
+                d -= n_data * residual * gains
+            else:
+                for block in blocks:
+                    norm = np.linalg.norm(beta[block])
+                    # a block which has reached zero stays there
+                    ridge = n_data * residual * gains[block] / norm if norm > 0 else np.where(gains[block] > 0, np.inf, 0)
+                    H[block, block] += np.diag(np.minimum(ridge, 1e300))
+            beta_new, n_iter = nnls_gram(H, d, passive=beta > 0, tol=tol)
+            iterations += n_iter
+            converged = np.linalg.norm(beta_new - beta) <= 1e-9 * max(np.linalg.norm(beta_new), 1e-12)
+            beta = beta_new
+            if converged:
+                break
+
+    info = {
+        "outer iterations": outer,
+        "active set iterations": iterations,
+        "kkt residual": l2_kkt_residual(beta, stats, settings),
+        "objective": l2_objective(beta, stats, settings),
+    }
+    if verbose:
+        logging.info(f"nnls: {info['outer iterations']} outer / {info['active set iterations']} active set iterations, "
+                     f"KKT residual {info['kkt residual']:.3e}. Optimal value: {info['objective']:.6e}")
+    return beta, info
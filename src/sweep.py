@@ -0,0 +1,79 @@
+# Hyperparameter sweeps over the regularization gains and flow rate weights of a model,
+# re-solving one problem set up once for every point in the grid.
+import itertools
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from training import make_data_matrices, objective_value, split_parameters, training_split, PathSolver
+from evaluation import predict_flow_rates
+from utils.hysteresis import append_hysteresis
+from utils.parameterization import valve_equivalent_resistances
+from utils.topology import load_topology
+from utils.utils import load_data, DATA_DIR
+
+SWEEP_PARAMETERS = ["valve regularization gain", "pipe regularization gain", "flow rate weights"]
+
+def sweep(settings, data_set, grid):
+    """
+    Train the model in settings on data_set for every point in the product of the values in grid,
+    a dict mapping a setting in SWEEP_PARAMETERS to a list of values.
+    Phi is built once, and the points are solved with a PathSolver, which sets the problem up once (per flow rate
+    weight, except for the highs solver) and warm-starts every solve from the previous point, so order the values
+    along the path (e.g. from strong to weak regularization).
+    Returns a table with one row per grid point.
+    """
+    for name in grid:
+        if name not in SWEEP_PARAMETERS:
+            raise ValueError(f"Cannot sweep over {name}, choose from {SWEEP_PARAMETERS}.")
+
+    data = load_data(data_set)
+    data = append_hysteresis(data, settings["hysteresis percent"])
+    n_train = len(training_split(data, settings))
+    phi, y, w = make_data_matrices(data.iloc[:n_train], settings)
+
+    q = np.column_stack([data[f"q{i}"].to_numpy() for i in range(load_topology(settings).n_consumers)])
+
+    rows = []
+    solver = PathSolver(phi, y, w)
+    for values in itertools.product(*grid.values()):
+        point = dict(settings, **dict(zip(grid.keys(), values)))
+
+        start = time.perf_counter()
+        beta, status = solver.solve(point)
+        solve_time = time.perf_counter() - start
+        logging.info(f"Sweep point {dict(zip(grid.keys(), values))}: {status} in {solve_time:.3f} s.")
+
+        theta, s = split_parameters(beta, point)
+        model = {"theta": theta, "s": s, "settings": point}
+        q_hat = predict_flow_rates(data, valve_equivalent_resistances(model), s, point["flow rate exponent"], load_topology(point)).to_numpy()
+        e = q - q_hat
+
+        row = {name: point[name] for name in SWEEP_PARAMETERS}
+        row["status"] = status
+        row["objective"] = objective_value(phi, y, w, beta, point)
+        row["solve time"] = solve_time
+        row["valve nonzeros"] = int(np.count_nonzero(theta))
+        row["pipe nonzeros"] = int(np.count_nonzero(s))
+        for i in range(len(theta)):
+            row[f"train rmse{i}"] = np.sqrt(np.mean(e[:n_train, i]**2))
+            row[f"test rmse{i}"] = np.sqrt(np.mean(e[n_train:, i]**2))
+        row["train rmse"] = np.sqrt(np.mean(e[:n_train]**2))
+        row["test rmse"] = np.sqrt(np.mean(e[n_train:]**2))
+        for i in range(len(theta)):
+            for k, t in enumerate(theta[i]):
+                row[f"theta{i}_{k}"] = t
+        for j in range(len(s)):
+            row[f"s{j}"] = s[j]
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
+def save_sweep(table, model_name, data_set):
+    dirname = os.path.join(DATA_DIR, "sweeps")
+    os.makedirs(dirname, exist_ok=True)
+    filename = os.path.join(dirname, f"{model_name}_{data_set}.csv")
+    logging.info(f"Saving sweep to {filename}.")
+    table.to_csv(filename, index=False)
@@ -1,26 +1,29 @@
 import pandas as pd
 from utils.utils import *
-from utils.parameterization import valve_curve, RAMP_PARAMETERS
+from utils.artifacts import cached_model, cached_data, cached_results
+from utils.parameterization import valve_curve, RAMP_A, RAMP_B, RAMP_C
+from utils.topology import load_topology
 import os
 import matplotlib.pyplot as plt
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "tikz")
 
 def error_data(model_name, training_set, test_set):
-    row_lim = np.Inf
+    row_lim = np.inf
     
-    data = load_data(test_set)
-    results = load_results(model_name, training_set, test_set)
+    n_valves = load_topology(cached_model(model_name, training_set)["settings"]).n_consumers
+    data = cached_data(test_set, columns=[f"{c}{i}" for c in ["v", "q"] for i in range(n_valves)])
+    results = cached_results(model_name, training_set, test_set)
     
     tikz_data = pd.DataFrame()
-    for i in range(4):
+    for i in range(n_valves):
         tikz_data[f"e{i}"] = results[f"e{i}"]
         tikz_data[f"v{i}"] = data[f"v{i}"]
         tikz_data[f"q{i}"] = data[f"q{i}"]
         qm = tikz_data[f"q{i}"].mean()
         tikz_data[f"em{i}"] = tikz_data[f"e{i}"] /qm 
     # add columns for sign-change in v[i] (default 1)
-    for i in range(4):
+    for i in range(n_valves):
         tikz_data[f"sign{i}"] = data[f"v{i}"].diff().apply(lambda x : 1 if x > 0 else -1 if x < 0 else 1)
 
     # split data into training and test data
@@ -43,7 +46,7 @@ def error_data(model_name, training_set, test_set):
         
 
 def valve_curve_data(model_name, training_set):
-    model = load_model(model_name, training_set)
+    model = cached_model(model_name, training_set)
     kv = valve_curve(model)
     kv.to_csv(f"data/tikz/valve_curve_{model_name}_{training_set}.csv", index=False, lineterminator='\n')
     
@@ -64,18 +67,21 @@ def pipe_parameter_table():
         "exciting" : "E",
         "realistic" : "R"
     }
-    table = """Model & Data & $s_1$ & $s_2$ & $s_3$ & $s_4$ & $s_5$ & $s_6$ & $s_7$ \\\\ \hline \n"""
-    for model_name in get_all_models():
-        for training_set in ["exciting", "realistic"]:
-            model = load_model(model_name, training_set)
-            s = model["s"]
-            table += f"{model_name} & {data_short[training_set]} & "
-            for i in range(7):
-                if s[i] == 0:
-                    table += r"\zero & "
-                else:
-                    table += f"{sigdig(s[i], 2)} & "
-            table = table[:-2] + " \\\\\n"
+    models = [(model_name, training_set, cached_model(model_name, training_set)) for model_name in get_all_models() for training_set in DATA_SETS]
+    # one column per pipe of the largest network, models with fewer pipes leave the rest empty
+    n_pipes = max(len(model["s"]) for _, _, model in models)
+    table = "Model & Data & " + " & ".join(f"$s_{{{j+1}}}$" for j in range(n_pipes)) + r" \\ \hline " + "\n"
+    for model_name, training_set, model in models:
+        s = model["s"]
+        table += f"{model_name} & {data_short[training_set]} & "
+        for i in range(n_pipes):
+            if i >= len(s):
+                table += " & "
+            elif s[i] == 0:
+                table += r"\zero & "
+            else:
+                table += f"{sigdig(s[i], 2)} & "
+        table = table[:-2] + " \\\\\n"
     filename = os.path.join(DATA_DIR, "pipe_parameter_table.txt")
     with open(filename, "w") as f:
         f.write(table)
@@ -89,16 +95,16 @@ def model_equation():
         return r"""\frac{{ {0} }}{{\ramp{{ v_{1} }}{{ {2} }}{{ {3} }}^{{ {4} }} }} +""".format(sigdig(theta, 2), i, a, b, c)
         
     for model_name in get_all_models():
-        for training_data in ["exciting", "realistic"]:
-            model = load_model(model_name, training_data)
+        for training_data in DATA_SETS:
+            model = cached_model(model_name, training_data)
             theta = model["theta"]
             s = r""
             if model["settings"]["parameterization"] == "linear":
-                for i in range(4):
+                for i in range(len(theta)):
                     s += lin_term(theta[i][0], i+1)
             elif model["settings"]["parameterization"] == "ramps":
-                pars = [(a,b,c) for a in RAMP_PARAMETERS["a"] for b in RAMP_PARAMETERS["b"] for c in RAMP_PARAMETERS["c"]]
-                for i in range(4):
+                pars = list(zip(RAMP_A, RAMP_B, RAMP_C))
+                for i in range(len(theta)):
                     s += r"""\Delta p_{0} &= \left(""".format(i+1)
                     for k, t in enumerate(theta[i]):
                         if t > 0.0001:
@@ -122,7 +128,7 @@ def q3_sorted():
     """
     Sort the data for consumer 3 in the exciting data set
     """
-    data = load_data("exciting")
+    data = cached_data("exciting")
     # make a new dataframe with q3 sorted
     sorted_data = data.sort_values("q3")
     sorted_data["i"] = np.arange(sorted_data.shape[0])
@@ -140,14 +146,14 @@ def valve_overlap_example(plot=False):
     f2 = lambda v: k2(v) / np.sqrt(s * k2(v) ** 2 + 1)
     data = {
         "v": v_values,
-        "f1": [f1(v) for v in v_values],
-        "f2": [f2(v) for v in v_values],
+        "f1": f1(v_values),
+        "f2": f2(v_values),
     }
     df = pd.DataFrame(data)
     df.to_csv(os.path.join(DATA_DIR, "valve_overlap_example.csv"), index=False)
     if plot:
-        plt.plot(v_values, [f1(v) for v in v_values], label="f1")
-        plt.plot(v_values, [f2(v) for v in v_values], label="f2")
+        plt.plot(v_values, data["f1"], label="f1")
+        plt.plot(v_values, data["f2"], label="f2")
         plt.legend()
         plt.show()
 
@@ -158,7 +164,7 @@ if __name__ == "__main__":
     q3_sorted()
     valve_overlap_example(plot=True)
     for model_name in get_all_models():
-        for training_set in ["exciting", "realistic"]:
-            for test_set in ["exciting", "realistic"]:
+        for training_set in DATA_SETS:
+            for test_set in DATA_SETS:
                 error_data(model_name, training_set, test_set)
             valve_curve_data(model_name, training_set)
\ No newline at end of file
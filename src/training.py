@@ -1,86 +1,103 @@
 import numpy as np
 import cvxpy as cp
+import scipy.sparse as sp
 from utils.parameterization import load_parameterization
+from utils.topology import load_topology
 from utils.utils import *
-from utils.hysteresis import append_hysteresis
+from utils.hysteresis import append_hysteresis, HysteresisFilter
+from utils.cache import cache_key, load_cached_matrices, save_cached_matrices
+from solvers import LinearProgram, solve_highs, gram_statistics, solve_nnls, l2_objective
+from admm import solve_admm
+import profiling
 
-def valve_data(row, settings):
-    """
-    Compute the data matrix entries which hit the valve parameters for one load condition
-    """
-    valve_features = load_parameterization(settings)
+SOLVERS = ["cvxpy", "highs", "nnls", "admm"]
+# from this many consumers, problems with cost norm 2 are split over the consumers with ADMM instead of solved
+# with nnls on the Gram matrix of all parameters
+ADMM_MIN_CONSUMERS = 500
 
-    # evaluate all of the valve functions and put them in a long vector
-    gv =  [row[f'q{i}']**settings["flow rate exponent"] * valve_features(row[f'vh{i}']) for i in range(4) ]
-    
-    # Split the vector into block diagonal 4 x 4K matrix.
-    # the first row hits valve 1, the second valve 2, etc...
-    return blkdiag(gv)
-
-def pipe_data(row, settings):
+def training_columns(settings):
     """
-    Computer the data matrix entries which hit the pipe parameters for one load condition
+    Columns of the prepared data needed to build the data matrices: the pump pressure, the flow rate and valve
+    position of each consumer, and the measured flow rates of the pipes in the topology.
     """
-    gp = [
-        2 * row[f'q{i}']**settings["flow rate exponent"] for i in range(7)
-    ]
-    # initiate empty matrix
-    pipe_data = np.zeros((4, 7))
-    for i in range(4):
-        # select the correct pipe indices that lie in the path going through each valve
-        pipe_data[i, pipemap[i]] = [ gp[i] for i in pipemap[i]]
-    return pipe_data
+    topology = load_topology(settings)
+    flow_columns = [c for c in topology.flow_columns.values() if c not in [f"q{i}" for i in range(topology.n_consumers)]]
+    return ["dp_pump"] + [f"q{i}" for i in range(topology.n_consumers)] + flow_columns \
+        + [f"v{i}" for i in range(topology.n_consumers)]
 
-
-def make_load_condition_phi(row, settings):
+def valve_data(data, settings):
     """
-    Compute the 4 rows of Phi which correspond to one load condition (row)
+    Compute the data matrix entries which hit the valve parameters for all load conditions.
+    Returns one (N x K) array per valve, holding the nonzero entries of the rows which hit that valve
     """
-    phi_entry = np.hstack([
-        valve_data(row, settings), 
-        pipe_data(row, settings), 
-        ])
-    
-    # optionally drop rows where q < threshold
-    phi_entry = np.delete(phi_entry, [i for i in range(4) if row[f"q{i}"] < settings["flow rate threshold"]], axis = 0)
+    valve_features = load_parameterization(settings)
 
-    return phi_entry
+    # evaluate all of the valve functions, one block per valve
+    return [
+        np.power(data[f'q{i}'].to_numpy(), settings["flow rate exponent"])[:, None] * valve_features(data[f'vh{i}'].to_numpy())
+        for i in range(load_topology(settings).n_consumers)
+    ]
 
-def make_load_condition_y(row, settings):
+def pipe_data(data, settings):
     """
-    Compute the 4 rows of y which correspond to one load condition (row)
+    Compute the data matrix entries which hit the pipe parameters for all load conditions.
+    Returns one (N x len(pipemap[i])) array per valve, holding the entries for the pipes in the path going through valve i
     """
-    y = row['dp_pump'] * np.ones((4,1))
-    # optionally drop rows where q < threshold
-    y = np.delete(y, [i for i in range(4) if row[f"q{i}"] < settings["flow rate threshold"]], axis = 0)
-    return y
+    topology = load_topology(settings)
+    gp = 2 * np.power(topology.data_flow_rates(data), settings["flow rate exponent"])
+    return [gp[:, topology.pipemap[i]] for i in range(topology.n_consumers)]
 
-def make_load_condition_weights(row, settings):
+def row_mask(data, settings):
     """
-    Compute the 4 rows of optional weights to be used in the optimization problem in order to weigh precision towards higher flow rates
+    Boolean mask over the rows of the data matrices (one per load condition and valve), False where q < threshold
     """
-    w = np.array([row[f"vh{i}"] for i in range(4)]).reshape(4,1) - 0.2
-    # optionally drop rows where q < threshold
-    w = np.delete(w, [i for i in range(4) if row[f"q{i}"] < settings["flow rate threshold"]], axis = 0)
-    return w
+    q = np.column_stack([data[f"q{i}"].to_numpy() for i in range(load_topology(settings).n_consumers)])
+    return ~(q < settings["flow rate threshold"]).reshape(-1)
 
 def make_data_matrices(data, settings):
     """
-    Iterate over each row (load condition) in the data and compute the data matrices (phi, y, w)
+    Compute the data matrices (phi, y, w) for all load conditions (rows) in the data at once.
+    Each load condition gives one row per valve, in consecutive rows. Phi is returned as a sparse CSR matrix,
+    where the row hitting valve i holds the K entries of valve block i and the entries of the pipes in pipemap[i].
     """
-    phi = np.vstack([make_load_condition_phi(row, settings) for _, row in data.iterrows()])
-    y = np.vstack([make_load_condition_y(row, settings) for _, row in data.iterrows()])
-    w = np.vstack([make_load_condition_weights(row, settings) for _, row in data.iterrows()])
-    # reshape y and w to be vectors
-    y = y.reshape(-1)
-    w = w.reshape(-1)
-    return phi, y, w
+    topology = load_topology(settings)
+    n_valves = topology.n_consumers
+    n_data = len(data)
+    gv = valve_data(data, settings)
+    gp = pipe_data(data, settings)
+    n_features = gv[0].shape[1]
+    n_var = n_valves * n_features + topology.n_pipes
 
-def estimate_parameters(phi, y, w, settings):
+    # nonzero entries and their columns, row by row (load condition major, valve minor)
+    values = np.hstack([np.hstack([gv[i], gp[i]]) for i in range(n_valves)]).reshape(-1)
+    columns = np.concatenate([
+        np.concatenate([np.arange(i*n_features, (i+1)*n_features), n_valves * n_features + topology.pipemap[i]])
+        for i in range(n_valves)
+    ])
+    row_lengths = np.array([n_features + len(topology.pipemap[i]) for i in range(n_valves)])
+
+    y = np.repeat(data['dp_pump'].to_numpy(), n_valves)
+    w = np.column_stack([data[f"vh{i}"].to_numpy() for i in range(n_valves)]).reshape(-1) - 0.2
+
+    # optionally drop rows where q < threshold
+    mask = row_mask(data, settings)
+    lengths = np.tile(row_lengths, n_data)
+    entry_mask = np.repeat(mask, lengths)
+    indptr = np.concatenate([[0], np.cumsum(lengths[mask])])
+    phi = sp.csr_matrix(
+        (values[entry_mask], np.tile(columns, n_data)[entry_mask], indptr),
+        shape=(int(mask.sum()), n_var),
+    )
+    return phi, y[mask], w[mask]
+
+def make_problem(phi, y, w, settings):
     """
-    Find parameters s and theta through solving a convex optimization problem
+    Set up the convex optimization problem for finding s and theta.
+    The regularization gains enter as cvxpy Parameters, so that the problem is compiled once and
+    can be re-solved for new gains (see set_problem_parameters). The flow rate weights are constants,
+    as a parameter vector of length N would make the compiled problem grow with N^2.
+    Returns the problem, the variable beta and a dict of the parameters.
     """
-    # set up cvx problem
     # gather both s and theta in a vector beta (to be split up later)
     n_var = phi.shape[1]
     n_data = phi.shape[0]
@@ -89,56 +106,281 @@ def estimate_parameters(phi, y, w, settings):
     # optional flow rate weights
     W = w**settings["flow rate weights"]
 
+    params = {
+        "valve regularization gain": cp.Parameter(nonneg = True),
+        "pipe regularization gain": cp.Parameter(nonneg = True),
+    }
+
     # set up the objective function
+    n_pipes = load_topology(settings).n_pipes
     objective = cp.Minimize(
-        1 / n_data * cp.norm( np.diag(W) @ (phi @ beta - y), settings["cost norm"])
-        + settings["valve regularization gain"] * cp.norm(beta[:-7], settings["regularization norm"])
-        + settings["pipe regularization gain"] * cp.norm(beta[-7:], settings["regularization norm"])
+        1 / n_data * cp.norm( cp.multiply(W, phi @ beta - y), settings["cost norm"])
+        + params["valve regularization gain"] * cp.norm(beta[:-n_pipes], settings["regularization norm"])
+        + params["pipe regularization gain"] * cp.norm(beta[-n_pipes:], settings["regularization norm"])
         )
-    prob = cp.Problem(objective, [])
+    return cp.Problem(objective, []), beta, params
+
+def set_problem_parameters(params, settings):
+    """
+    Assign the regularization gains in settings to the parameters of the problem
+    """
+    params["valve regularization gain"].value = settings["valve regularization gain"]
+    params["pipe regularization gain"].value = settings["pipe regularization gain"]
 
+def solve_problem(prob, settings, verbose = True):
+    """
+    Solve the problem, warm-started from the current value of its variables
+    """
     if settings["cost norm"] == 2: # choose solver based on the problem
-        prob.solve(verbose=True, solver=cp.SCS)
+        prob.solve(verbose=verbose, solver=cp.SCS, warm_start=True)
     elif settings["cost norm"] == 1:
-        prob.solve(verbose=True, solver=cp.SCIPY)
+        prob.solve(verbose=verbose, solver=cp.SCIPY, warm_start=True)
     else:
         # use default solver
-        prob.solve(verbose=True)
+        prob.solve(verbose=verbose, warm_start=True)
+    stats = prob.solver_stats
+    profiling.record(**{
+        "solver": stats.solver_name, "status": prob.status, "compile time": prob.compilation_time,
+        "solve time": stats.solve_time, "iterations": stats.num_iters,
+    })
 
+def split_parameters(beta, settings):
+    """
+    Split the solution beta into valve parameters theta and pipe parameters s
+    """
     # split beta into valve and pipe resistances
-    n_v = int((n_var - 7) / 4) # number of valve features
-    theta = [beta.value[i*n_v:(i+1)*n_v] for i in range(4)]
-    s = beta.value[-7:]
+    topology = load_topology(settings)
+    n_v = int((len(beta) - topology.n_pipes) / topology.n_consumers) # number of valve features
+    theta = [beta[i*n_v:(i+1)*n_v] for i in range(topology.n_consumers)]
+    s = beta[-topology.n_pipes:]
 
     # set very small values to 0
-    theta = [[0 if abs(x) < settings["zero threshold"] else x for x in theta[i]] for i in range(4)]
+    theta = [[0 if abs(x) < settings["zero threshold"] else x for x in theta[i]] for i in range(topology.n_consumers)]
     s = [0 if abs(x) < settings["zero threshold"] else x for x in s]
 
     return theta, s
 
-def train_model(settings, data_set):
-    
-    data = load_data(data_set)
-    # append hysteresis-compensated columns "vh{i}" to data
-    data = append_hysteresis(data, settings["hysteresis percent"])
+def choose_solver(settings):
+    """
+    The solver backend in the optional "solver" setting, where "auto" (default) picks a dedicated backend
+    when the problem has a structure one can exploit, and cvxpy otherwise
+    """
+    solver = settings.get("solver", "auto")
+    if solver == "auto":
+        if settings["cost norm"] == 1 and settings["regularization norm"] == 1:
+            return "highs"
+        if settings["cost norm"] == 2 and settings["regularization norm"] in [1, 2]:
+            return "admm" if load_topology(settings).n_consumers >= ADMM_MIN_CONSUMERS else "nnls"
+        return "cvxpy"
+    if solver not in SOLVERS:
+        raise ValueError(f"Invalid solver {solver}, choose from {['auto'] + SOLVERS}.")
+    return solver
+
+def compare_with_scs(phi, y, w, settings, beta, stats):
+    """
+    Solve the problem with cvxpy (SCS) as well and log how well the answer agrees with beta
+    """
+    prob, beta_scs, params = make_problem(phi, y, w, settings)
+    set_problem_parameters(params, settings)
+    solve_problem(prob, settings, verbose=False)
+    objective = l2_objective(beta, stats, settings)
+    objective_scs = l2_objective(beta_scs.value, stats, settings)
+    logging.debug(f"nnls vs SCS: objective {objective:.6e} vs {objective_scs:.6e} (relative difference "
+                  f"{(objective_scs - objective) / abs(objective):.2e}), max parameter difference "
+                  f"{np.abs(beta - beta_scs.value).max():.3e}")
+
+def solve_beta(phi, y, w, settings, beta0 = None, verbose = True):
+    """
+    Solve the convex optimization problem for beta, the parameters theta and s stacked in one vector.
+    beta0: an earlier solution to warm-start from, used by the nnls, admm and cvxpy solvers
+    """
+    solver = choose_solver(settings)
+    if solver == "highs":
+        return solve_highs(phi, y, w, settings)
+    if solver == "admm":
+        beta, info = solve_admm(phi, y, w, settings, beta0)
+        profiling.record(solver="admm", **info)
+        return beta
+    if solver == "nnls":
+        stats = gram_statistics(phi, y, w, settings)
+        beta, info = solve_nnls(stats, settings, beta0)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            compare_with_scs(phi, y, w, settings, beta, stats)
+        profiling.record(solver="nnls", **info)
+        return beta
+
+    prob, beta, params = make_problem(phi, y, w, settings)
+    set_problem_parameters(params, settings)
+    if beta0 is not None:
+        beta.value = beta0
+    solve_problem(prob, settings, verbose)
+    return beta.value
+
+def objective_value(phi, y, w, beta, settings):
+    """
+    The objective of the problem in make_problem at beta
+    """
+    n_pipes = load_topology(settings).n_pipes
+    W = w**settings["flow rate weights"]
+    norm = settings["regularization norm"]
+    return np.linalg.norm(W * (phi @ beta - y), settings["cost norm"]) / phi.shape[0] \
+        + settings["valve regularization gain"] * np.linalg.norm(beta[:-n_pipes], norm) \
+        + settings["pipe regularization gain"] * np.linalg.norm(beta[-n_pipes:], norm)
+
+class PathSolver:
+    """
+    Solves the problem on fixed data matrices for a sequence of settings which only differ in the regularization gains
+    and flow rate weights, such as a regularization path, with the backend from choose_solver.
+    What does not change between the settings is set up once: the LP for highs, and the Gram statistics for nnls
+    and the compiled problem for cvxpy, which are set up again when the flow rate weight changes.
+    Each solve is warm-started from the previous solution.
+    """
+    def __init__(self, phi, y, w):
+        self.phi, self.y, self.w = phi, y, w
+        self.beta = None
+        self.key = None
+        self.setup = None
 
-    # extract the first "training data percent"% of the data for training
-    training_data = data.iloc[:int(len(data)*settings["training data percent"]/100)]
+    def solve(self, settings):
+        """
+        Solve the problem for settings. Returns beta and the solver status.
+        """
+        solver = choose_solver(settings)
+        # the LP takes new flow rate weights as new bounds
+        key = (solver, None if solver == "highs" else settings["flow rate weights"])
+        if key != self.key:
+            self.key = key
+            if solver == "highs":
+                self.setup = LinearProgram(self.phi, self.y)
+            elif solver == "nnls":
+                self.setup = gram_statistics(self.phi, self.y, self.w, settings)
+            elif solver == "cvxpy":
+                self.setup = make_problem(self.phi, self.y, self.w, settings)
 
-    # make data matrices
-    phi, y, w = make_data_matrices(training_data, settings)
+        status = "optimal"
+        if solver == "highs":
+            self.beta = self.setup.solve(self.w, settings)
+        elif solver == "nnls":
+            self.beta, info = solve_nnls(self.setup, settings, self.beta)
+            profiling.record(solver="nnls", **info)
+        elif solver == "admm":
+            self.beta = solve_beta(self.phi, self.y, self.w, settings, self.beta, verbose=False)
+        else:
+            prob, beta, params = self.setup
+            set_problem_parameters(params, settings)
+            solve_problem(prob, settings, verbose=False)
+            self.beta, status = beta.value, prob.status
+        return self.beta, status
+
+def estimate_parameters(phi, y, w, settings):
+    """
+    Find parameters s and theta through solving a convex optimization problem
+    """
+    return split_parameters(solve_beta(phi, y, w, settings), settings)
+
+def training_split(data, settings):
+    """
+    extract the first "training data percent"% of the data for training
+    """
+    return data.iloc[:int(len(data)*settings["training data percent"]/100)]
+
+def train_model(settings, data_set, data = None):
+    """
+    Train a model on data_set. The data set can be passed as data if it is already loaded, and is then modified in place.
+    The data matrices are reused from the cache when an earlier model was trained on the same data with the same
+    settings for building them.
+    With profiling on, the stages of the run are recorded in model["profile"].
+    """
+    profiling.start()
+    key = cache_key(data_set, settings)
+    with profiling.stage("cache lookup"):
+        cached = load_cached_matrices(key)
+    if cached is not None:
+        phi, y, w = cached
+    else:
+        if data is None:
+            with profiling.stage("load"):
+                data = load_data(data_set)
+        # append hysteresis-compensated columns "vh{i}" to data
+        with profiling.stage("hysteresis"):
+            data = append_hysteresis(data, settings["hysteresis percent"])
+
+        # extract the first "training data percent"% of the data for training
+        training_data = training_split(data, settings)
+
+        # make data matrices
+        with profiling.stage("phi"):
+            phi, y, w = make_data_matrices(training_data, settings)
+        with profiling.stage("cache store"):
+            save_cached_matrices(key, data_set, settings, phi, y, w)
 
     # train the model
-    theta, s = estimate_parameters(phi, y, w, settings)
+    with profiling.stage("solve"):
+        profiling.record_matrix(phi)
+        theta, s = estimate_parameters(phi, y, w, settings)
 
     # save the data matrices for potential later analysis
-    save_data_matrices(settings, data_set, phi, y)
+    with profiling.stage("save"):
+        save_data_matrices(settings, data_set, phi, y)
 
     model = {
         "theta": theta,
         "s": s,
         "settings": settings
     }
+    profile = profiling.stop()
+    if profile is not None:
+        model["profile"] = profile
     return model
 
+def train_model_chunked(settings, data_set, chunk_size):
+    """
+    Train a model on data_set streamed in chunks of chunk_size rows, for data sets which do not fit in memory.
+    The hysteresis filters carry their state between chunks, so the data matrices are the same as in train_model.
+    Only the Gram statistics are accumulated over the chunks, so the memory used is bounded by the chunk size; this
+    requires the nnls solver (cost norm 2). The other solvers need all rows of phi at once, and are refused.
+    The data matrices are not saved, nor cached.
+    With profiling on, the stages of the run are recorded in model["profile"], where "phi" covers reading the chunks,
+    the hysteresis filters and the data matrices.
+    """
+    solver = choose_solver(settings)
+    if solver != "nnls":
+        raise ValueError(f"Training in chunks requires the nnls solver, which only keeps the Gram statistics of the "
+                         f"chunks, but the model is solved with {solver}, which needs all rows of the data matrices in "
+                         "memory. Use cost norm 2 and regularization norm 1 or 2 (with \"solver\": \"nnls\" for networks "
+                         f"of {ADMM_MIN_CONSUMERS} or more consumers), or train without --chunk-size.")
+    profiling.start()
+    n_rows = count_rows(data_set)
+    n_train = int(n_rows * settings["training data percent"] / 100)
+    if n_train == 0:
+        raise ValueError(f"No training data: {settings['training data percent']}% of the {n_rows} rows of {data_set}.")
+    n_valves = load_topology(settings).n_consumers
+    filters = [HysteresisFilter(settings["hysteresis percent"] / 100) for _ in range(n_valves)]
+
+    stats = None
+    with profiling.stage("phi"):
+        rows = nnz = 0
+        for chunk in iter_data(data_set, chunk_size, training_columns(settings), n_train):
+            for i in range(n_valves):
+                chunk[f"vh{i}"] = filters[i].filter(chunk[f"v{i}"].to_numpy())
+            phi, y, w = make_data_matrices(chunk, settings)
+            rows, nnz = rows + phi.shape[0], nnz + phi.nnz
+            chunk_stats = gram_statistics(phi, y, w, settings)
+            stats = chunk_stats if stats is None else tuple(a + b for a, b in zip(stats, chunk_stats))
+        n_var = phi.shape[1]
+
+    with profiling.stage("solve"):
+        profiling.record(rows=rows, columns=n_var, nnz=nnz)
+        beta, info = solve_nnls(stats, settings)
+        profiling.record(solver="nnls", **info)
+        theta, s = split_parameters(beta, settings)
 
+    model = {
+        "theta": theta,
+        "s": s,
+        "settings": settings
+    }
+    profile = profiling.stop()
+    if profile is not None:
+        model["profile"] = profile
+    return model
@@ -0,0 +1,67 @@
+# Memoized loading of the artifacts plots and exports are made from: prepared data sets, results and trained models.
+# Each artifact is cached on its path and modification time, so a file which is written again is read again.
+# The cached objects are shared between callers, which must not modify them.
+import functools
+import os
+
+from utils.utils import DATA_DIR, column_store_dirname, model_dirname, results_filename, load_data, load_results, load_model
+
+# number of artifacts of each kind kept in memory, least recently used first out
+ARTIFACT_CACHE_SIZE = 32
+
+def file_version(filename):
+    """
+    (size, modification time) of a file, or None if it does not exist
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+@functools.lru_cache(maxsize=ARTIFACT_CACHE_SIZE)
+def _data(data_name, version):
+    return load_data(data_name)
+
+@functools.lru_cache(maxsize=ARTIFACT_CACHE_SIZE)
+def _results(model_name, training_data, test_data, version):
+    return load_results(model_name, training_data, test_data)
+
+@functools.lru_cache(maxsize=ARTIFACT_CACHE_SIZE)
+def _model(name, training_data, version):
+    return load_model(name, training_data)
+
+def cached_data(data_name, columns = None):
+    """
+    load_data, reading the whole data set once and taking the columns from it
+    """
+    version = (
+        file_version(os.path.join(DATA_DIR, f"{data_name}.csv")),
+        file_version(os.path.join(column_store_dirname(data_name), "manifest.json")),
+    )
+    data = _data(data_name, version)
+    if columns is None:
+        return data
+    missing = [column for column in columns if column not in data]
+    if len(missing) > 0:
+        raise KeyError(f"Columns {missing} not in data set {data_name}.")
+    return data[columns]
+
+def cached_results(model_name, training_data, test_data):
+    """
+    load_results, reading each results file once
+    """
+    version = file_version(results_filename(model_name, training_data, test_data))
+    return _results(model_name, training_data, test_data, version)
+
+def cached_model(name, training_data):
+    """
+    load_model, reading each model once. meta.json is written last when a model is saved, so it versions the model.
+    """
+    dirname = model_dirname(name, training_data)
+    version = (file_version(os.path.join(dirname, "meta.json")), file_version(f"{dirname}.pkl"))
+    return _model(name, training_data, version)
+
+def clear_artifact_cache():
+    for f in [_data, _results, _model]:
+        f.cache_clear()
@@ -0,0 +1,175 @@
+# Content-addressed cache of the data matrices, keyed by the contents of the data set
+# and the settings which affect phi, y and w.
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from utils.topology import topology_file
+from utils.utils import DATA_DIR, save_arrays, load_arrays, sparse_to_arrays, sparse_from_arrays
+
+CACHE_DIR = os.path.join(DATA_DIR, "data_matrices", "cache")
+# maximum total size of the cache in bytes, least recently used entries are evicted beyond this
+CACHE_SIZE_LIMIT = 1024**3
+# settings which change the data matrices, the regularization gains, norms and flow rate weights do not
+PHI_SETTINGS = ["parameterization", "hysteresis percent", "flow rate exponent", "flow rate threshold", "training data percent"]
+# bump when the layout of the data matrices changes, to invalidate old entries
+CACHE_VERSION = 2
+# entries are written to temporary directories with this prefix and then moved into place
+TMP_PREFIX = ".tmp-"
+# seconds after which an entry without meta.json is taken to be left behind by a writer which died, and evicted
+INCOMPLETE_GRACE_PERIOD = 3600
+
+_digests = {}
+
+def file_digest(filename):
+    """
+    sha256 of the contents of a file, memoized on its path, size and modification time
+    """
+    stat = os.stat(filename)
+    key = (filename, stat.st_size, stat.st_mtime_ns)
+    if key not in _digests:
+        h = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+def cache_key(data_set, settings):
+    """
+    Key of the data matrices for training on data_set with settings
+    """
+    description = {
+        "data": file_digest(os.path.join(DATA_DIR, f"{data_set}.csv")),
+        "settings": {k: settings[k] for k in PHI_SETTINGS},
+        "version": CACHE_VERSION,
+    }
+    # the layout of phi follows the network, the lab network keeps the keys of earlier entries
+    if "topology" in settings:
+        description["topology"] = file_digest(topology_file(settings))
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+def load_cached_matrices(key, mmap_mode = None):
+    """
+    Returns the cached (phi, y, w) for key, or None if they are not in the cache.
+    mmap_mode: memory-map the arrays instead of reading them, e.g. to share them between processes
+    """
+    dirname = os.path.join(CACHE_DIR, key)
+    if not os.path.exists(os.path.join(dirname, "meta.json")):
+        return None
+
+    try:
+        arrays, meta = load_arrays(dirname, ["phi_data", "phi_indices", "phi_indptr", "y", "w"], mmap_mode=mmap_mode)
+        # mark as recently used
+        os.utime(os.path.join(dirname, "meta.json"))
+    except FileNotFoundError:
+        # evicted by another process in the meantime
+        return None
+    logging.info(f"Using cached data matrices {key[:12]}.")
+    return sparse_from_arrays("phi", arrays, meta["phi"]), arrays["y"], arrays["w"]
+
+def save_cached_matrices(key, data_set, settings, phi, y, w):
+    """
+    Cache (phi, y, w) as key. The entry is written to a temporary directory in the cache and renamed into place,
+    so other processes only ever see complete entries. If another process cached the same key first, its entry is kept.
+    """
+    dirname = os.path.join(CACHE_DIR, key)
+    if os.path.exists(os.path.join(dirname, "meta.json")):
+        return
+    logging.debug(f"Caching data matrices as {key[:12]}.")
+
+    arrays, description = sparse_to_arrays("phi", phi)
+    arrays.update({"y": y, "w": w})
+    tmpdir = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(dir=CACHE_DIR, prefix=TMP_PREFIX)
+        save_arrays(tmpdir, arrays, {"data set": data_set, "settings": {k: settings[k] for k in PHI_SETTINGS}, "phi": description})
+        os.replace(tmpdir, dirname)
+    except OSError as e:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        # the entry may have been moved into place by another process in the meantime, otherwise training goes on
+        # without caching
+        if not os.path.exists(os.path.join(dirname, "meta.json")):
+            logging.warning(f"Could not cache the data matrices as {key[:12]}: {e}")
+        return
+    except BaseException:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+    evict(CACHE_SIZE_LIMIT)
+
+def cache_entries():
+    """
+    List the complete cache entries, least recently used first. Temporary directories and entries without meta.json
+    are being written by another process (or were left behind by one, see evict), and are not listed.
+    """
+    if not os.path.exists(CACHE_DIR):
+        return []
+    entries = []
+    for key in os.listdir(CACHE_DIR):
+        if key.startswith(TMP_PREFIX):
+            continue
+        dirname = os.path.join(CACHE_DIR, key)
+        meta_file = os.path.join(dirname, "meta.json")
+        try:
+            with open(meta_file, "r") as f:
+                meta = json.load(f)
+            size = sum(os.path.getsize(os.path.join(dirname, f)) for f in os.listdir(dirname))
+            last_used = os.path.getmtime(meta_file)
+        except FileNotFoundError:
+            continue
+        entries.append({"key": key, "size": size, "last used": last_used, **meta})
+    return sorted(entries, key=lambda entry: entry["last used"])
+
+def remove_incomplete_entries(grace_period = INCOMPLETE_GRACE_PERIOD):
+    """
+    Remove the temporary directories and entries without meta.json which have not been written to for grace_period
+    seconds
+    """
+    if not os.path.exists(CACHE_DIR):
+        return
+    now = time.time()
+    for key in os.listdir(CACHE_DIR):
+        dirname = os.path.join(CACHE_DIR, key)
+        try:
+            if not key.startswith(TMP_PREFIX) and os.path.exists(os.path.join(dirname, "meta.json")):
+                continue
+            modified = max([os.path.getmtime(dirname)] + [os.path.getmtime(os.path.join(dirname, f)) for f in os.listdir(dirname)])
+        except FileNotFoundError:
+            continue
+        if now - modified > grace_period:
+            logging.info(f"Removing incomplete cache entry {key[:12]}.")
+            shutil.rmtree(dirname, ignore_errors=True)
+
+def evict(size_limit):
+    """
+    Remove the least recently used entries until the cache is at most size_limit bytes, and incomplete entries
+    left behind by writers which died
+    """
+    remove_incomplete_entries()
+    entries = cache_entries()
+    total = sum(entry["size"] for entry in entries)
+    for entry in entries:
+        if total <= size_limit:
+            break
+        logging.info(f"Evicting cached data matrices {entry['key'][:12]}.")
+        shutil.rmtree(os.path.join(CACHE_DIR, entry["key"]), ignore_errors=True)
+        total -= entry["size"]
+
+def clear_cache():
+    evict(0)
+
+def print_cache():
+    entries = cache_entries()
+    for entry in entries:
+        last_used = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["last used"]))
+        print(f"{entry['key'][:12]}\t{entry['data set']}\t{entry['size'] / 1024**2:.1f} MB\t{last_used}\t{entry['settings']}")
+    total = sum(entry["size"] for entry in entries)
+    print(f"{len(entries)} entries, {total / 1024**2:.1f} MB of {CACHE_SIZE_LIMIT / 1024**2:.1f} MB.")
@@ -1,27 +1,92 @@
-def hysteresis_valve_pos(vcol, delta):
+import numpy as np
+import pandas as pd
+
+# the kernel loops over the samples of series shorter than this, and vectorizes over blocks of samples otherwise
+VECTORIZE_MIN_LENGTH = 2000
+# samples per block of the vectorized kernel
+BLOCK_SIZE = 32
+
+def compose_clamps(lo, hi):
     """
-    Simulate hysteresis in valve position
+    Prefix compositions of the clamps x -> min(max(x, lo[i]), hi[i]): the bounds of the clamp which applies
+    clamps 0, ..., i in turn. A clamp of a clamp is a clamp, with the bounds of the inner one clamped by the outer one.
+    The clamps are composed along blocks of BLOCK_SIZE samples, for all blocks at once, and the blocks are then
+    joined by composing the clamps of whole blocks the same way.
+    """
+    n = len(lo)
+    n_blocks = -(-n // BLOCK_SIZE)
+    block_size = BLOCK_SIZE if n_blocks > 1 else n
+    # padded with the identity clamp, and stored with one block per column so each step is over contiguous rows
+    pad = n_blocks * block_size - n
+    lo = np.concatenate([lo, np.full(pad, -np.inf)]).reshape(n_blocks, block_size).T.copy()
+    hi = np.concatenate([hi, np.full(pad, np.inf)]).reshape(n_blocks, block_size).T.copy()
+    for k in range(1, block_size):
+        lo[k], hi[k] = np.clip(lo[k-1], lo[k], hi[k]), np.clip(hi[k-1], lo[k], hi[k])
+    if n_blocks > 1:
+        block_lo, block_hi = compose_clamps(lo[-1], hi[-1])
+        lo[:, 1:], hi[:, 1:] = np.clip(block_lo[:-1], lo[:, 1:], hi[:, 1:]), np.clip(block_hi[:-1], lo[:, 1:], hi[:, 1:])
+    return lo.T.reshape(-1)[:n], hi.T.reshape(-1)[:n]
+
+def hysteresis_kernel(v, delta, last=None):
+    """
+    Simulate hysteresis in valve position over a 1-d array of positions.
+    last: filtered position preceding v[0], or None to let the filter start at v[0]
+    Each sample clamps the filtered position to [v - delta, v + delta], so for long series the composed clamps are
+    computed with compose_clamps instead of stepping through the samples.
+    """
+    if delta == 0 or len(v) == 0:
+        return np.array(v, dtype=float)
+
+    v = np.asarray(v, dtype=float)
+    start = v[0] if last is None else last
+    if len(v) >= VECTORIZE_MIN_LENGTH:
+        # a missing position leaves the filtered position as it is, like the loop below
+        missing = np.isnan(v)
+        lo, hi = compose_clamps(np.where(missing, -np.inf, v - delta), np.where(missing, np.inf, v + delta))
+        return np.clip(start, lo, hi)
+
+    # plain python floats in a tight loop
+    vhyst = [0.0] * len(v)
+    previous = start
+    for i, vi in enumerate(v.tolist()):
+        if previous < vi - delta:
+            previous = vi - delta
+        elif previous > vi + delta:
+            previous = vi + delta
+        vhyst[i] = previous
+
+    return np.array(vhyst)
+
+class HysteresisFilter:
     """
-    vhyst = vcol.copy(deep=True)
-    if delta == 0:
+    Hysteresis filter for valve positions arriving in chunks, e.g. from live data.
+    The last filtered position is carried between calls, so filtering a series chunk by chunk
+    gives the same result as filtering it all at once.
+    """
+    def __init__(self, delta, last=None):
+        self.delta = delta
+        self.last = last
+
+    def filter(self, v):
+        vhyst = hysteresis_kernel(v, self.delta, self.last)
+        if len(vhyst) > 0:
+            self.last = vhyst[-1]
         return vhyst
 
-    for i in range(1, len(vcol)):
-        if vcol[i] - vhyst[i-1] > delta:
-            vhyst[i] = vcol[i] - delta
-        elif vcol[i] - vhyst[i-1] < -delta:
-            vhyst[i] = vcol[i] + delta
-        else:
-            vhyst[i] = vhyst[i-1]
-            
-    return vhyst
+def hysteresis_valve_pos(vcol, delta):
+    """
+    Simulate hysteresis in valve position
+    """
+    return pd.Series(hysteresis_kernel(vcol.to_numpy(), delta), index=vcol.index, name=vcol.name)
 
 def append_hysteresis(data, delta_percent):
     """
     Append hysteresis-filtered valve positions to data
     """
-    # append hysteresis with different d-values
-    for i in range(4):
+    # append hysteresis with different d-values, for all valves v0, v1, ... in the data
+    i = 0
+    while f'v{i}' in data:
         data[f'vh{i}'] = hysteresis_valve_pos(data[f'v{i}'], delta_percent/100)
+        i += 1
 
-    return data
\ No newline at end of file
+    return data
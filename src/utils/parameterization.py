@@ -1,3 +1,4 @@
+import functools
 import numpy as np
 import pandas as pd
 from utils.utils import ramp
@@ -8,31 +9,159 @@ RAMP_PARAMETERS = {
     "c": [2.0, 2.5, 3.0]
 }
 
+# the ramp grid as flat arrays, in the order of the features of f_ramps
+RAMP_A, RAMP_B, RAMP_C = np.array([
+    (a, b, c) for a in RAMP_PARAMETERS["a"] for b in RAMP_PARAMETERS["b"] for c in RAMP_PARAMETERS["c"]
+]).T
+
+# registered valve basis functions, mapping a vector of n valve positions to an (n x K) feature matrix
+PARAMETERIZATIONS = {}
+# for the bases whose valve resistance curves can be tabulated, the function giving the breakpoints of a curve
+BREAKPOINTS = {}
+
+# valve resistance curves are tabulated on this many intervals of equal length over the valve positions [0, 1]
+VALVE_TABLE_INTERVALS = 2**13
+# bound on the relative error of the tabulated valve resistances, positions where it cannot be met are evaluated exactly
+VALVE_TABLE_TOLERANCE = 1e-6
+
+def scalar_or_vector(f):
+    """
+    A basis function f mapping a vector of n valve positions to an (n x K) matrix, extended to map a single position
+    to its K features
+    """
+    @functools.wraps(f)
+    def valve_features(v):
+        v = np.asarray(v, dtype=float)
+        features = f(np.atleast_1d(v))
+        return features[0] if v.ndim == 0 else features
+    return valve_features
+
+def register_parameterization(name, vectorized=True, breakpoints=None):
+    """
+    Decorator registering a valve basis function under name. The decorated function takes a vector of valve positions
+    or a single position, as the functions returned by load_parameterization.
+    * vectorized=True: the function maps a vector of n valve positions to an (n x K) matrix
+    * vectorized=False: the function maps a single valve position to K features, and is applied to one position at a time
+    * breakpoints: for bases of nonincreasing functions whose logs are convex except at some positions, a function
+      mapping the K parameters of a valve to these positions. The valve resistance curves are then tabulated for
+      prediction (see ValveTable). None for bases which are always evaluated exactly.
+    """
+    def decorator(f):
+        if vectorized:
+            PARAMETERIZATIONS[name] = f
+        else:
+            PARAMETERIZATIONS[name] = lambda v: np.array([f(vi) for vi in v]).reshape(len(v), -1)
+        if breakpoints is not None:
+            BREAKPOINTS[name] = breakpoints
+        return scalar_or_vector(PARAMETERIZATIONS[name])
+    return decorator
+
 def load_parameterization(settings):
     """
-    Loads the parameterization function
+    Loads the parameterization function.
+    The returned function maps a vector of valve positions to an (n x K) matrix, and a single position to K features.
     """
-    model_map = {
-        "linear": f_linear,
-        "ramps": f_ramps
-    }
     parameterization = settings["parameterization"]
-    if parameterization not in model_map:
+    if parameterization not in PARAMETERIZATIONS:
         raise ValueError(f"Invalid model parameterization {parameterization}.")
-    
-    return model_map[parameterization]
+    return scalar_or_vector(PARAMETERIZATIONS[parameterization])
 
+@register_parameterization("linear")
 def f_linear(v):
     """
     naive valve basis function
     """
-    return np.array([1 / (v**2)])
+    return 1 / (v[:, None]**2)
+
+def ramp_breakpoints(theta):
+    """
+    The lower ends of the ramps with nonzero parameters, where the valve resistance curve has a kink which is not convex
+    """
+    return np.unique(RAMP_A[np.asarray(theta) != 0])
 
+@register_parameterization("ramps", breakpoints=ramp_breakpoints)
 def f_ramps(v):
     """
     Basis function for valve parameterization using ramp functions
     """
-    return np.array([ 1 / ramp(v, a, b)**(c) for a in RAMP_PARAMETERS["a"] for b in RAMP_PARAMETERS["b"] for c in RAMP_PARAMETERS["c"]])
+    return 1 / ramp(v[:, None], RAMP_A, RAMP_B)**RAMP_C
+
+class ValveTable:
+    """
+    The valve resistance curves s_i(v) = f(v) @ theta_i of a model, tabulated for fast evaluation independent of the
+    number of basis functions. log s_i is tabulated on a grid of VALVE_TABLE_INTERVALS intervals over [0, 1] and
+    interpolated linearly.
+    With nonnegative parameters, each curve is nonincreasing, and log s_i is convex between the breakpoints of the
+    parameterization (as the log of a nonnegative sum of functions with convex logs). There, interpolation is exact at the
+    grid points and above log s_i in between, by at most h/4 (d[k+1] - d[k-1]) on interval k, with h the grid step and d
+    the slopes of log s_i between grid points (the grid has one more point beyond 1 for the last interval). Positions on
+    intervals where this bound exceeds the tolerance, or whose neighbours touch a breakpoint, the first interval and
+    positions outside [0, 1] are evaluated exactly, so the relative error is at most the tolerance everywhere.
+    values: the curves on the grid, of shape (n_valves, intervals + 2), if already tabulated
+    """
+    def __init__(self, theta, settings, values = None, intervals = VALVE_TABLE_INTERVALS, tolerance = VALVE_TABLE_TOLERANCE):
+        self.theta = np.array(theta, dtype=float)
+        self.valve_features = load_parameterization(settings)
+        self.intervals = intervals
+        if values is None:
+            values = (self.valve_features(np.arange(intervals + 2) / intervals) @ self.theta.T).T
+        self.values = np.asarray(values, dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            log_values = np.log(self.values)
+
+            # slopes between the grid points, and the interpolation error bound of each interval
+            h = 1 / intervals
+            slopes = np.diff(log_values, axis=1) / h
+            bound = np.full((len(self.theta), intervals), np.inf)
+            bound[:, 1:] = h / 4 * (slopes[:, 2:] - slopes[:, :-2])
+            exact = ~(np.expm1(bound) <= tolerance)
+
+        for i in range(len(self.theta)):
+            if np.any(self.theta[i] < 0):
+                exact[i] = True
+            for point in BREAKPOINTS[settings["parameterization"]](self.theta[i]):
+                # the intervals which use the slopes on either side of the breakpoint, with a margin for rounding
+                k = int(np.floor(point * intervals))
+                exact[i, max(k - 3, 0):k + 3] = True
+
+        # flat, with a row of intervals + 2 entries per valve, and the intervals evaluated exactly zeroed in the table
+        self.log_values = np.nan_to_num(log_values, posinf=0, neginf=0).reshape(-1)
+        self.exact = np.concatenate([exact, np.ones((len(exact), 2), dtype=bool)], axis=1).reshape(-1)
+        self.offsets = (intervals + 2) * np.arange(len(exact), dtype=float)[:, None]
+
+    def __call__(self, v):
+        """
+        Equivalent resistances of the valves at the positions v, of shape (n_valves,) or (n_valves, n)
+        """
+        v = np.asarray(v, dtype=float)
+        shape = v.shape
+        v = v.reshape(len(self.theta), -1)
+        x = v * self.intervals
+        # fmin and fmax map nan to the other argument
+        k = np.fmin(np.fmax(np.floor(x), 0), self.intervals - 1)
+        index = (k + self.offsets).astype(np.intp)
+        exact = self.exact[index] | ~((v >= 0) & (v <= 1))
+        g = self.log_values[index]
+        s = np.exp(g + (x - k) * (self.log_values[index + 1] - g))
+        if exact.any():
+            valve = np.nonzero(exact)[0]
+            s[exact] = np.einsum("nk,nk->n", self.valve_features(v[exact]), self.theta[valve])
+        return s.reshape(shape)
+
+def valve_table(model):
+    """
+    The ValveTable of a model, or None if its parameterization cannot be tabulated. The tabulated curves are kept in
+    the model as the array "valve_table", so that they are saved with it and reused.
+    """
+    settings = model["settings"]
+    if settings["parameterization"] not in BREAKPOINTS:
+        return None
+    values = model.get("valve_table")
+    if values is not None and np.shape(values) != (len(model["theta"]), VALVE_TABLE_INTERVALS + 2):
+        values = None
+    table = ValveTable(model["theta"], settings, values)
+    model["valve_table"] = table.values
+    return table
 
 
 def print_curves(model):
@@ -40,35 +169,41 @@ def print_curves(model):
     if model["settings"]["parameterization"] == "linear":
         funcs = [ "1 / v^2" ]
     elif model["settings"]["parameterization"] == "ramps":
-        funcs = [ f"/ramp(v, {round(a,3)}, {round(b,3)})^{round(c,3)}" for a in RAMP_PARAMETERS["a"] for b in RAMP_PARAMETERS["b"] for c in RAMP_PARAMETERS["c"]]
+        funcs = [ f"/ramp(v, {round(a,3)}, {round(b,3)})^{round(c,3)}" for a, b, c in zip(RAMP_A, RAMP_B, RAMP_C)]
     else:
         raise ValueError(f"Invalid model parameterization {model['settings']['parameterization']}.")
     
-    for i in range(4):
+    for i in range(len(model["theta"])):
         print(f"Valve {i}:")
         terms = [
             str( round(model["theta"][i][j], 4)) + funcs[j] for j in range(len(model["theta"][i])) if model["theta"][i][j] > 0 
         ]
         print(" + ".join(terms))
 
-def valve_equivalent_resistances(model):
+def valve_equivalent_resistances(model, tabulate = True):
     """
-    Returns a function for evaluating the equivalent resistances in the valves
+    Returns a function for evaluating the equivalent resistances in the valves.
+    The function takes the positions of the valves, each either a scalar or a vector of n samples,
+    and returns an array of shape (n_valves,) or (n_valves, n).
+    tabulate: evaluate the curves from the ValveTable of the model, if its parameterization can be tabulated
     """
-    theta = model["theta"]
+    table = valve_table(model) if tabulate else None
+    if table is not None:
+        return lambda v : table(np.array(v, dtype=float))
+    theta = [np.asarray(t, dtype=float) for t in model["theta"]]
     valve_features = load_parameterization(model["settings"])
     return lambda v : np.array([
-        np.dot(valve_features(v[i]), theta[i]) for i in range(4)
+        valve_features(v[i]) @ theta[i] for i in range(len(theta))
         ])
 
 def valve_curve(model, n_points=100):
     """
-    generate values for plotting the valve curve of a model
+    generate values for plotting the valve curve of a model, from its ValveTable if it has been tabulated
     """
-    s_valves = valve_equivalent_resistances(model)
+    s_valves = valve_equivalent_resistances(model, tabulate="valve_table" in model)
     v_values = np.linspace(0, 1, n_points)
-    kv = [[s**(-1/model["settings"]["flow rate exponent"]) for s in s_valves([v,v,v,v])] for v in v_values]
-    kv = pd.DataFrame(kv, columns=[f'kv{i}' for i in range(4)])
+    n_valves = len(model["theta"])
+    kv = s_valves([v_values] * n_valves)**(-1/model["settings"]["flow rate exponent"])
+    kv = pd.DataFrame(kv.T, columns=[f'kv{i}' for i in range(n_valves)])
     kv["v"] = v_values
     return kv
-
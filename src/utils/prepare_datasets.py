@@ -2,56 +2,84 @@
 import pandas as pd
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
+from utils.utils import write_column_store
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 RAW_DATA_DIR = os.path.join(os.path.dirname(ROOT_DIR), "data", "raw_data")
 
-def filter_realistic(file, step_length):
-    filepath = os.path.join(RAW_DATA_DIR, "realistic", file)
-    data = pd.read_csv(filepath)
-    # drop first 100 samples which correspond to a start-up-period
-    data = data.drop(range(100))
-    # rearrange the index to start at 0
-    l = len(data)
-    data.index = np.arange(l)
-    # compute the mean over step_length samples and drop the last sample
-    data = data.groupby(np.arange(l) // step_length).mean()
-    data = data.drop(data.index[-1])
-    return data
+# number of raw data rows read at a time
+CHUNK_SIZE = 100000
 
-def filter_exciting(file, drop_first, step_length):
-    filepath = os.path.join(RAW_DATA_DIR, "exciting", file)
-    data = pd.read_csv(filepath)
+def stream_block_means(filepath, skip, step_length, block_mean):
+    """
+    Read a raw data file in chunks of CHUNK_SIZE rows, drop the first skip rows and compute block_mean over
+    consecutive blocks of step_length rows. Rows which do not complete a block are carried over to the next chunk,
+    so memory use is bounded by the chunk size. The last block is dropped, whether complete or not.
+    """
+    means = []
+    carry = None
+    for chunk in pd.read_csv(filepath, chunksize=CHUNK_SIZE):
+        if skip > 0:
+            n_skip = min(skip, len(chunk))
+            chunk = chunk.iloc[n_skip:]
+            skip -= n_skip
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+        n_full = len(chunk) // step_length * step_length
+        if n_full > 0:
+            means.append(block_mean(chunk.iloc[:n_full], step_length))
+        carry = chunk.iloc[n_full:]
 
-    # drop first 20 samples which correspond to a start-up-period.
-    data_mean = pd.concat(
-        [data.iloc[i+drop_first:i+step_length].mean() for i in range(20, len(data), step_length)], 
-        axis=1).transpose()
-    
+    data = pd.concat(means, ignore_index=True)
     # drop the last sample to avoid nan values due to mismatch in sample size
-    data_mean = data_mean.drop(data_mean.index[-1])
-    return data_mean
+    if carry is None or len(carry) == 0:
+        data = data.drop(data.index[-1])
+    return data
+
+def filter_realistic(file, step_length, raw_dir = RAW_DATA_DIR):
+    filepath = os.path.join(raw_dir, "realistic", file)
+    # drop first 100 samples which correspond to a start-up-period
+    # and compute the mean over step_length samples
+    return stream_block_means(
+        filepath, 100, step_length,
+        lambda block, step_length: block.groupby(np.arange(len(block)) // step_length).mean()
+    )
+
+def exciting_block_mean(block, step_length, drop_first):
+    """
+    Mean over the samples drop_first, ..., step_length-1 of each block of step_length samples,
+    as a single reshape and mean over the block axis
+    """
+    n_blocks = len(block) // step_length
+    # one contiguous row per column, so that each block is summed the same way as a data frame slice
+    values = np.ascontiguousarray(block.to_numpy(dtype=float).T).reshape(block.shape[1], n_blocks, step_length)
+    means = values[:, :, drop_first:].sum(axis=2) / (step_length - drop_first)
+    return pd.DataFrame(means.T, columns=block.columns)
 
-def make_filtered_data_set(method, step_length, drop_first=10):
+def filter_exciting(file, drop_first, step_length, raw_dir = RAW_DATA_DIR):
+    filepath = os.path.join(raw_dir, "exciting", file)
+
+    # drop first 20 samples which correspond to a start-up-period,
+    # and the first drop_first samples of each step
+    return stream_block_means(
+        filepath, 20, step_length,
+        lambda block, step_length: exciting_block_mean(block, step_length, drop_first)
+    )
+
+RAW_FILES = ['consumer_1.csv', 'consumer_2.csv', 'consumer_3.csv', 'consumer_4.csv', 'pipe_20.csv', 'pipe_24.csv', 'pump_41.csv']
+
+def make_filtered_data_set(method, step_length, drop_first=10, raw_dir=RAW_DATA_DIR):
     if method == "realistic":
-        prep_method = lambda file: filter_realistic(file, step_length)
+        prep_method = lambda file: filter_realistic(file, step_length, raw_dir)
     elif method == "exciting":
-        prep_method = lambda file: filter_exciting(file, drop_first, step_length)
+        prep_method = lambda file: filter_exciting(file, drop_first, step_length, raw_dir)
     else:
         raise ValueError("Invalid method: " + method)
     
-    # load consumer data and compute mean over step_length samples
-    consumer_1 = prep_method('consumer_1.csv')
-    consumer_2 = prep_method('consumer_2.csv')
-    consumer_3 = prep_method('consumer_3.csv')
-    consumer_4 = prep_method('consumer_4.csv')
-
-    # load pipe data and compute mean over step_length samples
-    supply_pipe = prep_method('pipe_20.csv')
-    return_pipe = prep_method('pipe_24.csv')
-
-    # pumping station
-    pumping_station = prep_method('pump_41.csv')
+    # load consumer, pipe and pumping station data concurrently and compute mean over step_length samples
+    with ThreadPoolExecutor(max_workers=len(RAW_FILES)) as executor:
+        consumer_1, consumer_2, consumer_3, consumer_4, supply_pipe, return_pipe, pumping_station = executor.map(prep_method, RAW_FILES)
 
     data = pd.DataFrame({
         "q0": consumer_1["q_pipe"],
@@ -110,10 +138,11 @@ def run():
         else:
             print("Saving realistic data set to data/realistic.csv")
             data.to_csv("data/realistic.csv")
+            write_column_store("realistic")
     else:
         print("Saving realistic data set to data/realistic.csv")
         data.to_csv("data/realistic.csv")
-
+        write_column_store("realistic")
     # filter the exciting data set
     step_length = 40
     drop_first = 10
@@ -126,9 +155,10 @@ def run():
         else:
             print("Saving exciting data set to data/exciting.csv")
             data.to_csv("data/exciting.csv")
+            write_column_store("exciting")
     else:
         print("Saving exciting data set to data/exciting.csv")
         data.to_csv("data/exciting.csv")
-
+        write_column_store("exciting")
 if __name__ == "__main__":
     run(overwrite=True)
\ No newline at end of file
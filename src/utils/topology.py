@@ -0,0 +1,119 @@
+# Network topologies: a tree of pipes from the pumping station out to the consumers (substations), each with a valve.
+import functools
+import json
+import os
+import numpy as np
+import scipy.sparse as sp
+
+from utils.utils import MODEL_DIR
+
+TOPOLOGY_DIR = os.path.join(MODEL_DIR, "topologies")
+# the lab network, used by models without a "topology" setting
+DEFAULT_TOPOLOGY = "lab"
+
+class Topology:
+    """
+    A tree network given as an edge list of pipes [parent node, child node] and a list of consumer nodes.
+    The pump is at the root, the one node which is not the child of any pipe, and the consumers are the leaves,
+    with their valve at the end of the pipe leading to them. Pipes (the parameters s, with flow rates from the
+    consumers downstream) and consumers (the valves, with data columns q{i} and v{i}) are numbered in the order they
+    are listed. Both the supply and the return pipe are counted in s, as in the model dp = sum 2 s_e q_e^gamma + ...
+    flow_columns: optionally, for each pipe the column of the data set holding its measured flow rate, or None where
+    it is not measured. The flow rates of the other pipes are the sums of the flow rates of the consumers downstream.
+    """
+    def __init__(self, consumers, pipes, flow_columns = None):
+        nodes = {}
+        index = lambda name: nodes.setdefault(name, len(nodes))
+        self.parent = np.array([index(p) for p, _ in pipes], dtype=int)
+        self.child = np.array([index(c) for _, c in pipes], dtype=int)
+        self.n_nodes = len(nodes)
+        self.n_pipes = len(pipes)
+        self.n_consumers = len(consumers)
+
+        if len(np.unique(self.child)) != self.n_pipes:
+            raise ValueError("Each node of the network can only be fed by one pipe.")
+        roots = np.setdiff1d(np.arange(self.n_nodes), self.child)
+        if len(roots) != 1:
+            raise ValueError(f"The network must have one root (the pump), found {len(roots)}.")
+        self.root = roots[0]
+        missing = [c for c in consumers if c not in nodes]
+        if len(missing) > 0:
+            raise ValueError(f"Consumers {missing} are not connected to any pipe.")
+        self.consumer_nodes = np.array([nodes[c] for c in consumers], dtype=int)
+        if set(np.setdiff1d(np.arange(self.n_nodes), self.parent)) != set(self.consumer_nodes):
+            raise ValueError("The consumers must be exactly the leaves of the network.")
+
+        # pipe feeding each node (-1 at the root), and the pipe upstream of each pipe
+        self.feeding_pipe = np.full(self.n_nodes, -1)
+        self.feeding_pipe[self.child] = np.arange(self.n_pipes)
+        upstream = self.feeding_pipe[self.parent]
+
+        # walk up from all pipes at once, one level per pass: depth of each pipe below the root
+        depth = np.zeros(self.n_pipes, dtype=int)
+        current = upstream.copy()
+        for _ in range(self.n_pipes):
+            if np.all(current < 0):
+                break
+            depth += current >= 0
+            current = np.where(current >= 0, upstream[current], -1)
+        else:
+            raise ValueError("The network contains a cycle.")
+        self.levels = [np.flatnonzero(depth == d) for d in range(depth.max() + 1)]
+
+        # incidence[i, e] = 1 if pipe e is on the path from the pump to consumer i, found walking up from the consumers
+        rows, columns = [], []
+        current = self.feeding_pipe[self.consumer_nodes]
+        consumer = np.arange(self.n_consumers)
+        while len(current) > 0:
+            rows.append(consumer)
+            columns.append(current)
+            keep = upstream[current] >= 0
+            consumer, current = consumer[keep], upstream[current][keep]
+        rows, columns = np.concatenate(rows), np.concatenate(columns)
+        self.incidence = sp.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(self.n_consumers, self.n_pipes))
+        self.incidence.sort_indices()
+        # the pipes on the path to each consumer, in increasing order
+        self.pipemap = [self.incidence.indices[self.incidence.indptr[i]:self.incidence.indptr[i+1]] for i in range(self.n_consumers)]
+
+        self.is_consumer = np.zeros(self.n_nodes, dtype=bool)
+        self.is_consumer[self.consumer_nodes] = True
+
+        if flow_columns is None:
+            flow_columns = [None] * self.n_pipes
+        if len(flow_columns) != self.n_pipes:
+            raise ValueError(f"Expected {self.n_pipes} pipe flow columns, got {len(flow_columns)}.")
+        self.flow_columns = {e: column for e, column in enumerate(flow_columns) if column is not None}
+
+    def pipe_flow_rates(self, q):
+        """
+        Flow rates of all pipes, from the flow rates q of the consumers of shape (N, n_consumers).
+        The flows of each pipe are summed in the order of the consumers.
+        """
+        return np.asarray(self.incidence.T @ np.asarray(q, dtype=float).T).T
+
+    def data_flow_rates(self, data):
+        """
+        Flow rates of all pipes for the rows of a data set, of shape (N, n_pipes): measured where the pipe has a flow
+        column, and summed from the consumers otherwise
+        """
+        q = np.column_stack([data[f"q{i}"].to_numpy() for i in range(self.n_consumers)])
+        q_pipe = self.pipe_flow_rates(q)
+        for e, column in self.flow_columns.items():
+            q_pipe[:, e] = data[column].to_numpy()
+        return q_pipe
+
+@functools.lru_cache(maxsize=None)
+def read_topology(name):
+    with open(os.path.join(TOPOLOGY_DIR, f"{name}.json"), "r") as f:
+        description = json.load(f)
+    return Topology(description["consumers"], description["pipes"], description.get("flow columns"))
+
+def topology_file(settings):
+    return os.path.join(TOPOLOGY_DIR, f"{settings.get('topology', DEFAULT_TOPOLOGY)}.json")
+
+def load_topology(settings):
+    """
+    The network topology of a model: src/models/topologies/<name>.json for the optional "topology" setting,
+    the lab network by default
+    """
+    return read_topology(settings.get("topology", DEFAULT_TOPOLOGY))
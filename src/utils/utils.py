@@ -1,51 +1,225 @@
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import pickle
+import json
 import os
+import shutil
 import logging
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATA_DIR = os.path.join(os.path.dirname(ROOT_DIR), "data")
 MODEL_DIR = os.path.join(ROOT_DIR, "models")
+DATA_SETS = ["exciting", "realistic"]
 
-def load_data(data_name):
+def column_store_dirname(data_name):
+    return os.path.join(DATA_DIR, f"{data_name}_columns")
+
+def write_column_store(data_name):
+    """
+    Store the columns of the prepared data set data/<data_name>.csv as one .npy file each, with a manifest.
+    The columns are read from the csv file, so that loading from the store gives the same values as parsing the csv.
+    """
     file_name = os.path.join(DATA_DIR, f"{data_name}.csv")
-    return pd.read_csv(file_name)
+    data = pd.read_csv(file_name)
+    dirname = column_store_dirname(data_name)
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.makedirs(dirname)
+    for column in data.columns:
+        np.save(os.path.join(dirname, f"{column}.npy"), data[column].to_numpy())
+
+    # the csv file the store was made from, to detect if it has been changed since
+    stat = os.stat(file_name)
+    manifest = {
+        "columns": list(data.columns),
+        "dtypes": [str(dtype) for dtype in data.dtypes],
+        "rows": len(data),
+        "csv size": stat.st_size,
+        "csv mtime": stat.st_mtime_ns,
+    }
+    with open(os.path.join(dirname, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+
+def load_column_manifest(data_name):
+    """
+    Returns the manifest of the column store of data_name, or None if there is no store matching the csv file
+    """
+    manifest_file = os.path.join(column_store_dirname(data_name), "manifest.json")
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    stat = os.stat(os.path.join(DATA_DIR, f"{data_name}.csv"))
+    if (manifest["csv size"], manifest["csv mtime"]) != (stat.st_size, stat.st_mtime_ns):
+        logging.info(f"Column store of {data_name} is out of date, reading the csv file.")
+        return None
+    return manifest
+
+def load_data(data_name, columns = None):
+    """
+    Load a prepared data set, optionally only the given columns.
+    The columns are memory-mapped from the column store written by the prepare step if there is one,
+    otherwise they are parsed from the csv file.
+    """
+    manifest = load_column_manifest(data_name)
+    if manifest is None:
+        file_name = os.path.join(DATA_DIR, f"{data_name}.csv")
+        if columns is None:
+            return pd.read_csv(file_name)
+        return pd.read_csv(file_name, usecols=columns)[columns]
+
+    dirname = column_store_dirname(data_name)
+    columns = manifest["columns"] if columns is None else columns
+    missing = [column for column in columns if column not in manifest["columns"]]
+    if len(missing) > 0:
+        raise KeyError(f"Columns {missing} not in data set {data_name}.")
+    # copy-on-write maps, so that the data frame can be modified without touching the files
+    return pd.DataFrame(
+        {column: np.load(os.path.join(dirname, f"{column}.npy"), mmap_mode="c") for column in columns},
+        copy=False,
+    )
+
+def count_rows(data_name):
+    """
+    Number of rows in a prepared data set, without loading it
+    """
+    manifest = load_column_manifest(data_name)
+    if manifest is not None:
+        return manifest["rows"]
+    file_name = os.path.join(DATA_DIR, f"{data_name}.csv")
+    return sum(len(chunk) for chunk in pd.read_csv(file_name, usecols=[0], chunksize=1_000_000))
+
+def iter_data(data_name, chunk_size, columns = None, n_rows = None):
+    """
+    Stream a prepared data set as data frames of chunk_size rows, optionally only the given columns and the first n_rows rows.
+    Each chunk is read from the column store if there is one, otherwise from the csv file, and is indexed by its row numbers.
+    """
+    manifest = load_column_manifest(data_name)
+    if manifest is None:
+        file_name = os.path.join(DATA_DIR, f"{data_name}.csv")
+        start = 0
+        for chunk in pd.read_csv(file_name, usecols=columns, chunksize=chunk_size):
+            if n_rows is not None:
+                if start >= n_rows:
+                    return
+                chunk = chunk.iloc[:n_rows - start]
+            start += len(chunk)
+            yield chunk if columns is None else chunk[columns]
+        return
+
+    dirname = column_store_dirname(data_name)
+    columns = manifest["columns"] if columns is None else columns
+    n_rows = manifest["rows"] if n_rows is None else min(n_rows, manifest["rows"])
+    for start in range(0, n_rows, chunk_size):
+        end = min(start + chunk_size, n_rows)
+        # map the files anew for each chunk, so the pages read so far are released with the map
+        yield pd.DataFrame(
+            {column: np.array(np.load(os.path.join(dirname, f"{column}.npy"), mmap_mode="r")[start:end]) for column in columns},
+            index=pd.RangeIndex(start, end),
+        )
 
 def ramp(x, a, b, tol = 1e-8):
     """
-    Ramp function
+    Ramp function, elementwise over broadcast arrays x, a, b
     * x < a: 0 
     * a < x < b: (x-a)/(b-a)
     * x > b: 1
     * tol: Tolerance for x < a to avoid division by 0
     """
-    if b < a:
-        a, b = b, a
-    return min(max(x-a+tol, tol), b-a) / (b-a)
+    a, b = np.minimum(a, b), np.maximum(a, b)
+    return np.minimum(np.maximum(x-a+tol, tol), b-a) / (b-a)
+
+def save_arrays(dirname, arrays, metadata):
+    """
+    Store each array in the dict arrays raw as dirname/<key>.npy, and metadata in the sidecar dirname/meta.json
+    """
+    os.makedirs(dirname, exist_ok=True)
+    for key, array in arrays.items():
+        np.save(os.path.join(dirname, f"{key}.npy"), array)
+    # written last, so a directory without meta.json is incomplete
+    with open(os.path.join(dirname, "meta.json"), "w") as f:
+        json.dump(metadata, f, indent=4, default=lambda x: x.item())
+
+def load_arrays(dirname, keys, mmap_mode = "r"):
+    """
+    Load the arrays in keys from dirname, memory-mapped unless mmap_mode is None, together with the metadata
+    """
+    with open(os.path.join(dirname, "meta.json"), "r") as f:
+        metadata = json.load(f)
+    arrays = {key: np.load(os.path.join(dirname, f"{key}.npy"), mmap_mode=mmap_mode) for key in keys}
+    return arrays, metadata
+
+def sparse_to_arrays(name, matrix):
+    """
+    Split a sparse CSR or CSC matrix into raw arrays and a description for save_arrays
+    """
+    arrays = {f"{name}_data": matrix.data, f"{name}_indices": matrix.indices, f"{name}_indptr": matrix.indptr}
+    return arrays, {"format": matrix.format, "shape": list(matrix.shape)}
+
+def sparse_from_arrays(name, arrays, description):
+    """
+    Inverse of sparse_to_arrays
+    """
+    matrix_type = {"csr": sp.csr_matrix, "csc": sp.csc_matrix}[description["format"]]
+    return matrix_type(
+        (arrays[f"{name}_data"], arrays[f"{name}_indices"], arrays[f"{name}_indptr"]),
+        shape=tuple(description["shape"]),
+    )
+
+def model_dirname(name, training_data):
+    return os.path.join(MODEL_DIR, "parameters", f"{name}_{training_data}")
 
 def load_model(name, training_data):
+    dirname = model_dirname(name, training_data)
+    if not os.path.exists(os.path.join(dirname, "meta.json")):
+        if os.path.exists(f"{dirname}.pkl"):
+            return migrate_model(name, training_data)
+        raise FileNotFoundError(f"No such model {name}_{training_data}.")
 
-    filename = os.path.join(MODEL_DIR, "parameters", f"{name}_{training_data}.pkl")
-    if not os.path.exists(filename):
-        raise FileNotFoundError(f"No such model {name}_{training_data}.pkl.")
+    logging.debug(f"Loading model from {dirname}.")
+    with open(os.path.join(dirname, "meta.json"), "r") as f:
+        metadata = json.load(f)
+    arrays, _ = load_arrays(dirname, metadata["arrays"], mmap_mode=None)
+    model = {key: value for key, value in metadata.items() if key != "arrays"}
+    model.update(arrays)
+    # theta and s as lists, the way they come out of training
+    model["theta"] = model["theta"].tolist()
+    model["s"] = model["s"].tolist()
+    return model
 
-    logging.debug(f"Loading model from {filename}.")
+def migrate_model(name, training_data):
+    """
+    Read a model stored as a pickle file by earlier versions, and store it in the current format
+    """
+    filename = f"{model_dirname(name, training_data)}.pkl"
+    logging.info(f"Migrating model {filename} to the array format.")
     with open(filename, 'rb') as f:
         model = pickle.load(f)
+    write_model(model, model_dirname(name, training_data))
     return model
 
+def write_model(model, dirname):
+    """
+    Store theta, s and any other array in the model as .npy files, and the rest (settings etc.) in meta.json
+    """
+    arrays = {key: np.asarray(value, dtype=float) for key, value in model.items() if key in ["theta", "s"] or isinstance(value, np.ndarray)}
+    metadata = {key: value for key, value in model.items() if key not in arrays}
+    metadata["arrays"] = list(arrays)
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    save_arrays(dirname, arrays, metadata)
 
 def save_model(model, training_data, overwrite = False):
     name = model["settings"]["name"]
-    filename = os.path.join(MODEL_DIR, "parameters", f"{name}_{training_data}.pkl")
+    filename = model_dirname(name, training_data)
     # Check if file exists
     if not os.path.exists(filename):
         logging.info("File does not exist. Saving...")
     elif overwrite:
         logging.info(f"Overwriting existing file {filename}.")
     else:
-        print(f"Model with name {name}_{training_data}.pkl already exists. Overwrite? (y/n)")
+        print(f"Model with name {name}_{training_data} already exists. Overwrite? (y/n)")
         if input() != "y":
             print("Aborting.")
             return
@@ -53,12 +227,14 @@ def save_model(model, training_data, overwrite = False):
 
     logging.debug(f"Saving model to {filename}.")
     logging.debug(f"Model: {model}")
-    with open(filename, "wb") as f:
-        pickle.dump(model, f)
+    write_model(model, filename)
     print("Model saved.")
 
+def results_filename(model_name, training_data, test_data):
+    return os.path.join(DATA_DIR, "results", f"{model_name}_{training_data}_{test_data}.csv")
+
 def save_results(results, model_name, training_data, test_data, overwrite = False):
-    filename = os.path.join(DATA_DIR, "results", f"{model_name}_{training_data}_{test_data}.csv")
+    filename = results_filename(model_name, training_data, test_data)
 
     # Check if file exists
     if not os.path.exists(filename):
@@ -74,21 +250,13 @@ def save_results(results, model_name, training_data, test_data, overwrite = Fals
     results.to_csv(filename)
 
 def load_results(model_name, training_data, test_data):
-    filename = os.path.join(DATA_DIR, "results", f"{model_name}_{training_data}_{test_data}.csv")
+    filename = results_filename(model_name, training_data, test_data)
     if not os.path.exists(filename):
         raise FileNotFoundError(f"No such results {model_name}_{training_data}_{test_data}.csv.")
 
     results = pd.read_csv(filename)
     return results
 
-# pipe-map:
-pipemap = [ # Maps valve indices to pipes in their loops
-    [0,4],
-    [1,4,5],
-    [2,4,5,6],
-    [3,4,5,6]
-]
-
 def blkdiag(vectors):
     """
     Make a block diagonal matrix from a list of vectors
@@ -114,44 +282,79 @@ def print_model(model, print_settings = True, print_theta = True, print_s = True
     
     if print_theta:
         print("Valve parameters theta:")
-        for v in range(4):
+        for v in range(len(model["theta"])):
             theta = model["theta"][v]
             print(f"Valve {v}:\t{[round(x, 4) for x in theta]}")
         
     if print_s:        
         print("Pipe parameters s:")
         s = model["s"]
-        for i in range(7):
+        for i in range(len(s)):
             print(f"Pipe {i}:\t{round(s[i], 6)}")
     
 def save_data_matrices(settings, data_set, phi, y):
+    """
+    Store phi in CSC format, so that the columns of one valve can be memory-mapped on their own
+    """
+    from utils.topology import load_topology
     name = settings["name"]
     dirname = os.path.join(DATA_DIR, "data_matrices", f"{name}_{data_set}")
-    if not os.path.exists(dirname):
-        os.mkdir(dirname)
+    phi = sp.csc_matrix(phi)
+    arrays, description = sparse_to_arrays("phi", phi)
+    arrays["y"] = np.asarray(y)
+    # number of valve features, for selecting the columns of one valve
+    topology = load_topology(settings)
+    n_features = (phi.shape[1] - topology.n_pipes) // topology.n_consumers
+    save_arrays(dirname, arrays, {"phi": description, "n features": n_features})
 
-    with open(f"{dirname}/phi.pkl", "wb") as f:
-        pickle.dump(phi, f)
+def load_data_matrices(model_name, training_data, valve = None, mmap_mode = "r"):
+    """
+    Load phi and y, memory-mapped unless mmap_mode is None.
+    valve: only load the columns of phi which hit the parameters of this valve
+    """
+    dirname = os.path.join(DATA_DIR, "data_matrices", f"{model_name}_{training_data}")
+    if not os.path.exists(os.path.join(dirname, "meta.json")):
+        return load_legacy_data_matrices(dirname, valve)
 
-    with open(f"{dirname}/y.pkl", "wb") as f:
-        pickle.dump(y, f)
+    keys = ["phi_data", "phi_indices", "phi_indptr", "y"]
+    arrays, metadata = load_arrays(dirname, keys, mmap_mode=mmap_mode)
+    y = arrays["y"]
+    if valve is None:
+        return sparse_from_arrays("phi", arrays, metadata["phi"]), y
 
-def load_data_matrices(model_name, training_data):
-    dirname = os.path.join(DATA_DIR, "data_matrices", f"{model_name}_{training_data}")
+    # slice the column pointers of the valve block, only touching its part of data and indices
+    n_features = metadata["n features"]
+    indptr = arrays["phi_indptr"][valve*n_features:(valve+1)*n_features + 1]
+    start, end = indptr[0], indptr[-1]
+    phi = sp.csc_matrix(
+        (arrays["phi_data"][start:end], arrays["phi_indices"][start:end], indptr - start),
+        shape=(metadata["phi"]["shape"][0], n_features),
+    )
+    return phi, y
+
+def load_legacy_data_matrices(dirname, valve = None):
+    """
+    Read data matrices pickled by earlier versions
+    """
     with open(os.path.join(dirname, "phi.pkl"), "rb") as f:
         phi = pickle.load(f)
     
     with open(os.path.join(dirname, "y.pkl"), "rb") as f:
         y = pickle.load(f)
 
+    if valve is not None:
+        n_features = (phi.shape[1] - 7) // 4
+        phi = sp.csc_matrix(phi)[:, valve*n_features:(valve+1)*n_features]
     return phi, y
 
-def print_data_stats(data_set):
-    
+def print_data_stats(data_set, topology):
+    """
+    Print the flow rates and valve positions of the consumers of the network topology in a data set
+    """
     print("-------------------------------------------------------")
     print(f"Data set: {data_set}")
     print("-------------------------------------------------------")
-    data = load_data(data_set)
+    data = load_data(data_set, columns=[f"{c}{i}" for c in ["q", "v"] for i in range(topology.n_consumers)])
     training_data = data[:int(0.7 * len(data))]
 
     print("Data set size:")
@@ -160,7 +363,7 @@ def print_data_stats(data_set):
     print(f"Test data (30 %): {len(data) - int(0.7 * len(data))} samples")
 
     print(f"Min, 5th quantile, mean, 95th quantile and max flow rates in {data_set} data set:")
-    for i in range(4):
+    for i in range(topology.n_consumers):
         vals = [
             np.round(data[f'q{i}'].min(), 3),
             np.round(data[f'q{i}'].quantile(0.05), 3),
@@ -171,7 +374,7 @@ def print_data_stats(data_set):
 
         print(f"Full data, flow rate {i}: \t{vals[0]}, \t{vals[1]}, \t{vals[2]}, \t{vals[3]}, \t{vals[4]}")
     
-    for i in range(4):
+    for i in range(topology.n_consumers):
         vals = [
             np.round(training_data[f'q{i}'].min(), 3),
             np.round(training_data[f'q{i}'].quantile(0.05), 3),
@@ -182,7 +385,7 @@ def print_data_stats(data_set):
         print(f"Training data, flow rate {i}: \t{vals[0]}, \t{vals[1]}, \t{vals[2]}, \t{vals[3]}, \t{vals[4]}")
     
     print(f"Min, 5th quantile, mean, 95th quantile and max valve positions in {data_set} data set:")
-    for i in range(4):
+    for i in range(topology.n_consumers):
         vals = [
             np.round(data[f'v{i}'].min(), 3),
             np.round(data[f'v{i}'].quantile(0.05), 3),
@@ -194,7 +397,7 @@ def print_data_stats(data_set):
         print(f"Full data, valve {i}: \t{vals[0]}, \t{vals[1]}, \t{vals[2]}, \t{vals[3]}, \t{vals[4]}")
     
     training_data = data[:int(0.7 * len(data))]
-    for i in range(4):
+    for i in range(topology.n_consumers):
         vals = [
             np.round(training_data[f'v{i}'].min(), 3),
             np.round(training_data[f'v{i}'].quantile(0.05), 3),
@@ -0,0 +1,20 @@
+# The modules in src/ import each other as top-level modules, as when running src/main.py
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """
+    A temporary data directory in place of data/, for tests which write data sets, caches and models
+    """
+    import training
+    import utils.cache
+    import utils.utils
+    for module in [utils.utils, utils.cache, training]:
+        monkeypatch.setattr(module, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(utils.cache, "CACHE_DIR", str(tmp_path / "data_matrices" / "cache"))
+    return tmp_path
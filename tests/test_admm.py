@@ -0,0 +1,37 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import admm
+from benchmark import generate_data_set
+from training import make_data_matrices
+from utils.hysteresis import append_hysteresis
+from utils.topology import load_topology
+
+SETTINGS = {
+    "parameterization": "linear", "flow rate weights": 1, "hysteresis percent": 1.5, "cost norm": 2,
+    "regularization norm": 1, "valve regularization gain": 1e-4, "pipe regularization gain": 1e-4,
+    "flow rate exponent": 2.0, "flow rate threshold": 0.1, "zero threshold": 1e-8,
+}
+
+def test_admm_workers_match_serial():
+    # the workers are started with the default start method, and attach to phi by the names of its shared memory
+    data = append_hysteresis(generate_data_set(load_topology(SETTINGS), 200), SETTINGS["hysteresis percent"])
+    phi, y, w = make_data_matrices(data, SETTINGS)
+    serial, serial_info = admm.solve_admm(phi, y, w, SETTINGS, n_workers=1)
+    parallel, parallel_info = admm.solve_admm(phi, y, w, SETTINGS, n_workers=2)
+    assert parallel_info["admm iterations"] == serial_info["admm iterations"]
+    np.testing.assert_allclose(parallel, serial, rtol=1e-10, atol=1e-14)
+
+def solver_workers():
+    return admm.N_WORKERS
+
+def test_solver_workers_reach_spawned_training_workers(monkeypatch):
+    # --solver-workers is set in the main process, and only reaches the -j workers through the initializer
+    from main import init_training_worker
+    monkeypatch.setattr(admm, "N_WORKERS", 3)
+    context = multiprocessing.get_context("spawn")
+    initargs = ([], 0, 1000, False, admm.N_WORKERS)
+    with ProcessPoolExecutor(1, mp_context=context, initializer=init_training_worker, initargs=initargs) as executor:
+        assert executor.submit(solver_workers).result() == 3
@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from utils import cache
+
+SETTINGS = {"parameterization": "linear", "hysteresis percent": 0, "flow rate exponent": 2.0,
+            "flow rate threshold": 0.0, "training data percent": 70}
+
+def matrices(n = 1000, seed = 0):
+    rng = np.random.default_rng(seed)
+    return sp.random(n, 11, density=0.3, format="csr", random_state=seed), rng.uniform(size=n), rng.uniform(size=n)
+
+def test_round_trip(data_dir):
+    phi, y, w = matrices()
+    cache.save_cached_matrices("key", "synthetic", SETTINGS, phi, y, w)
+    cached = cache.load_cached_matrices("key")
+    assert (cached[0] != phi).nnz == 0
+    np.testing.assert_array_equal(cached[1], y)
+    np.testing.assert_array_equal(cached[2], w)
+    assert os.listdir(cache.CACHE_DIR) == ["key"]
+
+def test_incomplete_entries_are_kept_until_the_grace_period(data_dir):
+    cache.save_cached_matrices("complete", "synthetic", SETTINGS, *matrices())
+    incomplete = os.path.join(cache.CACHE_DIR, "incomplete")
+    os.makedirs(incomplete)
+    np.save(os.path.join(incomplete, "y.npy"), np.zeros(10))
+
+    assert [entry["key"] for entry in cache.cache_entries()] == ["complete"]
+    cache.evict(0)
+    assert os.listdir(cache.CACHE_DIR) == ["incomplete"]
+
+    old = time.time() - 2 * cache.INCOMPLETE_GRACE_PERIOD
+    for path in [incomplete, os.path.join(incomplete, "y.npy")]:
+        os.utime(path, (old, old))
+    cache.evict(0)
+    assert os.listdir(cache.CACHE_DIR) == []
+
+def write_entry(cache_dir, seed):
+    cache.CACHE_DIR = cache_dir
+    cache.save_cached_matrices("shared", "synthetic", SETTINGS, *matrices(200000, seed))
+
+def test_concurrent_writers_leave_one_complete_entry(data_dir):
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=write_entry, args=(cache.CACHE_DIR, seed)) for seed in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    assert os.listdir(cache.CACHE_DIR) == ["shared"]
+    phi, y, w = cache.load_cached_matrices("shared")
+    # the arrays of one writer, not a mix of several
+    seed = [s for s in range(4) if np.array_equal(y, matrices(200000, s)[1])]
+    assert len(seed) == 1
+    np.testing.assert_array_equal(w, matrices(200000, seed[0])[2])
+
+def test_temporary_directories_are_not_entries(data_dir):
+    # a writer which has saved its arrays and meta.json, but not yet moved them into place
+    cache.save_cached_matrices("staged", "synthetic", SETTINGS, *matrices())
+    staged = os.path.join(cache.CACHE_DIR, cache.TMP_PREFIX + "staged")
+    os.replace(os.path.join(cache.CACHE_DIR, "staged"), staged)
+
+    assert cache.cache_entries() == []
+    cache.evict(0)
+    assert os.listdir(cache.CACHE_DIR) == [cache.TMP_PREFIX + "staged"]
+
+def test_failed_write_is_not_fatal(data_dir, monkeypatch):
+    save_arrays = cache.save_arrays
+    def save_and_remove(dirname, *args):
+        # the temporary directory removed by another process before it is moved into place
+        save_arrays(dirname, *args)
+        shutil.rmtree(dirname)
+    monkeypatch.setattr(cache, "save_arrays", save_and_remove)
+    cache.save_cached_matrices("key", "synthetic", SETTINGS, *matrices())
+    assert cache.load_cached_matrices("key") is None
+    assert os.listdir(cache.CACHE_DIR) == []
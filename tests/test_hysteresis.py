@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from utils import hysteresis
+from utils.hysteresis import HysteresisFilter, hysteresis_kernel
+
+@pytest.mark.parametrize("n", [1, 31, 32, 33, 1000, 5000])
+@pytest.mark.parametrize("last", [None, 0.5])
+def test_vectorized_kernel_matches_loop(monkeypatch, n, last):
+    # positions rounded to a grid, so that many samples land exactly on the edges of the band
+    v = np.round(np.random.default_rng(n).uniform(0, 1, n), 2)
+    monkeypatch.setattr(hysteresis, "VECTORIZE_MIN_LENGTH", n + 1)
+    looped = hysteresis_kernel(v, 0.05, last)
+    monkeypatch.setattr(hysteresis, "VECTORIZE_MIN_LENGTH", 1)
+    np.testing.assert_array_equal(hysteresis_kernel(v, 0.05, last), looped)
+
+def test_filter_in_chunks_matches_whole_series():
+    v = np.clip(np.cumsum(np.random.default_rng(0).normal(0, 0.01, 10000)) + 0.5, 0, 1)
+    f = HysteresisFilter(0.015)
+    chunks = [f.filter(v[start:start + 3000]) for start in range(0, len(v), 3000)]
+    np.testing.assert_array_equal(np.concatenate(chunks), hysteresis_kernel(v, 0.015))
+
+def test_missing_positions_hold_the_filtered_position(monkeypatch):
+    v = np.clip(np.cumsum(np.random.default_rng(1).normal(0, 0.01, 5000)) + 0.5, 0, 1)
+    v[[100, 2500, 2501, 4999]] = np.nan
+    monkeypatch.setattr(hysteresis, "VECTORIZE_MIN_LENGTH", len(v) + 1)
+    looped = hysteresis_kernel(v, 0.015)
+    assert not np.any(np.isnan(looped))
+    monkeypatch.setattr(hysteresis, "VECTORIZE_MIN_LENGTH", 1)
+    np.testing.assert_array_equal(hysteresis_kernel(v, 0.015), looped)
+    f = HysteresisFilter(0.015)
+    chunks = [f.filter(v[start:start + 700]) for start in range(0, len(v), 700)]
+    np.testing.assert_array_equal(np.concatenate(chunks), looped)
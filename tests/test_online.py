@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from benchmark import generate_data_set
+from online import OnlineEstimator
+from training import train_model
+from utils.topology import load_topology
+from utils.utils import iter_data
+
+def online_settings(**changes):
+    settings = {
+        "name": "online", "parameterization": "ramps", "flow rate weights": 1, "hysteresis percent": 1.5,
+        "cost norm": 2, "regularization norm": 1, "valve regularization gain": 1e-4,
+        "pipe regularization gain": 1e-4, "flow rate exponent": 2.0, "flow rate threshold": 0.1,
+        "training data percent": 100, "zero threshold": 0, "solver": "nnls",
+    }
+    return dict(settings, **changes)
+
+@pytest.mark.parametrize("regularization_norm", [1, 2])
+def test_online_estimate_matches_batch_model(data_dir, regularization_norm):
+    generate_data_set(load_topology({}), 1000).to_csv(data_dir / "synthetic.csv")
+    settings = online_settings(**{"regularization norm": regularization_norm})
+    estimator = OnlineEstimator(settings)
+    for batch in iter_data("synthetic", 97, None):
+        estimator.update(batch)
+    model = train_model(settings, "synthetic")
+    theta, s = estimator.parameters()
+    np.testing.assert_allclose(np.ravel(theta), np.ravel(model["theta"]), rtol=1e-6, atol=1e-12)
+    np.testing.assert_allclose(s, model["s"], rtol=1e-6, atol=1e-12)
+
+def test_online_estimator_refuses_cost_norm_1():
+    with pytest.raises(ValueError, match="cost norm 2"):
+        OnlineEstimator(online_settings(**{"cost norm": 1}))
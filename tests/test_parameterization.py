@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from utils.parameterization import RAMP_PARAMETERS, f_linear, f_ramps, load_parameterization
+from utils.utils import ramp
+
+# the basis functions of one valve position, as before they were vectorized
+SCALAR_BASES = {
+    "linear": lambda v: np.array([1 / (v**2)]),
+    "ramps": lambda v: np.array([1 / ramp(v, a, b)**c for a in RAMP_PARAMETERS["a"] for b in RAMP_PARAMETERS["b"] for c in RAMP_PARAMETERS["c"]]),
+}
+POSITIONS = [0.05, 0.12, 0.5, 0.93, 1.0]
+
+@pytest.mark.parametrize("name, f", [("linear", f_linear), ("ramps", f_ramps)])
+def test_basis_functions_take_single_positions_and_vectors(name, f):
+    for v in POSITIONS:
+        np.testing.assert_allclose(f(v), SCALAR_BASES[name](v), rtol=1e-14)
+    features = f(np.array(POSITIONS))
+    assert features.shape == (len(POSITIONS), len(SCALAR_BASES[name](0.5)))
+    np.testing.assert_allclose(features, [SCALAR_BASES[name](v) for v in POSITIONS], rtol=1e-14)
+    np.testing.assert_allclose(load_parameterization({"parameterization": name})(0.5), f(0.5), rtol=0)
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import generate_data_set
+from training import make_data_matrices, train_model, train_model_chunked
+from utils.parameterization import RAMP_PARAMETERS
+from utils.topology import load_topology
+
+# the pipes on the path to each valve of the lab network
+PIPEMAP = [[0, 4], [1, 4, 5], [2, 4, 5, 6], [3, 4, 5, 6]]
+
+def ramp(x, a, b, tol = 1e-8):
+    return min(max(x-a+tol, tol), b-a) / (b-a)
+
+FEATURES = {
+    "linear": lambda v: np.array([1 / (v**2)]),
+    "ramps": lambda v: np.array([1 / ramp(v, a, b)**c for a in RAMP_PARAMETERS["a"] for b in RAMP_PARAMETERS["b"] for c in RAMP_PARAMETERS["c"]]),
+}
+
+def iterrows_data_matrices(data, settings):
+    """
+    The data matrices built one load condition at a time with iterrows, as before make_data_matrices was vectorized
+    """
+    features = FEATURES[settings["parameterization"]]
+    gamma = settings["flow rate exponent"]
+    phi, y, w = [], [], []
+    for _, row in data.iterrows():
+        gv = [row[f"q{i}"]**gamma * features(row[f"vh{i}"]) for i in range(4)]
+        k = len(gv[0])
+        block = np.zeros((4, 4*k + 7))
+        for i in range(4):
+            block[i, i*k:(i+1)*k] = gv[i]
+            block[i, [4*k + e for e in PIPEMAP[i]]] = [2 * row[f"q{e}"]**gamma for e in PIPEMAP[i]]
+        keep = [i for i in range(4) if not row[f"q{i}"] < settings["flow rate threshold"]]
+        phi.append(block[keep])
+        y.append(row["dp_pump"] * np.ones(len(keep)))
+        w.append(np.array([row[f"vh{i}"] for i in keep]) - 0.2)
+    return np.vstack(phi), np.concatenate(y), np.concatenate(w)
+
+def lab_data(n, seed = 0):
+    rng = np.random.default_rng(seed)
+    q = rng.uniform(0, 2, (n, 4))
+    data = pd.DataFrame({f"q{i}": q[:, i] for i in range(4)})
+    data["q4"] = q.sum(axis=1)
+    data["q5"] = q[:, 1:].sum(axis=1)
+    data["q6"] = q[:, 2:].sum(axis=1)
+    for i in range(4):
+        data[f"vh{i}"] = rng.uniform(0.05, 1, n)
+    data["dp_pump"] = rng.uniform(2, 4, n)
+    return data
+
+@pytest.mark.parametrize("parameterization", ["linear", "ramps"])
+@pytest.mark.parametrize("threshold", [0.0, 0.5])
+@pytest.mark.parametrize("gamma", [2.0, 1.8])
+def test_make_data_matrices_matches_iterrows(parameterization, threshold, gamma):
+    settings = {"parameterization": parameterization, "flow rate threshold": threshold, "flow rate exponent": gamma}
+    data = lab_data(200)
+    phi, y, w = make_data_matrices(data, settings)
+    phi_ref, y_ref, w_ref = iterrows_data_matrices(data, settings)
+    assert phi.shape == phi_ref.shape
+    np.testing.assert_allclose(phi.toarray(), phi_ref, rtol=1e-13, atol=0)
+    np.testing.assert_array_equal(y, y_ref)
+    np.testing.assert_array_equal(w, w_ref)
+
+def chunked_settings(cost_norm):
+    return {
+        "name": "chunked", "parameterization": "ramps", "flow rate weights": 1, "hysteresis percent": 1.5,
+        "cost norm": cost_norm, "regularization norm": 1, "valve regularization gain": 1e-4,
+        "pipe regularization gain": 1e-4, "flow rate exponent": 2.0, "flow rate threshold": 0.1,
+        "training data percent": 70, "zero threshold": 1e-8,
+    }
+
+@pytest.mark.parametrize("regularization_norm", [1, 2])
+def test_train_model_chunked_matches_in_memory(data_dir, regularization_norm):
+    generate_data_set(load_topology({}), 1000).to_csv(data_dir / "synthetic.csv")
+    settings = dict(chunked_settings(2), **{"regularization norm": regularization_norm})
+    model = train_model(settings, "synthetic")
+    chunked = train_model_chunked(settings, "synthetic", 97)
+    np.testing.assert_allclose(np.array(chunked["theta"]), np.array(model["theta"]), rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(chunked["s"], model["s"], rtol=1e-9, atol=1e-12)
+
+@pytest.mark.parametrize("changes", [{"cost norm": 1}, {"solver": "cvxpy"}, {"solver": "admm"}])
+def test_train_model_chunked_refuses_unbounded_solvers(data_dir, changes):
+    # these solvers need all rows of phi in memory at once
+    generate_data_set(load_topology({}), 100).to_csv(data_dir / "synthetic.csv")
+    with pytest.raises(ValueError, match="requires the nnls solver"):
+        train_model_chunked(dict(chunked_settings(2), **changes), "synthetic", 10)
+
+def test_train_model_chunked_without_training_data(data_dir):
+    generate_data_set(load_topology({}), 100).to_csv(data_dir / "synthetic.csv")
+    settings = dict(chunked_settings(2), **{"training data percent": 0})
+    with pytest.raises(ValueError, match="No training data"):
+        train_model_chunked(settings, "synthetic", 10)